@@ -10,6 +10,26 @@ from gensim.models.keyedvectors import KeyedVectors
 from config import opt, data
 
 from utils import timer, batchify, pairwise_distances
+from inference import pool_precision, inference_module, autocast
+import time
+
+
+def legacy_conv_weight(weight, word_dim):
+    """Weight of a convolution over the flattened 1 x (WORD_DIM * MAX_SENT_LEN)
+    sentence, as in older checkpoints, converted to the same filters over the
+    (WORD_DIM, sentence length) layout
+    """
+    n_filters = weight.size(0)
+    return weight.view(n_filters, -1, word_dim).transpose(1, 2).contiguous()
+
+
+def convert_legacy_state(state_dict, word_dim):
+    """Copy of `state_dict` with any legacy convolution weights converted"""
+    converted = state_dict.copy()
+    for key, value in state_dict.items():
+        if key.startswith('conv_') and key.endswith('.weight') and value.dim() == 3 and value.size(1) == 1:
+            converted[key] = legacy_conv_weight(value, word_dim)
+    return converted
 
 
 class CNN(nn.Module):
@@ -25,7 +45,6 @@ class CNN(nn.Module):
         self.FILTER_NUM = [100, 100, 100]
         self.DROPOUT_EMBED_PROB = 0.3
         self.DROPOUT_MODEL_PROB = 0.5
-        self.IN_CHANNEL = 1
         self.VOCAB_SIZE = len(data.vocab)
 
         # one for UNK and one for zero padding
@@ -41,6 +60,9 @@ class CNN(nn.Module):
     def get_conv(self, i):
         return getattr(self, 'conv_{}'.format(i))
 
+    def load_state_dict(self, state_dict, strict=True):
+        return super(CNN, self).load_state_dict(convert_legacy_state(state_dict, self.WORD_DIM), strict)
+
     def reset(self):
         self.embed = nn.Embedding(self.NUM_EMBEDDINGS, self.WORD_DIM, padding_idx=self.VOCAB_SIZE + 1)
 
@@ -49,8 +71,7 @@ class CNN(nn.Module):
             self.embed.weight.data.copy_(torch.from_numpy(data["w2v"]))
 
         for i in range(len(self.FILTERS)):
-            conv = nn.Conv1d(
-                self.IN_CHANNEL, self.FILTER_NUM[i], self.WORD_DIM * self.FILTERS[i], stride=self.WORD_DIM)
+            conv = nn.Conv1d(self.WORD_DIM, self.FILTER_NUM[i], self.FILTERS[i])
             setattr(self, 'conv_{}'.format(i), conv)
 
         self.fc = nn.Linear(sum(self.FILTER_NUM), self.CLASS_SIZE)
@@ -65,13 +86,12 @@ class CNN(nn.Module):
         # inp = (25 x 59) - (mini_batch_size x sentence_length)
         if opt.cuda:
             inp = inp.cuda()
-        x = self.embed(inp).view(-1, 1, self.WORD_DIM * self.MAX_SENT_LEN)
+        x = self.embed(inp.view(-1, inp.size(-1))).transpose(1, 2).contiguous()
         x = self.dropout_embed(x)
-        # x = (25 x 1 x 17700) - mini_batch_size x embedding_for_each_sentence
+        # x = (25 x 300 x 59) - mini_batch_size x word_dim x sentence_length
 
         conv_results = [
-            F.max_pool1d(F.relu(self.get_conv(i)(x)),
-                         self.MAX_SENT_LEN - self.FILTERS[i] + 1).view(-1, self.FILTER_NUM[i])
+            torch.max(F.relu(self.get_conv(i)(x)), 2)[0]
             for i in range(len(self.FILTERS))]
         conv_results = torch.cat(conv_results, 1)
         x = self.dropout(conv_results)
@@ -157,28 +177,52 @@ class CNN(nn.Module):
         return self.validate(dataset)
 
     def encode_episode_data(self):
-        with torch.no_grad():
-            all_predictions = torch.Tensor()
-            all_repr = torch.Tensor()
-
-            if opt.cuda:
-                all_predictions, all_repr = all_predictions.cuda(), all_repr.cuda()
-
-            for i, (sentences, targets) in enumerate(batchify(data["train"])):
-                # print(sentences)
+        data["all_states"] = self.encode_states(data["train"], pool_precision())
+        print(data["all_states"].size())
+
+    def encode_states(self, dataset, precision='fp32'):
+        """States (conv features and class probabilities) of every sentence
+        in `dataset`, computed at `precision`
+        """
+        model = inference_module(self, precision)
+        with torch.no_grad(), autocast(precision):
+            all_predictions = []
+            all_repr = []
+
+            for i, (sentences, targets) in enumerate(batchify(dataset)):
                 sentences = torch.LongTensor(sentences)
-                targets = torch.LongTensor(targets)
 
                 if opt.cuda:
                     sentences = sentences.cuda()
 
-                preds, repr = self.forward(sentences, include_repr=True)
-                preds = nn.functional.softmax(preds, dim=1)
-                all_predictions = torch.cat((all_predictions, preds), dim=0)
-                all_repr = torch.cat((all_repr, repr), dim=0)
-            all_states = torch.cat((all_repr, all_predictions), dim=1)
-            data["all_states"] = all_states
-            print(data["all_states"].size())
+                preds, repr = model.forward(sentences, include_repr=True)
+                preds = nn.functional.softmax(preds.float(), dim=1)
+                all_predictions.append(preds)
+                all_repr.append(repr.float())
+            all_states = torch.cat((torch.cat(all_repr), torch.cat(all_predictions)), dim=1)
+        return all_states
+
+    def compare_precision(self, dataset):
+        """Encodes `dataset` at full and at the pool precision, and reports
+        how often the predicted class agrees, the mean state error, the
+        accuracy delta and the speedup of the reduced precision pass
+        """
+        time1 = time.time()
+        ref_states = self.encode_states(dataset)
+        time2 = time.time()
+        states = self.encode_states(dataset, pool_precision())
+        time3 = time.time()
+
+        targets = torch.LongTensor(dataset[1]).to(states.device)
+        ref_preds = ref_states[:, -self.CLASS_SIZE:].max(1)[1]
+        preds = states[:, -self.CLASS_SIZE:].max(1)[1]
+        metrics = {
+            "prediction_agreement": (ref_preds == preds).float().mean().item(),
+            "state_error": (ref_states - states).abs().mean().item(),
+            "delta_accuracy": 100.0 * ((preds == targets).float().mean() - (ref_preds == targets).float().mean()).item(),
+            "speedup": (time2 - time1) / max(time3 - time2, 1e-6)
+        }
+        return metrics
 
     def query(self, index):
         # current_state = data["all_states"][index].view(1, -1)
@@ -0,0 +1,96 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from datasets.vse.vocab import tokenizer_version
+
+CACHE_FILES = ('tokens', 'offsets', 'lengths', 'sort_idx')
+
+
+def file_hash(path, block_size=1 << 20):
+    """sha1 of the raw bytes of `path`"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def vocab_hash(vocab):
+    """sha1 of the word -> id mapping, independent of dict ordering"""
+    h = hashlib.sha1()
+    for word, idx in sorted(vocab.word2idx.items(), key=lambda x: x[1]):
+        h.update('{}\t{}\n'.format(idx, word).encode('utf-8'))
+    return h.hexdigest()
+
+
+def tokenize_captions(captions, vocab, tokenizer='nltk'):
+    """Captions encoded by `vocab.encode_flat` with `tokenizer`, wrapped in
+    <start>/<end> and unknown words mapped to <unk>. The default nltk
+    tokenizer gives the same tokens as the old `load_data`.
+    Returns flat int32 tokens, int64 offsets and int32 lengths.
+    """
+    tokens, offsets, lengths = vocab.encode_flat(captions, tokenizer=tokenizer)
+    return tokens.astype(np.int32), offsets, lengths.astype(np.int32)
+
+
+def build_caption_cache(caption_path, vocab, cache_dir, tokenizer='nltk'):
+    """One-time preprocessing of a caption file into `cache_dir`.
+    The directory is written next to its final location and renamed
+    into place, so parallel runs never see a half-written cache.
+    """
+    with open(caption_path) as f:
+        captions = [line.strip() for line in f]
+
+    tokens, offsets, lengths = tokenize_captions(captions, vocab, tokenizer)
+    # Same (unstable) sort as before so cached order matches old runs
+    sort_idx = np.argsort(-1 * lengths.astype(np.int64))
+
+    parent = os.path.dirname(cache_dir)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    tmp_dir = tempfile.mkdtemp(dir=parent)
+    arrays = dict(zip(CACHE_FILES, (tokens, offsets, lengths, sort_idx)))
+    for name in CACHE_FILES:
+        np.save(os.path.join(tmp_dir, '{}.npy'.format(name)), arrays[name])
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        # Another process finished the same cache first
+        shutil.rmtree(tmp_dir)
+
+
+def load_caption_cache(caption_path, vocab, cache_root, tokenizer='nltk'):
+    """Returns memory-mapped (tokens, offsets, lengths, sort_idx) for
+    `caption_path`, building the cache first if it does not exist yet.
+    The cache is keyed by the caption file, the vocabulary and the
+    tokenizer version.
+    """
+    key = '{}_{}_{}_{}'.format(os.path.basename(caption_path).split('.')[0],
+                               file_hash(caption_path)[:16],
+                               vocab_hash(vocab)[:16],
+                               tokenizer_version(tokenizer))
+    cache_dir = os.path.join(cache_root, key)
+    if not os.path.isdir(cache_dir):
+        print("Building caption cache {}".format(cache_dir))
+        build_caption_cache(caption_path, vocab, cache_dir, tokenizer)
+
+    return tuple(np.load(os.path.join(cache_dir, '{}.npy'.format(name)), mmap_mode='r')
+                 for name in CACHE_FILES)
+
+
+def pad_sorted(tokens, offsets, lengths, sort_idx):
+    """Padded int64 caption matrix in `sort_idx` order, without a
+    per-row Python loop.
+    """
+    lengths = np.asarray(lengths)[sort_idx]
+    starts = np.asarray(offsets)[sort_idx]
+    max_len = int(lengths.max()) if len(lengths) else 0
+    positions = np.arange(max_len)
+    mask = positions[None, :] < lengths[:, None]
+    padded = np.zeros((len(lengths), max_len), dtype=np.int64)
+    padded[mask] = np.asarray(tokens)[(starts[:, None] + positions[None, :])[mask]]
+    return padded, lengths.astype(np.int64)
@@ -2,7 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.init
 import torchvision.models as models
-from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.autograd.function import once_differentiable
+from torch.nn.utils.rnn import pack_padded_sequence
 import torch.backends.cudnn as cudnn
 from torch.nn.utils import clip_grad_norm_
 import numpy as np
@@ -10,6 +11,9 @@ import sklearn
 from collections import OrderedDict
 from config import opt, data
 from utils import batchify, pairwise_distances, timer
+from embedding_store import EmbeddingStore, next_version
+from inference import pool_precision, inference_module, autocast, topk_overlap
+from state_store import StateStore, compact_indices
 from pprint import pprint
 import itertools
 
@@ -213,22 +217,18 @@ class EncoderText(nn.Module):
             self.embed.weight.data.copy_(torch.from_numpy(data.w2v))
 
     def forward(self, x, lengths):
-        """Handles variable size captions
+        """Handles variable size captions. `lengths` (list, array or tensor)
+        has to be sorted in descending order, the caption embedding is the
+        final hidden state of the GRU.
         """
-        # Embed word ids to vectors
-        x = self.embed(x)
+        lengths = torch.as_tensor(lengths, dtype=torch.long)
+        # Embed word ids to vectors, without the padding past the longest
+        x = self.embed(x[:, :int(lengths[0])])
         packed = pack_padded_sequence(x, lengths, batch_first=True)
 
-        # Forward propagate RNN
-        out, _ = self.rnn(packed)
-
-        # Reshape *final* output to (batch_size, hidden_size)
-        padded = pad_packed_sequence(out, batch_first=True)
-        I = torch.LongTensor(lengths).view(-1, 1, 1)
-        I = I.expand(x.size(0), 1, self.embed_size)-1
-        if opt.cuda:
-            I = I.cuda()
-        out = torch.gather(padded[0], 1, I).squeeze(1)
+        # Forward propagate RNN, h_n holds the last step of every caption
+        _, hidden = self.rnn(packed)
+        out = hidden[-1]
 
         # normalization in the joint embedding space
         out = l2norm(out)
@@ -246,13 +246,67 @@ def cosine_sim(im, s):
     return im.mm(s.t())
 
 
+# Max number of elements of the (rows x captions x dim) difference tensor
+# materialized at once by `order_sim`
+ORDER_SIM_CHUNK = 2 ** 24
+
+
+def order_sim_chunks(im, s):
+    """Yields (start, stop) row ranges of `im` that keep the difference
+    tensor within ORDER_SIM_CHUNK elements
+    """
+    rows = max(1, ORDER_SIM_CHUNK // max(1, s.size(0) * s.size(1)))
+    for start in range(0, im.size(0), rows):
+        yield start, min(start + rows, im.size(0))
+
+
+def order_sim_forward(im, s):
+    """Chunked $-||max(0, s-im)||$ without tracking gradients
+    """
+    score = im.new(im.size(0), s.size(0))
+    for start, stop in order_sim_chunks(im, s):
+        diff = s.unsqueeze(0) - im[start:stop].unsqueeze(1)
+        score[start:stop] = diff.clamp_(min=0).pow_(2).sum(2).sqrt_().neg_()
+    return score
+
+
+class OrderSim(torch.autograd.Function):
+    """Order similarity whose forward and backward passes both work in row
+    chunks, so the full B x B x D difference tensor is never kept in memory.
+    """
+
+    @staticmethod
+    def forward(ctx, im, s):
+        score = order_sim_forward(im, s)
+        ctx.save_for_backward(im, s, score)
+        return score
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_score):
+        # plain tensors in and out, wrapped in Variables by the decorator
+        im, s, score = ctx.saved_tensors
+        # d score / d max(0, s-im) = max(0, s-im) / score, and zero for
+        # pairs that are already ordered (score == 0)
+        coef = grad_score / score
+        coef.masked_fill_(score == 0, 0)
+        grad_im = im.new(im.size()).zero_()
+        grad_s = s.new(s.size()).zero_()
+        for start, stop in order_sim_chunks(im, s):
+            diff = s.unsqueeze(0) - im[start:stop].unsqueeze(1)
+            weighted = diff.clamp_(min=0).mul_(coef[start:stop].unsqueeze(2))
+            grad_im[start:stop] = -weighted.sum(1)
+            grad_s += weighted.sum(0)
+        return grad_im, grad_s
+
+
 def order_sim(im, s):
     """Order embeddings similarity measure $max(0, s-im)$
     """
-    YmX = (s.unsqueeze(1).expand(s.size(0), im.size(0), s.size(1))
-           - im.unsqueeze(0).expand(s.size(0), im.size(0), s.size(1)))
-    score = -YmX.clamp(min=0).pow(2).sum(2).sqrt().t()
-    return score
+    if (getattr(im, 'requires_grad', False) or
+            getattr(s, 'requires_grad', False)):
+        return OrderSim.apply(im, s)
+    return order_sim_forward(im, s)
 
 
 class ContrastiveLoss(nn.Module):
@@ -269,6 +323,17 @@ class ContrastiveLoss(nn.Module):
             self.sim = cosine_sim
 
         self.max_violation = max_violation
+        # diagonal masks keyed by batch size, built once per size
+        self.masks = {}
+
+    def diagonal_mask(self, size):
+        """Boolean identity mask of `size`, cached across calls"""
+        if size not in self.masks:
+            mask = torch.eye(size) > .5
+            if opt.cuda:
+                mask = mask.cuda()
+            self.masks[size] = mask
+        return self.masks[size]
 
     def forward(self, im, s):
         # compute image-sentence score matrix
@@ -285,10 +350,7 @@ class ContrastiveLoss(nn.Module):
         # image retrieval
         cost_im = (self.margin + scores - d2).clamp(min=0)
         # clear diagonals
-        mask = torch.eye(scores.size(0)) > .5
-        I = mask
-        if opt.cuda:
-            I = I.cuda()
+        I = self.diagonal_mask(scores.size(0))
         cost_s = cost_s.masked_fill_(I, 0)
         cost_im = cost_im.masked_fill_(I, 0)
 
@@ -334,6 +396,13 @@ class VSE(nn.Module):
 
         self.optimizer = torch.optim.Adam(params, lr=opt.learning_rate_vse)
 
+        # Bumped whenever the weights change, invalidates cached embeddings
+        self.version = next_version()
+        self.embedding_store = EmbeddingStore(opt.get('embed_spill_dir', ''),
+                                              opt.get('embed_spill_size', 0))
+        # (version, img_enc, txt_enc) quantized for int8 inference
+        self.quantized = None
+
     def reset(self):
         self.img_enc = EncoderImage(opt.data_name, opt.img_dim, opt.embed_size,
                                     opt.finetune, opt.cnn_type,
@@ -352,7 +421,7 @@ class VSE(nn.Module):
             params += list(self.img_enc.cnn.parameters())
         self.params = params
         self.optimizer = torch.optim.Adam(params, lr=opt.learning_rate_vse)
-
+        self.version = next_version()
 
     def state_dict(self):
         state_dict = [self.img_enc.state_dict(), self.txt_enc.state_dict()]
@@ -361,6 +430,7 @@ class VSE(nn.Module):
     def load_state_dict(self, state_dict):
         self.img_enc.load_state_dict(state_dict[0])
         self.txt_enc.load_state_dict(state_dict[1])
+        self.version = next_version()
 
     def train_start(self):
         """switch to train mode
@@ -439,6 +509,7 @@ class VSE(nn.Module):
         if self.grad_clip > 0:
             clip_grad_norm_(self.params, self.grad_clip)
         self.optimizer.step()
+        self.version = next_version()
         del img_emb, cap_emb
         return loss
 
@@ -450,8 +521,7 @@ class VSE(nn.Module):
             # all_vectors, current_vector = all_vectors.cuda(), current_vector.cuda()
 
         current_state = data["all_states"][index].view(1, -1)
-        all_states = data["all_states"]
-        current_all_dist = pairwise_distances(current_state, all_states)
+        current_all_dist = data["all_states"].distances(current_state)
         similar_indices = torch.topk(current_all_dist, opt.selection_radius * 5, 1, largest=False)[1]
         similar_indices = similar_indices.data[0].cpu().numpy()
         for idx in similar_indices:
@@ -466,26 +536,78 @@ class VSE(nn.Module):
         data["active"][1].append(caption)
         data["active"][2].append(length)
 
-    def encode_data(self, dataset):
-        """Encode all images and captions loadable by `data_loader`
+    def encode_data(self, dataset, precision=None):
+        """Encode all images and captions of `dataset`. Splits held in
+        `data` are served from the embedding store while the weights and
+        the split are unchanged. The pool is encoded at `opt.inference_precision`
+        unless `precision` is given, everything else at full precision.
         """
+        split = dataset_split(dataset)
+        if precision is None:
+            precision = pool_precision() if split == 'train_deleted' else 'fp32'
+        if split is None:
+            return self.encode_dataset(dataset, precision)
+        key = (self.version, id(dataset), len(dataset[0]), precision)
+        return self.embedding_store.get(split, key, lambda: self.encode_dataset(dataset, precision))
+
+    def inference_encoders(self, precision):
+        """Image and text encoders to run inference at `precision` with"""
+        if precision != 'int8':
+            return self.img_enc, self.txt_enc
+        if self.quantized is None or self.quantized[0] != self.version:
+            self.quantized = (self.version, inference_module(self.img_enc, precision),
+                              inference_module(self.txt_enc, precision))
+        return self.quantized[1:]
+
+    def encode_dataset(self, dataset, precision='fp32'):
         # with torch.no_grad():
         torch.set_grad_enabled(False)
         self.val_start()
+        img_enc, txt_enc = self.inference_encoders(precision)
         img_embs = []
         cap_embs = []
-        for i, (images, captions, lengths) in enumerate(batchify(dataset)):
-            # compute the embeddings
-            img_emb, cap_emb = self.forward_emb(images, captions, lengths, volatile=True)
-            img_embs.append(img_emb)
-            cap_embs.append(cap_emb)
-            del img_emb, cap_emb
-            del images, captions
+        with autocast(precision):
+            for i, (images, captions, lengths) in enumerate(batchify(dataset)):
+                # compute the embeddings
+                images = torch.FloatTensor(images)
+                captions = torch.LongTensor(captions)
+                if opt.cuda:
+                    images = images.cuda()
+                    captions = captions.cuda()
+                img_embs.append(img_enc(images).float())
+                cap_embs.append(txt_enc(captions, lengths).float())
+                del images, captions
         img_embs = torch.cat(img_embs)
         cap_embs = torch.cat(cap_embs)
         torch.set_grad_enabled(True)
         return img_embs, cap_embs
 
+    def compare_precision(self, dataset):
+        """Encodes `dataset` at full and at the pool precision, and reports
+        the overlap of the top-k captions of every image, the recall deltas
+        and the speedup of the reduced precision pass
+        """
+        precision = pool_precision()
+        time1 = time.time()
+        ref_embs = self.encode_dataset(dataset)
+        time2 = time.time()
+        embs = self.encode_dataset(dataset, precision)
+        time3 = time.time()
+        if opt.cuda:
+            ref_embs = tuple(emb.cuda() for emb in ref_embs)
+            embs = tuple(emb.cuda() for emb in embs)
+
+        ref_topk = torch.topk(pairwise_distances(*ref_embs), opt.topk, 1, largest=False)[1]
+        topk = torch.topk(pairwise_distances(*embs), opt.topk, 1, largest=False)[1]
+        metrics = {
+            "topk_overlap": topk_overlap(ref_topk, topk),
+            "speedup": (time2 - time1) / max(time3 - time2, 1e-6)
+        }
+        names = ("r1", "r5", "r10", "r1i", "r5i", "r10i")
+        for name, ref_recall, recall in zip(names, t2i2t(*ref_embs), t2i2t(*embs)):
+            metrics["delta_" + name] = recall - ref_recall
+        return metrics
+
     def train_model(self, train_data, epochs):
         # if opt.train_shuffle:
             # train_data = sklearn.utils.shuffle(*train_data)
@@ -529,6 +651,9 @@ class VSE(nn.Module):
         for both image -> caption and cap -> img, and the sum of them all added together"""
 
         img_embs, cap_embs = self.encode_data(dataset)
+        if opt.cuda:
+            img_embs = img_embs.cuda()
+            cap_embs = cap_embs.cuda()
         (r1, r5, r10, r1i, r5i, r10i) = t2i2t(img_embs, cap_embs)
 
         sum = r1 + r5 + r10 + r1i + r5i + r10i
@@ -559,8 +684,9 @@ class VSE(nn.Module):
         image_caption_distances = timer(pairwise_distances, (img_embs, cap_embs))
         topk = torch.topk(image_caption_distances, opt.topk, 1, largest=False)
         (image_caption_distances_topk, image_caption_distances_topk_idx) = (topk[0], topk[1])
-        data["image_caption_distances_topk"] = image_caption_distances_topk
-        data["image_caption_distances_topk_idx"] = image_caption_distances_topk_idx
+        state_dtype = opt.get('state_dtype', 'float32')
+        data["image_caption_distances_topk"] = StateStore(image_caption_distances_topk, state_dtype)
+        data["image_caption_distances_topk_idx"] = compact_indices(image_caption_distances_topk_idx)
         del topk
         del image_caption_distances
         intra_cap_distance = timer(pairwise_distances, (cap_embs, cap_embs))
@@ -584,7 +710,9 @@ class VSE(nn.Module):
         # print(data["all_states"].size())
         print(data["image_caption_distances_topk"].size())
         # data["all_states"] = torch.cat((img_embs, all_dist, data["image_caption_distances_topk"]), dim=1).cpu()
-        data["all_states"] = torch.cat((torch.Tensor(data["train_deleted"][0]), all_dist.cpu(), data["image_caption_distances_topk"].cpu()), dim=1).cpu()
+        all_states = torch.cat((image_states(data["train_deleted"][0]), all_dist.cpu(), image_caption_distances_topk.cpu()), dim=1)
+        data["all_states"] = StateStore(all_states, state_dtype)
+        del all_states, image_caption_distances_topk
         print(data["all_states"].size())
         # data["images_embed_all"] = img_embs.data.cpu()
         # data["captions_embed_all"] = cap_embs.data.cpu()
@@ -671,6 +799,27 @@ class VSE(nn.Module):
             param_group['lr'] = lr
 
 
+def image_states(images):
+    """Image part of the episode states, projected to `opt.state_dim`
+    dimensions when a state projection is used
+    """
+    images = torch.Tensor(images)
+    if data.get("state_projection") is None:
+        return images
+    mean, components = data["state_projection"]
+    return torch.mm(images - mean, components)
+
+
+def dataset_split(dataset):
+    """Name of the split in `data` that `dataset` is, if any. Splits are
+    replaced rather than changed in place, so identity tells revisions apart.
+    """
+    for split in ('train_deleted', 'dev', 'test', 'train', 'active'):
+        if data.get(split) is dataset:
+            return split
+    return None
+
+
 def i2t(images, captions, npts=None, measure='cosine', return_ranks=False):
     """
     Images->Text (Image Annotation)
@@ -0,0 +1,59 @@
+import os
+import tempfile
+
+import numpy as np
+
+PROJECTIONS = ('none', 'pca', 'random')
+
+
+def fit_pca(images, dim, chunk_size=4096):
+    """Mean and top `dim` principal directions of `images`, from a
+    covariance accumulated chunk by chunk so memory-mapped features are
+    never loaded as a whole
+    """
+    n, img_dim = images.shape
+    total = np.zeros(img_dim, dtype=np.float64)
+    cov = np.zeros((img_dim, img_dim), dtype=np.float64)
+    for start in range(0, n, chunk_size):
+        chunk = np.asarray(images[start:start + chunk_size], dtype=np.float64)
+        total += chunk.sum(axis=0)
+        cov += chunk.T.dot(chunk)
+    mean = total / n
+    cov = cov / n - np.outer(mean, mean)
+    # eigh sorts ascending
+    _, vectors = np.linalg.eigh(cov)
+    components = vectors[:, ::-1][:, :dim]
+    return mean.astype(np.float32), np.ascontiguousarray(components, dtype=np.float32)
+
+
+def fit_random(img_dim, dim, seed=0):
+    """Gaussian random projection, scaled to roughly keep distances"""
+    rng = np.random.RandomState(seed)
+    components = rng.randn(img_dim, dim) / np.sqrt(dim)
+    return np.zeros(img_dim, dtype=np.float32), components.astype(np.float32)
+
+
+def load_state_projection(images, kind, dim, cache_dir):
+    """Returns the (mean, components) projection of image features to
+    `dim` dimensions, fitted on `images` the first time and loaded from
+    `cache_dir` afterwards. The file is written next to its final
+    location and renamed into place, so parallel runs never see a
+    half-written projection.
+    """
+    path = os.path.join(cache_dir, 'state_projection_{}_{}_{}.npz'.format(kind, dim, len(images)))
+    if os.path.isfile(path):
+        projection = np.load(path)
+        return projection['mean'], projection['components']
+
+    if kind == 'pca':
+        mean, components = fit_pca(images, dim)
+    else:
+        mean, components = fit_random(images.shape[1], dim)
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.npz')
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, mean=mean, components=components)
+    os.rename(tmp_path, path)
+    return mean, components
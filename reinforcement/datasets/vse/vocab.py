@@ -5,7 +5,11 @@ from collections import Counter
 # from pycocotools.coco import COCO
 import json
 import argparse
+import multiprocessing
 import os
+import re
+
+import numpy as np
 
 annotations = {
     'coco_precomp': ['train_caps.txt', 'dev_caps.txt'],
@@ -19,6 +23,81 @@ annotations = {
 }
 
 
+# Regex port of the Treebank rules nltk's word_tokenize applies, with
+# sentence ends detected from the period before whitespace instead of punkt.
+# Rules work per line on lowercased text, so a whole batch of captions is
+# tokenized at once. It is not identical to nltk: abbreviations such as
+# "st." or "u.s." lose their final period and leading single quotes are
+# not split off, so it is only used when asked for.
+TOKEN_RULES = [(re.compile(pattern, re.M), repl) for pattern, repl in [
+    # starting quotes
+    (r'``', r' `` '),
+    (r'"(?<=[ (\[{<]")', r' `` '),
+    # punctuation
+    (r'[:,](?!\d)', r' \g<0> '),
+    (r'\.\.\.', r' ... '),
+    (r'[;@#$%&?!]', r' \g<0> '),
+    (r'\.(?<=\S[^\s.]\.)(?=[\s\'"])', r' . '),
+    (r'\.(?<=[^.]\.)(?=[\]\)}>"\']*[ \t]*$)', r' . '),
+    (r"' (?<=[^']' )", r" ' "),
+    # parens, brackets and double dashes
+    (r'[\]\[\(\)\{\}\<\>]', r' \g<0> '),
+    (r'--', r' -- '),
+    # ending quotes and contractions
+    (r'"', " '' "),
+    (r"''(?<=\S'')", r" '' "),
+    (r"'(?<=[^' ]')([smd]?|ll|re|ve) ", r" '\1 "),
+    (r"n't (?<=[^' ]n't )", r" n't "),
+    (r'not\b(?<=\bcannot)|na\b(?<=\b[gw][oa]nna)|ta\b(?<=\bgotta)',
+     r' \g<0>'),
+]]
+
+
+def tokenize_batch(captions):
+    """Fast regex tokenization of a list of captions, close to the
+    lowercased tokens of `nltk.tokenize.word_tokenize`
+    """
+    lines = []
+    for caption in captions:
+        if isinstance(caption, bytes):
+            caption = caption.decode('utf-8')
+        lines.append(' ' + caption.lower().replace('\n', ' ') + ' ')
+    text = '\n'.join(lines)
+    for pattern, repl in TOKEN_RULES:
+        text = pattern.sub(repl, text)
+    return [line.split() for line in text.split('\n')]
+
+
+def tokenize(caption):
+    return tokenize_batch([caption])[0]
+
+
+def nltk_tokenize_batch(captions):
+    """`nltk.tokenize.word_tokenize` of every lowercased caption, the
+    tokenization the datasets have always used
+    """
+    tokens = []
+    for caption in captions:
+        caption = caption.lower()
+        if isinstance(caption, bytes):
+            caption = caption.decode('utf-8')
+        tokens.append(nltk.tokenize.word_tokenize(caption))
+    return tokens
+
+
+TOKENIZERS = {'nltk': nltk_tokenize_batch, 'regex': tokenize_batch}
+
+# Bumped whenever TOKEN_RULES change the tokens they produce
+REGEX_RULES_VERSION = 1
+
+
+def tokenizer_version(tokenizer):
+    """Identifies the tokens `tokenizer` produces, for cache keys"""
+    if tokenizer == 'nltk':
+        return 'nltk-%s' % nltk.__version__
+    return '%s-%d' % (tokenizer, REGEX_RULES_VERSION)
+
+
 class Vocabulary(object):
     """Simple vocabulary wrapper."""
 
@@ -38,6 +117,53 @@ class Vocabulary(object):
             return self.word2idx['<unk>']
         return self.word2idx[word]
 
+    def encode_batch(self, captions, wrap=True, tokenizer='nltk'):
+        """Tokenizes and encodes a list of captions at once. Returns an int64
+        (n, max_len) array padded with <pad> and the int64 lengths. With
+        `wrap`, every caption is enclosed in <start> and <end>. `tokenizer`
+        is one of TOKENIZERS.
+        """
+        get = self.word2idx.get
+        unk = self.word2idx['<unk>']
+        tokens = TOKENIZERS[tokenizer](captions)
+        lengths = np.array([len(words) for words in tokens], dtype=np.int64)
+        flat = np.fromiter((get(word, unk) for words in tokens
+                            for word in words),
+                           dtype=np.int64, count=int(lengths.sum()))
+
+        offset = 1 if wrap else 0
+        max_len = int(lengths.max()) + 2 * offset if len(lengths) else 0
+        padded = np.full((len(tokens), max_len), self.word2idx['<pad>'],
+                         dtype=np.int64)
+        positions = np.arange(max_len)[None, :] - offset
+        padded[(positions >= 0) & (positions < lengths[:, None])] = flat
+        if wrap:
+            rows = np.arange(len(tokens))
+            padded[:, 0] = self.word2idx['<start>']
+            padded[rows, lengths + 1] = self.word2idx['<end>']
+            lengths = lengths + 2
+        return padded, lengths
+
+    def encode_flat(self, captions, chunk_size=10000, tokenizer='nltk'):
+        """`encode_batch` of the captions in chunks, concatenated into one
+        flat int64 token array. Returns the tokens together with the int64
+        offset and length of each caption.
+        """
+        tokens = [np.zeros(0, dtype=np.int64)]
+        lengths = [np.zeros(0, dtype=np.int64)]
+        for i in range(0, len(captions), chunk_size):
+            padded, chunk_lengths = self.encode_batch(
+                captions[i:i + chunk_size], tokenizer=tokenizer)
+            positions = np.arange(padded.shape[1])
+            tokens.append(padded[positions[None, :] < chunk_lengths[:, None]])
+            lengths.append(chunk_lengths)
+        tokens = np.concatenate(tokens)
+        lengths = np.concatenate(lengths)
+
+        offsets = np.zeros(len(lengths), dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths[:-1])
+        return tokens, offsets, lengths
+
     def __len__(self):
         return len(self.word2idx)
 
@@ -69,9 +195,22 @@ def from_txt(txt):
     return captions
 
 
-def build_vocab(data_path, data_name, jsons, threshold):
-    """Build a simple vocabulary wrapper."""
+def count_words(captions):
+    """Counts the nltk tokens of a list of captions"""
     counter = Counter()
+    for caption in captions:
+        counter.update(nltk.tokenize.word_tokenize(
+            caption.lower().decode('utf-8')))
+    return counter
+
+
+def build_vocab(data_path, data_name, jsons, threshold, workers=1):
+    """Build a simple vocabulary wrapper. With `workers` > 1 the captions
+    are counted in chunks by a process pool; the chunk counts are merged
+    in order, so the vocabulary is identical to the sequential one.
+    """
+    counter = Counter()
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
     for path in jsons[data_name]:
         full_path = os.path.join(os.path.join(data_path, data_name), path)
         # if data_name == 'coco':
@@ -80,13 +219,17 @@ def build_vocab(data_path, data_name, jsons, threshold):
             captions = from_flickr_json(full_path)
         else:
             captions = from_txt(full_path)
-        for i, caption in enumerate(captions):
-            tokens = nltk.tokenize.word_tokenize(
-                caption.lower().decode('utf-8'))
-            counter.update(tokens)
-
-            if i % 1000 == 0:
-                print("[%d/%d] tokenized the captions." % (i, len(captions)))
+        chunks = [captions[i:i + 1000] for i in range(0, len(captions), 1000)]
+        if pool:
+            counts = pool.imap(count_words, chunks)
+        else:
+            counts = (count_words(chunk) for chunk in chunks)
+        for i, chunk_counter in enumerate(counts):
+            counter.update(chunk_counter)
+            print("[%d/%d] tokenized the captions." % (i * 1000, len(captions)))
+    if pool:
+        pool.close()
+        pool.join()
 
     # Discard if the occurrence of the word is less than min_word_cnt.
     words = [word for word, cnt in counter.items() if cnt >= threshold]
@@ -104,8 +247,9 @@ def build_vocab(data_path, data_name, jsons, threshold):
     return vocab
 
 
-def main(data_path, data_name):
-    vocab = build_vocab(data_path, data_name, jsons=annotations, threshold=4)
+def main(data_path, data_name, workers=1):
+    vocab = build_vocab(data_path, data_name, jsons=annotations, threshold=4,
+                        workers=workers)
     with open('./vocab/%s_vocab.pkl' % data_name, 'wb') as f:
         pickle.dump(vocab, f, pickle.HIGHEST_PROTOCOL)
     print("Saved vocabulary file to ", './vocab/%s_vocab.pkl' % data_name)
@@ -116,5 +260,7 @@ if __name__ == '__main__':
     parser.add_argument('--data_path', default='/w/31/faghri/vsepp_data/')
     parser.add_argument('--data_name', default='coco',
                         help='{coco,f8k,f30k,10crop}_precomp|coco|f8k|f30k')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Processes counting the caption words.')
     opt = parser.parse_args()
-    main(opt.data_path, opt.data_name)
+    main(opt.data_path, opt.data_name, opt.workers)
@@ -0,0 +1,72 @@
+import itertools
+import os
+
+import numpy as np
+import torch
+
+# Shared by every model instance, so a rebuilt or reset model never
+# reuses the version of an older one
+_versions = itertools.count()
+
+
+def next_version():
+    """Returns a new, globally unique model version"""
+    return next(_versions)
+
+
+class EmbeddingStore(object):
+    """Keeps the embeddings of each dataset split together with the key
+    (model version, dataset revision) they were computed for, so every
+    weights/split pair is encoded at most once.
+    Embeddings are kept as float32 cpu tensors. Splits with at least
+    `spill_size` rows are moved to memory-mapped files in `spill_dir`.
+    """
+
+    def __init__(self, spill_dir='', spill_size=0):
+        self.spill_dir = spill_dir
+        self.spill_size = spill_size
+        self.entries = {}
+        self.spills = itertools.count()
+
+    def get(self, split, key, encode):
+        """Returns the embeddings of `split` cached under `key`, calling
+        `encode()` and replacing the old entry on a miss.
+        """
+        entry = self.entries.get(split)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+
+        self.drop(split)
+        paths = []
+        embs = tuple(self.keep(split, emb, paths) for emb in encode())
+        self.entries[split] = (key, embs, paths)
+        return embs
+
+    def keep(self, split, emb, paths):
+        emb = emb.detach().float().cpu()
+        if not self.spill_dir or len(emb) < self.spill_size:
+            return emb
+
+        if not os.path.isdir(self.spill_dir):
+            os.makedirs(self.spill_dir)
+        path = os.path.join(self.spill_dir, '{}_{}_{}.npy'.format(os.getpid(), split, next(self.spills)))
+        spilled = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=tuple(emb.size()))
+        spilled[:] = emb.numpy()
+        spilled.flush()
+        paths.append(path)
+        return torch.from_numpy(spilled)
+
+    def drop(self, split):
+        """Forgets `split`. Spilled files are unlinked, tensors still
+        holding their mapping stay valid until they are released.
+        """
+        entry = self.entries.pop(split, None)
+        if entry is None:
+            return
+        for path in entry[2]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def clear(self):
+        for split in list(self.entries):
+            self.drop(split)
@@ -0,0 +1,65 @@
+import contextlib
+import copy
+
+import torch
+import torch.nn as nn
+
+from config import opt
+
+PRECISIONS = ('fp32', 'int8', 'bf16')
+
+
+# Precisions already reported as unsupported by this torch version
+_unsupported = set()
+
+
+def supported_precision(precision):
+    """`precision`, or fp32 with a message if this torch version lacks
+    dynamic quantization (int8) or autocast (bf16)
+    """
+    if precision == 'int8':
+        supported = hasattr(torch, 'quantization') and hasattr(torch.quantization, 'quantize_dynamic')
+    elif precision == 'bf16':
+        supported = hasattr(torch, 'autocast')
+    else:
+        supported = True
+    if supported:
+        return precision
+    if precision not in _unsupported:
+        _unsupported.add(precision)
+        print("inference precision {} needs torch.{} (torch {}), falling back to fp32".format(
+            precision, 'quantization' if precision == 'int8' else 'autocast', torch.__version__))
+    return 'fp32'
+
+
+def pool_precision():
+    """Precision of the inference passes over the unlabeled pool"""
+    return supported_precision(opt.get('inference_precision', 'fp32'))
+
+
+def inference_module(module, precision):
+    """`module` as used for inference at `precision`. int8 returns a cpu
+    copy with dynamically quantized Linear and GRU layers, the other
+    precisions run the module itself.
+    """
+    if supported_precision(precision) != 'int8':
+        return module
+    module = copy.deepcopy(module).cpu()
+    return torch.quantization.quantize_dynamic(module, {nn.Linear, nn.GRU}, dtype=torch.qint8)
+
+
+def autocast(precision):
+    """Context running the enclosed ops in bfloat16 for `bf16`"""
+    if supported_precision(precision) != 'bf16':
+        return contextlib.suppress()
+    return torch.autocast('cuda' if opt.cuda else 'cpu', dtype=torch.bfloat16)
+
+
+def topk_overlap(ref_idx, idx):
+    """Mean fraction of the top-k indices of each row of `ref_idx` that are
+    also in the same row of `idx`
+    """
+    ref_idx, idx = ref_idx.cpu(), idx.cpu()
+    k = ref_idx.size(1)
+    same = (ref_idx.unsqueeze(2) == idx.unsqueeze(1)).any(dim=2).sum(dim=1)
+    return same.float().mean().item() / k
@@ -104,6 +104,24 @@ class NoLogger(object):
         pass
 
 
+class RecordingLogger(object):
+    """Records the logging calls of a repetition run in a worker process,
+    to be replayed on the real logger by the parent."""
+    def __init__(self, calls=None):
+        self.calls = [] if calls is None else calls
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        def record(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+        return record
+
+    def replay(self, lg):
+        for name, args, kwargs in self.calls:
+            getattr(lg, name)(*args, **kwargs)
+
 class VisdomLogger(object):
     def __init__(self):
         self.vis = Visdom('http://logserver.duckdns.org', port=5010)
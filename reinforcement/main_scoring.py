@@ -52,6 +52,13 @@ def main():
         parser.add_argument('--no_imgnorm',         action='store_true',        help='Do not normalize the image embeddings.')
         parser.add_argument('--finetune',           action='store_true',        help='Fine-tune the image encoder.')
         parser.add_argument('--use_restval',        action='store_true',        help='Use the restval data for training on MSCOCO.')
+        parser.add_argument('--caption_cache_path', default='',     type=str,   help='Dir for pre-tokenized caption caches (default: DATA_PATH/DATA_NAME/caption_cache)')
+        parser.add_argument('--tokenizer',          default='nltk', type=str,   help='Caption tokenizer (nltk|regex). regex is faster but differs from nltk on abbreviations and quotes.')
+        parser.add_argument('--embed_spill_dir',    default='',     type=str,   help='Dir to memory-map cached embeddings of large splits to (default: keep in memory)')
+        parser.add_argument('--embed_spill_size',   default=100000, type=int,   help='Min number of rows before cached embeddings are spilled to disk.')
+        parser.add_argument('--state_dtype',        default='float32', type=str, help='Storage of the episode states and distance caches (float32|float16|int8)')
+        parser.add_argument('--state_projection',   default='none', type=str,   help='Projection of the image features in the state (none|pca|random)')
+        parser.add_argument('--state_dim',          default=256,    type=int,   help='Dimensionality of the projected image features.')
         # parser.add_argument('--resume',             default='',    type=str, metavar='PATH', help='path to latest checkpoint (default: none)')
 
     # Global params all datasets use
@@ -64,11 +71,15 @@ def main():
     parser.add_argument('--c',              default='',                                 type=str,   help='Comment in logfile')
     parser.add_argument('--gamma',          default=0,                                  type=float, help='Discount factor')
     parser.add_argument('--load_model_name',default='',                                 type=str,   help='Path to existing RL model')
+    parser.add_argument('--inference_precision', default='fp32',                        type=str,   help='Precision of the encoding passes over the pool (fp32 | int8 | bf16)')
+    parser.add_argument('--n_average',      default=10,                                 type=int,   help='Number of active learning runs to average')
+    parser.add_argument('--average_workers',default=1,                                  type=int,   help='Number of processes running the averaged runs in parallel (cpu only)')
 
     parser.add_argument('--reset_train',    action='store_true', help='Ensure the training is always done in train mode (Not recommended).')
     parser.add_argument('--no_cuda',        action='store_true', help='Disable cuda')
     parser.add_argument('--reward_clip',    action='store_true', help='Give positive actions +1 and negative actions -1 reward')
     parser.add_argument('--train_shuffle',  action='store_true', help='Shuffle active train set every time')
+    parser.add_argument('--inference_compare', action='store_true', help='Log top-k overlap and recall deltas of the inference precision against fp32')
 
     params = parser.parse_args(sys.argv[3:])
     params.actions = 2
@@ -79,6 +90,9 @@ def main():
     if torch.cuda.is_available():
         torch.cuda.set_device(params.device)
     params.cuda = (not params.no_cuda) and torch.cuda.is_available()
+    if params.cuda and params.inference_precision == 'int8':
+        print("int8 inference is cpu only, using fp32")
+        params.inference_precision = 'fp32'
     params.pid = os.getpid()
 
     for arg in vars(params):
@@ -112,7 +126,6 @@ def main():
         load_word2vec()
 
     from train_scoring import active_train
-    opt.n_average = 10
     active_train(model)
 
 if __name__ == "__main__":
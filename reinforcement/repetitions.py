@@ -0,0 +1,72 @@
+import multiprocessing
+import os
+import random
+
+import numpy as np
+import torch
+
+from logger import RecordingLogger
+
+# Set before the workers are forked, so they inherit them
+_run = None
+_seeds = None
+
+
+def share_arrays(arrays, directory):
+    """Read-only memory maps of `arrays`, saved to `directory`, which
+    forked workers share instead of each holding a copy
+    """
+    shared = []
+    for i, array in enumerate(arrays):
+        path = os.path.join(directory, '{}.npy'.format(i))
+        np.save(path, np.asarray(array))
+        shared.append(np.load(path, mmap_mode='r'))
+    return shared
+
+
+def run_repetitions(run, n, lg, workers=1, threads=None, initializer=None, initargs=(), on_result=None):
+    """Returns [run(j, lg) for j in range(n)], calling on_result(j, result)
+    after every repetition in order.
+    With `workers` > 1 the repetitions run in a pool of forked processes,
+    each pinned to `threads` torch threads (default: an equal share of
+    the cpus), set up by initializer(*initargs) and seeded per
+    repetition. Workers log to a RecordingLogger whose calls are replayed
+    on `lg` in repetition order.
+    """
+    global _run, _seeds
+    results = []
+    if workers <= 1 or n <= 1:
+        for j in range(n):
+            results.append(run(j, lg))
+            if on_result is not None:
+                on_result(j, results[-1])
+        return results
+
+    if threads is None:
+        threads = max(1, multiprocessing.cpu_count() // workers)
+    _run = run
+    _seeds = [random.randrange(2 ** 31) for j in range(n)]
+    context = multiprocessing.get_context('fork')
+    with context.Pool(min(workers, n), _init_worker, (threads, initializer, initargs)) as pool:
+        for j, (result, calls) in enumerate(pool.imap(_run_worker, range(n))):
+            if lg is not None:
+                RecordingLogger(calls).replay(lg)
+            results.append(result)
+            if on_result is not None:
+                on_result(j, result)
+    return results
+
+
+def _init_worker(threads, initializer, initargs):
+    torch.set_num_threads(threads)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _run_worker(j):
+    random.seed(_seeds[j])
+    np.random.seed(_seeds[j])
+    torch.manual_seed(_seeds[j])
+    lg = RecordingLogger()
+    result = _run(j, lg)
+    return result, lg.calls
@@ -0,0 +1,68 @@
+import torch
+
+DTYPES = ('float32', 'float16', 'int8')
+
+
+class StateStore(object):
+    """Row-indexable float matrix kept in a compact cpu representation:
+    float32, float16, or int8 with a per-feature offset and scale. Rows
+    are dequantized to float32 on read. The storage is moved to shared
+    memory, so worker processes map it instead of holding their own copy.
+    """
+
+    def __init__(self, values, dtype='float32', chunk_size=4096):
+        values = values.detach().float().cpu()
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.offset = self.scale = None
+        if dtype == 'int8':
+            low = values.min(dim=0)[0]
+            scale = (values.max(dim=0)[0] - low) / 255
+            scale[scale == 0] = 1
+            quantized = torch.round((values - low) / scale) - 128
+            self.values = quantized.to(torch.int8)
+            self.offset = (low + 128 * scale).share_memory_()
+            self.scale = scale.share_memory_()
+        elif dtype == 'float16':
+            self.values = values.half()
+        else:
+            self.values = values
+        self.values.share_memory_()
+
+    def __len__(self):
+        return len(self.values)
+
+    def size(self, dim=None):
+        return self.values.size() if dim is None else self.values.size(dim)
+
+    def __getitem__(self, index):
+        return self.dequantize(self.values[index])
+
+    def dequantize(self, values):
+        values = values.float()
+        if self.scale is not None:
+            values = values * self.scale + self.offset
+        return values
+
+    def chunks(self):
+        """Yields (start, rows) of dequantized chunks of `chunk_size` rows"""
+        for start in range(0, len(self.values), self.chunk_size):
+            yield start, self[start:start + self.chunk_size]
+
+    def distances(self, x):
+        """Squared euclidean distances (len(x), len(self)) of the rows of `x`
+        to every stored row, dequantizing one chunk at a time
+        """
+        x = x.float().cpu()
+        x_norm = (x ** 2).sum(1).view(-1, 1)
+        dist = torch.empty(len(x), len(self.values))
+        for start, rows in self.chunks():
+            rows_norm = (rows ** 2).sum(1).view(1, -1)
+            chunk = x_norm + rows_norm - 2.0 * torch.mm(x, rows.t())
+            dist[:, start:start + len(rows)] = torch.clamp(chunk, 0.0, float('inf'))
+        return dist
+
+
+def compact_indices(indices):
+    """int32 cpu copy of an index tensor, in shared memory"""
+    return indices.to(torch.int32).cpu().share_memory_()
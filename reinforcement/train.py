@@ -70,6 +70,8 @@ def train(classifier):
         metrics = timer(model.performance_validate, (data["dev"],))
 
         lg.dict_scalar_summary('episode-validation', metrics, episode)
+        if opt.inference_compare and hasattr(model, 'compare_precision'):
+            lg.dict_scalar_summary('inference-precision', model.compare_precision(data["dev"]), episode)
         lg.scalar_summary('episode-cum-reward', cum_reward, episode)
         lg.scalar_summary('performance', game.performance, episode)
         lg.scalar_summary('number-of-0-actions', num_of_zero, episode)
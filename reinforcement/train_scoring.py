@@ -1,12 +1,15 @@
 import os
 import random
-import copy
+import shutil
+import tempfile
 import torch
 import itertools
 import numpy as np
 from game import Game
 from agents import DQNAgent, DQNTargetAgent, PolicyAgent, ActorCriticAgent, RandomAgent
 from config import data, opt, loaders, global_logger
+from repetitions import run_repetitions, share_arrays
+from state_store import compact_indices
 from utils import save_model, timer, load_external_model, average_vector, save_VSE_model,get_full_VSE_model, pairwise_distances
 
 
@@ -21,48 +24,11 @@ def active_train(classifier):
     n_rounds = 20
     avg_scores = [{} for i in range(n_rounds)]
 
-    for avg_i in range(opt.n_average):
-        # Start with all the data, reset active set
-        data["train_deleted"] = copy.deepcopy(data["train"])
-        data["active"] = tuple(([] for i in range(len(data["train"]))))
-
-        # Init validation
-        model.reset()
-        indices = random_scorefn(model, opt.init_samples)
-        for idx in indices:
-            model.add_index(idx)
-        # Delete the data from train_deleted
-        new_data = [*data["train_deleted"]]
-        for i, d in enumerate(new_data):
-            new_data[i] = np.delete(new_data[i], indices, axis=0)
-        data["train_deleted"] = new_data
-        model.train(data["active"])
-
-        metrics = model.validate(data["dev"])
-        for key in metrics:
-            if key in avg_scores[0]:
-                avg_scores[0][key].append(metrics[key])
-            else:
-                avg_scores[0][key] = [metrics[key]]
-
-        for rnd in range(1, n_rounds):
-
-            # Get and add indices according to scorefn
-            indices = scorefn(model, opt.selection_radius)
-            for idx in indices:
-                model.add_index(idx)
-            # Delete the data from train_deleted
-            new_data = [*data["train_deleted"]]
-            for i, d in enumerate(new_data):
-                new_data[i] = np.delete(new_data[i], indices, axis=0)
-            data["train_deleted"] = new_data
-
-            # Reset and train model
-            model.reset()
-            timer(model.train_model, (data["active"], opt.num_epochs))
-            metrics = model.validate(data["dev"])
-            lg.dict_scalar_summary('last_episode_validation', metrics, rnd-1)
+    def run(avg_i, lg):
+        return active_train_repetition(model, scorefn, n_rounds, lg)
 
+    def log_averages(avg_i, rounds):
+        for rnd, metrics in enumerate(rounds):
             for key in metrics:
                 if key in avg_scores[rnd]:
                     avg_scores[rnd][key].append(metrics[key])
@@ -75,6 +41,74 @@ def active_train(classifier):
                 avg = sum(round_metric[key]) / len(round_metric[key])
                 lg.scalar_summary(tag, avg, id*5*32)
 
+    workers = opt.get('average_workers', 1)
+    if workers > 1 and opt.cuda:
+        print("Running the repetitions sequentially on cuda")
+        workers = 1
+
+    if workers > 1:
+        # The workers map the train split from disk instead of copying it
+        shared_dir = tempfile.mkdtemp()
+        try:
+            shared = share_arrays(data["train"], shared_dir)
+            run_repetitions(run, opt.n_average, lg, workers,
+                            initializer=use_shared_train, initargs=(shared,), on_result=log_averages)
+        finally:
+            shutil.rmtree(shared_dir)
+    else:
+        run_repetitions(run, opt.n_average, lg, on_result=log_averages)
+
+
+def use_shared_train(shared):
+    data["train"] = tuple(shared)
+
+
+def active_train_repetition(model, scorefn, n_rounds, lg):
+    """ One active learning run from `opt.init_samples` random samples. Returns the validation metrics of every round """
+    rounds = []
+
+    # Start with all the data, reset active set. Selected rows are deleted
+    # into new arrays, data["train"] itself is never modified
+    data["train_deleted"] = list(data["train"])
+    data["active"] = tuple(([] for i in range(len(data["train"]))))
+
+    # Init validation
+    model.reset()
+    indices = random_scorefn(model, opt.init_samples)
+    for idx in indices:
+        model.add_index(idx)
+    # Delete the data from train_deleted
+    new_data = [*data["train_deleted"]]
+    for i, d in enumerate(new_data):
+        new_data[i] = np.delete(new_data[i], indices, axis=0)
+    data["train_deleted"] = new_data
+    model.train(data["active"])
+
+    rounds.append(model.validate(data["dev"]))
+
+    for rnd in range(1, n_rounds):
+
+        # Get and add indices according to scorefn
+        indices = scorefn(model, opt.selection_radius)
+        for idx in indices:
+            model.add_index(idx)
+        # Delete the data from train_deleted
+        new_data = [*data["train_deleted"]]
+        for i, d in enumerate(new_data):
+            new_data[i] = np.delete(new_data[i], indices, axis=0)
+        data["train_deleted"] = new_data
+
+        # Reset and train model
+        model.reset()
+        timer(model.train_model, (data["active"], opt.num_epochs))
+        metrics = model.validate(data["dev"])
+        lg.dict_scalar_summary('last_episode_validation', metrics, rnd-1)
+        if opt.inference_compare and hasattr(model, 'compare_precision'):
+            lg.dict_scalar_summary('inference-precision', model.compare_precision(data["dev"]), rnd-1)
+
+        rounds.append(metrics)
+    return rounds
+
 
 def random_scorefn(model, n_samples=32):
     dataset = data["train_deleted"]
@@ -93,7 +127,7 @@ def intra_scorefn(model, n_samples=32):
     topk = torch.topk(image_caption_distances, opt.topk, 1, largest=False)
     (image_caption_distances_topk, image_caption_distances_topk_idx) = (topk[0], topk[1])
     # data["image_caption_distances_topk"] = image_caption_distances_topk
-    data["image_caption_distances_topk_idx"] = image_caption_distances_topk_idx
+    data["image_caption_distances_topk_idx"] = compact_indices(image_caption_distances_topk_idx)
     del topk
     del image_caption_distances
     intra_cap_distance = timer(pairwise_distances, (cap_embs, cap_embs))
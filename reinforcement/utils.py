@@ -17,8 +17,8 @@ import plotly.graph_objs as go
 from datetime import datetime
 from scipy import spatial
 from plotly.graph_objs import Scatter, Layout
-from gensim.models.keyedvectors import KeyedVectors
 
+from embedding_cache import load_embeddings
 from logger import LocalLogger, ExternalLogger, NoLogger, VisdomLogger
 from config import opt, data
 
@@ -156,33 +156,13 @@ def logAreaGraph(distribution, classes, name):
 
 
 def load_word2vec():
-    print("loading word2vec...")
-    word_vectors = KeyedVectors.load_word2vec_format(
-        "{}/GoogleNews-vectors-negative300.bin".format(opt.data_path), binary=True)
-    wv_matrix = []
-
+    w2v_path = '{}/GoogleNews-vectors-negative300.bin'.format(opt.data_path)
     if opt.dataset == 'vse':
-        for idx in sorted(dict.keys(opt.vocab.idx2word)):
-            word = opt.vocab.idx2word[idx]
-            if word in word_vectors.vocab:
-                wv_matrix.append(word_vectors.word_vec(word))
-            else:
-                wv_matrix.append(
-                    np.random.uniform(-0.01, 0.01, 300).astype("float32"))
-
+        words = [opt.vocab.idx2word[idx] for idx in sorted(dict.keys(opt.vocab.idx2word))]
+        data["w2v"] = load_embeddings(words, w2v_path, special_rows=False)
     else:
-        for word in data.vocab:
-            if word in word_vectors.vocab:
-                wv_matrix.append(word_vectors.word_vec(word))
-            else:
-                wv_matrix.append(
-                    np.random.uniform(-0.01, 0.01, 300).astype("float32"))
-
-        # one for UNK and one for zero padding
-        wv_matrix.append(np.random.uniform(-0.01, 0.01, 300).astype("float32"))
-        wv_matrix.append(np.zeros(300).astype("float32"))
-    wv_matrix = np.array(wv_matrix)
-    data["w2v"] = wv_matrix
+        # one row for UNK and one for zero padding
+        data["w2v"] = load_embeddings(data.vocab, w2v_path)
 
 def average_vector(data):
     tot_vector = np.zeros(len(data[0]), dtype="float64") #TODO: change size to something better than data[0]
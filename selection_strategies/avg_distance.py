@@ -1,55 +1,42 @@
 from pprint import pprint
 import utils
-from gensim.models.keyedvectors import KeyedVectors
+import embedding_cache
 import numpy as np
 
-from scipy import spatial
-
-num_features = 300
+from scipy import sparse
 
 
 def average_distance_per_category(features, targets, classes):
-    print("Loading w2v")
-    w2v = KeyedVectors.load_word2vec_format("GoogleNews-vectors-negative300.bin", binary=True)
-
+    vocab = sorted(set(w for sentence in features for w in sentence))
+    word_to_idx = {w: i for i, w in enumerate(vocab)}
+    wv_matrix = embedding_cache.load_embeddings(vocab, "GoogleNews-vectors-negative300.bin", special_rows=False)
 
     print("Calculating")
-    tuples = list(zip(features, targets))
-    avg_similarity = {}
-
-    for c in classes:
-        features = [tup[0] for tup in tuples if tup[1] == c]
-        feature_vector = np.zeros((num_features, ), dtype="float32")
-
-        sentence_vectors = []
-
-        for sentence in features:
-            sentence_vector = average_feature_vector(sentence, w2v)
-            sentence_vectors.append(sentence_vector)
-            feature_vector = np.add(feature_vector, sentence_vector)
-
-        feature_vector = np.divide(feature_vector, len(features))
-
-        total_similarity = 0
-        for sentence_vector in sentence_vectors:
-            total_similarity += 1 - spatial.distance.cosine(feature_vector, sentence_vector)
-
-        avg_similarity[c] = total_similarity / len(sentence_vectors)
-    return avg_similarity
-
-def average_feature_vector(sentence, embedding):
-
-    feature_vector = np.zeros((num_features, ), dtype="float32")
 
-    for word in sentence:
-        if word in embedding.vocab:
-            word_vector = embedding.word_vec(word)
-        else:
-            word_vector = np.random.uniform(-0.01, 0.01, num_features).astype("float32")
-        feature_vector = np.add(feature_vector, word_vector)
+    lengths = np.array([len(sentence) for sentence in features])
+    ids = np.zeros((len(features), lengths.max()), dtype=np.int64)
+    for i, sentence in enumerate(features):
+        ids[i, :len(sentence)] = [word_to_idx[w] for w in sentence]
+    sentence_vectors = utils.sentence_embeddings(ids, lengths, wv_matrix)
+
+    # (classes, sentences) averaging matrix, so all centroids are one product
+    class_index = {c: i for i, c in enumerate(classes)}
+    labels = np.array([class_index[t] for t in targets])
+    members = sparse.csr_matrix(
+        (np.ones(len(targets)), (labels, np.arange(len(targets)))),
+        shape=(len(classes), len(targets)))
+    counts = np.asarray(members.sum(axis=1)).ravel()
+    averaging = sparse.diags(1.0 / counts).dot(members)
+    centroids = averaging.dot(sentence_vectors)
+
+    sentence_vectors = sentence_vectors / np.linalg.norm(sentence_vectors, axis=1, keepdims=True)
+    centroids = centroids / np.linalg.norm(centroids, axis=1, keepdims=True)
+    # cosine similarity of every sentence to the centroid of its class
+    similarities = np.sum(sentence_vectors * centroids[labels], axis=1)
+    avg_similarity = averaging.dot(similarities)
+
+    return {c: avg_similarity[class_index[c]] for c in classes}
 
-    feature_vector = np.divide(feature_vector, len(sentence))
-    return feature_vector
 
 data = utils.read_TREC()
 avg_dist = average_distance_per_category(data["train_x"], data["train_y"], sorted(list(set(data["train_y"]))))
@@ -0,0 +1,139 @@
+"""CPU timings of the text CNN over the (WORD_DIM, sentence length) layout
+against the former convolutions over the flattened 1 x (WORD_DIM *
+MAX_SENT_LEN) sentence, for training and for scoring the unlabeled pool.
+Also checks that legacy weights loaded through CNN.load_state_dict give
+the same outputs.
+
+    python benchmark_cnn.py --pool 10000 --threads 4
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+from torch.autograd import Variable
+
+from config import params
+
+
+def parse_params():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab_size", default=20000, type=int)
+    parser.add_argument("--max_sent_len", default=59, type=int)
+    parser.add_argument("--pool", default=10000, type=int,
+                        help="Number of pool sentences to score.")
+    parser.add_argument("--batch_size", default=50, type=int,
+                        help="Training batch size.")
+    parser.add_argument("--inference_batch_size", default=1024, type=int)
+    parser.add_argument("--repeats", default=3, type=int)
+    parser.add_argument("--threads", default=0, type=int,
+                        help="torch threads (default: torch's choice)")
+    options = parser.parse_args()
+
+    params.update({
+        "BATCH_SIZE": options.batch_size,
+        "SELECTION_SIZE": options.batch_size,
+        "MAX_SENT_LEN": options.max_sent_len,
+        "WORD_DIM": 300,
+        "VOCAB_SIZE": options.vocab_size,
+        "CLASS_SIZE": 2,
+        "FILTERS": [3, 4, 5],
+        "FILTER_NUM": [100, 100, 100],
+        "DROPOUT_EMBED": 0.2,
+        "DROPOUT_MODEL": 0.4,
+        "EMBEDDING": "random",
+        "CUDA": False,
+    })
+    return options
+
+
+def legacy_model():
+    from models.cnn import CNN
+
+    class LegacyCNN(CNN):
+        """The former convolutions over the flattened sentence"""
+
+        def init_model(self):
+            super(LegacyCNN, self).init_model()
+            for i in range(len(self.FILTERS)):
+                conv = nn.Conv1d(
+                    1, self.FILTER_NUM[i], self.WORD_DIM * self.FILTERS[i], stride=self.WORD_DIM)
+                setattr(self, 'conv_{}'.format(i), conv)
+
+        def forward(self, inp):
+            x = self.embed(inp).view(-1, 1, self.WORD_DIM * self.MAX_SENT_LEN)
+            x = self.dropout_embed(x)
+            conv_results = [
+                F.max_pool1d(F.relu(self.get_conv(i)(x)),
+                             self.MAX_SENT_LEN - self.FILTERS[i] + 1).view(-1, self.FILTER_NUM[i])
+                for i in range(len(self.FILTERS))]
+            x = torch.cat(conv_results, 1)
+            x = self.dropout(x)
+            return self.fc(x)
+
+    return LegacyCNN()
+
+
+def score_pool(model, pool, batch_size):
+    model.eval()
+    for i in range(0, len(pool), batch_size):
+        nn.functional.softmax(model(Variable(pool[i:i + batch_size], volatile=True)), dim=1)
+
+
+def train_epoch(model, features, targets, batch_size):
+    model.train()
+    optimizer = optim.Adadelta(model.parameters(), 0.1)
+    criterion = nn.CrossEntropyLoss()
+    for i in range(0, len(features), batch_size):
+        optimizer.zero_grad()
+        loss = criterion(model(Variable(features[i:i + batch_size])), Variable(targets[i:i + batch_size]))
+        loss.backward()
+        optimizer.step()
+
+
+def best_time(func, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    options = parse_params()
+    if options.threads:
+        torch.set_num_threads(options.threads)
+    from models.cnn import CNN
+
+    rng = np.random.RandomState(0)
+    lengths = rng.randint(5, options.max_sent_len + 1, options.pool)
+    pool = np.full((options.pool, options.max_sent_len), options.vocab_size + 1, dtype=np.int64)
+    for i, length in enumerate(lengths):
+        pool[i, :length] = rng.randint(0, options.vocab_size, length)
+    pool = torch.from_numpy(pool)
+    targets = torch.from_numpy(rng.randint(0, 2, options.pool))
+
+    legacy = legacy_model()
+    model = CNN()
+    model.load_state_dict(legacy.state_dict())
+    legacy.eval()
+    model.eval()
+    sample = Variable(pool[:1000], volatile=True)
+    diff = (legacy(sample) - model(sample)).abs().max().data[0]
+    print("max abs difference after loading legacy weights: {:.2e}".format(diff))
+
+    print("{:>8} {:>16} {:>16}".format("", "pool scoring", "train epoch"))
+    n_train = min(500, options.pool)
+    for name, m in (("legacy", legacy), ("conv1d", model)):
+        scoring = best_time(lambda: score_pool(m, pool, options.inference_batch_size), options.repeats)
+        training = best_time(lambda: train_epoch(m, pool[:n_train], targets[:n_train], options.batch_size),
+                             options.repeats)
+        print("{:>8} {:>14.3f} s {:>14.3f} s".format(name, scoring, training))
+
+
+if __name__ == "__main__":
+    main()
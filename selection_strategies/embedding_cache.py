@@ -0,0 +1,71 @@
+import hashlib
+import os
+import tempfile
+import time
+import zlib
+
+import numpy as np
+
+WORD_DIM = 300
+
+
+def vocab_hash(words, special_rows):
+    """Short hash identifying the rows of a cached matrix"""
+    digest = hashlib.sha1("\n".join(words).encode("utf-8"))
+    digest.update(b"special" if special_rows else b"plain")
+    return digest.hexdigest()[:16]
+
+
+def seeded_vector(word, dim=WORD_DIM):
+    """Random vector for a word missing from word2vec, seeded by the word
+    itself so every run and every entry point gets the same one
+    """
+    rng = np.random.RandomState(zlib.crc32(word.encode("utf-8")) & 0xffffffff)
+    return rng.uniform(-0.01, 0.01, dim).astype("float32")
+
+
+def build_matrix(words, w2v_path, special_rows):
+    from gensim.models.keyedvectors import KeyedVectors
+
+    print("loading word2vec...")
+    t0 = time.time()
+    word_vectors = KeyedVectors.load_word2vec_format(w2v_path, binary=True)
+    print("It took {} to load w2v".format(time.time() - t0))
+
+    n_rows = len(words) + 2 if special_rows else len(words)
+    wv_matrix = np.zeros((n_rows, WORD_DIM), dtype="float32")
+    for i, word in enumerate(words):
+        if word in word_vectors.vocab:
+            wv_matrix[i] = word_vectors.word_vec(word)
+        else:
+            wv_matrix[i] = seeded_vector(word)
+
+    if special_rows:
+        # one for UNK, the last one (zero padding) stays zero
+        wv_matrix[len(words)] = seeded_vector("<unk>")
+    return wv_matrix
+
+
+def load_embeddings(words, w2v_path, special_rows=True, cache_dir=None):
+    """word2vec matrix for `words`, in order, followed by an UNK and a zero
+    padding row if `special_rows`. The matrix is extracted from `w2v_path`
+    once and saved as a .npy keyed by the vocabulary hash in `cache_dir`
+    (default: next to `w2v_path`). Later runs memory-map the cached file
+    copy-on-write instead of loading word2vec.
+    """
+    words = list(words)
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(w2v_path))
+    path = os.path.join(cache_dir, "w2v_{}.npy".format(vocab_hash(words, special_rows)))
+    if os.path.isfile(path):
+        return np.load(path, mmap_mode="c")
+
+    wv_matrix = build_matrix(words, w2v_path, special_rows)
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".npy")
+    with os.fdopen(fd, "wb") as f:
+        np.save(f, wv_matrix)
+    os.rename(tmp_path, path)
+    return np.load(path, mmap_mode="c")
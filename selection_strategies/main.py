@@ -34,6 +34,8 @@ def main():
                         help='batch size for training [default: 32]')
     parser.add_argument('--selection-size', type=int, default=32,
                         help='selection size for selection function [default: 32]')
+    parser.add_argument('--inference-batch-size', type=int, default=1024,
+                        help='batch size for scoring the unlabeled pool [default: 1024]')
     parser.add_argument("--save_model", default="F",
                         help="whether saving model or not (T/F)")
     parser.add_argument("--early_stopping", default="F",
@@ -51,9 +53,11 @@ def main():
     parser.add_argument('--no-cuda', action='store_true',
                         default=False, help='disable the gpu')
     parser.add_argument("--scorefn", default="entropy",
-                        help="available scoring functions: entropy, random, egl")
+                        help="available scoring functions: entropy, margin, least_confidence, random, egl")
     parser.add_argument('--average', type=int, default=1,
                         help='Number of runs to average [default: 1]')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes running the averaged runs in parallel (cpu only) [default: 1]')
     parser.add_argument('--hnodes', type=int, default=256,
                         help='Number of nodes in the hidden layer(s)')
     parser.add_argument('--hlayers', type=int, default=1,
@@ -92,6 +96,7 @@ def main():
                              + data["dev_x"] + data["test_x"]]),
         "SELECTION_SIZE": options.selection_size,
         "BATCH_SIZE": options.batch_size,
+        "INFERENCE_BATCH_SIZE": options.inference_batch_size,
         "WORD_DIM": 300,
         "VOCAB_SIZE": len(data["vocab"]),
         "CLASS_SIZE": len(data["classes"]),
@@ -103,6 +108,7 @@ def main():
         "NO_CUDA": options.no_cuda,
         "SCORE_FN": options.scorefn,
         "N_AVERAGE": options.average,
+        "WORKERS": options.workers,
         "HIDDEN_SIZE": options.hnodes,
         "HIDDEN_LAYERS": options.hlayers,
         "WEIGHT_DECAY": options.weight_decay,
@@ -115,6 +121,8 @@ def main():
     for key in params_local:
         params[key] = params_local[key]
 
+    utils.encode_data()
+
     if params["LOG"]:
         logger_name = 'SS/{}_{}_{}_{}_{}'.format(getpass.getuser(), datetime.datetime.now().strftime("%d-%m-%y_%H:%M"), options.dataset, params["C"], str(uuid.uuid4())[:4])
         global_logger["lg"] = VisdomLogger(logger_name, "{}_{}".format(params["SIMILARITY_THRESHOLD"], params["SIMILARITY_REPRESENTATION"]))
@@ -148,6 +156,9 @@ def main():
         encoder, decoder, feature_extractor = encoder.cuda(), decoder.cuda(), feature_extractor.cuda()
 
     models["ENCODER"] = encoder
+    if params["SIMILARITY_REPRESENTATION"] == "AUTOENCODER":
+        # The encoder is fixed, so the pool is encoded once for every clean()
+        data["pool_encoded"] = encoder.encode(data["train_ids"], data["train_lengths"])
     models["DECODER"] = decoder
     models["FEATURE_EXTRACTOR"] = feature_extractor
 
@@ -4,6 +4,7 @@ from torch import nn, FloatTensor
 from torch.autograd import Variable
 
 from config import params, data
+import utils
 
 class AE(nn.Module):
     def __init__(self):
@@ -35,20 +36,10 @@ def train(model):
     criterion = nn.MSELoss()
 
     for epoch in range(params["EPOCH"]):
-        for i in range(0, len(data["train_x"]), params["BATCH_SIZE"]):
-            batch_range = min(params["BATCH_SIZE"], len(data["train_x"]) - i)
-
-            batch_x = [[data["word_to_idx"][w] for w in sent] +
-                       [params["VOCAB_SIZE"] + 1] *
-                       (params["MAX_SENT_LEN"] - len(sent))
-                       for sent in data["train_x"][i:i + batch_range]]
-
+        for i in range(0, len(data["train_ids"]), params["BATCH_SIZE"]):
             model.train()
 
-            feature = Variable(FloatTensor(batch_x))
-
-            if params["CUDA"]:
-                feature = feature.cuda()
+            feature = utils.batch_variable(data["train_ids"][i:i + params["BATCH_SIZE"]]).float()
             output = model(feature)
             loss = criterion(output, feature)
 
@@ -56,4 +47,4 @@ def train(model):
             loss.backward()
             optimizer.step()
 
-        print('epoch [{}/{}], loss:{:.4f}'.format(epoch, params["EPOCH"], loss.data[0] / len(batch_x)))
+        print('epoch [{}/{}], loss:{:.4f}'.format(epoch, params["EPOCH"], loss.data[0] / len(feature)))
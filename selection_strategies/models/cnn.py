@@ -8,6 +8,24 @@ from gensim.models.keyedvectors import KeyedVectors
 from config import params, data, w2v
 
 
+def legacy_conv_weight(weight, word_dim):
+    """Weight of a convolution over the flattened 1 x (WORD_DIM * MAX_SENT_LEN)
+    sentence, as in older checkpoints, converted to the same filters over the
+    (WORD_DIM, sentence length) layout
+    """
+    n_filters = weight.size(0)
+    return weight.view(n_filters, -1, word_dim).transpose(1, 2).contiguous()
+
+
+def convert_legacy_state(state_dict, word_dim):
+    """Copy of `state_dict` with any legacy convolution weights converted"""
+    converted = state_dict.copy()
+    for key, value in state_dict.items():
+        if key.startswith("conv_") and key.endswith(".weight") and value.dim() == 3 and value.size(1) == 1:
+            converted[key] = legacy_conv_weight(value, word_dim)
+    return converted
+
+
 class CNN(nn.Module):
     def __init__(self):
         super(CNN, self).__init__()
@@ -23,7 +41,6 @@ class CNN(nn.Module):
         self.FILTER_NUM = params["FILTER_NUM"]
         self.DROPOUT_EMBED_PROB = params["DROPOUT_EMBED"]
         self.DROPOUT_MODEL_PROB = params["DROPOUT_MODEL"]
-        self.IN_CHANNEL = 1
         self.EMBEDDING = params["EMBEDDING"]
 
         # one for UNK and one for zero padding
@@ -38,6 +55,9 @@ class CNN(nn.Module):
     def get_conv(self, i):
         return getattr(self, 'conv_{}'.format(i))
 
+    def load_state_dict(self, state_dict, strict=True):
+        return super(CNN, self).load_state_dict(convert_legacy_state(state_dict, self.WORD_DIM), strict)
+
     def init_model(self):
         self.embed = nn.Embedding(
             self.NUM_EMBEDDINGS, self.WORD_DIM, padding_idx=self.VOCAB_SIZE + 1)
@@ -46,8 +66,7 @@ class CNN(nn.Module):
             self.embed.weight.data.copy_(torch.from_numpy(self.wv_matrix))
 
         for i in range(len(self.FILTERS)):
-            conv = nn.Conv1d(
-                self.IN_CHANNEL, self.FILTER_NUM[i], self.WORD_DIM * self.FILTERS[i], stride=self.WORD_DIM)
+            conv = nn.Conv1d(self.WORD_DIM, self.FILTER_NUM[i], self.FILTERS[i])
             setattr(self, 'conv_{}'.format(i), conv)
 
         self.fc = nn.Linear(sum(self.FILTER_NUM), self.CLASS_SIZE)
@@ -60,13 +79,12 @@ class CNN(nn.Module):
 
     def forward(self, inp):
         # inp = (25 x 59) - (mini_batch_size x sentence_length)
-        x = self.embed(inp).view(-1, 1, self.WORD_DIM * self.MAX_SENT_LEN)
+        x = self.embed(inp.view(-1, inp.size(-1))).transpose(1, 2).contiguous()
         x = self.dropout_embed(x)
-        # x = (25 x 1 x 17700) - mini_batch_size x embedding_for_each_sentence
+        # x = (25 x 300 x 59) - mini_batch_size x word_dim x sentence_length
 
         conv_results = [
-            F.max_pool1d(F.relu(self.get_conv(i)(x)),
-                         self.MAX_SENT_LEN - self.FILTERS[i] + 1).view(-1, self.FILTER_NUM[i])
+            torch.max(F.relu(self.get_conv(i)(x)), 2)[0]
             for i in range(len(self.FILTERS))]
         # Take a max for each filter - each filter result is 25 x 100 x 57
 
@@ -79,13 +97,12 @@ class CNN(nn.Module):
         return x
 
     def get_sentence_representation(self, inp):
-        x = self.embed(inp).view(-1, 1, self.WORD_DIM * self.MAX_SENT_LEN)
+        x = self.embed(inp.view(-1, inp.size(-1))).transpose(1, 2).contiguous()
         # x = self.dropout_embed(x)
-        # x = (25 x 1 x 17700) - mini_batch_size x embedding_for_each_sentence
+        # x = (25 x 300 x 59) - mini_batch_size x word_dim x sentence_length
 
         conv_results = [
-            F.max_pool1d(F.relu(self.get_conv(i)(x)),
-                         self.MAX_SENT_LEN - self.FILTERS[i] + 1).view(-1, self.FILTER_NUM[i])
+            torch.max(F.relu(self.get_conv(i)(x)), 2)[0]
             for i in range(len(self.FILTERS))]
         # Take a max for each filter - each filter result is 25 x 100 x 57
 
@@ -5,6 +5,7 @@ import numpy as np
 
 from gensim.models.keyedvectors import KeyedVectors
 from config import params, data, w2v
+from models.cnn import convert_legacy_state
 # from config import para
 
 
@@ -20,7 +21,6 @@ class CNN2(nn.Module):
         self.DROPOUT_EMBED_PROB = params["DROPOUT_EMBED"]
         self.DROPOUT_MODEL_PROB = params["DROPOUT_MODEL"]
         self.EMBEDDING = params["EMBEDDING"]
-        self.IN_CHANNEL = 1
 
         self.data = data
 
@@ -36,6 +36,9 @@ class CNN2(nn.Module):
     def get_conv(self, i):
         return getattr(self, 'conv_{}'.format(i))
 
+    def load_state_dict(self, state_dict, strict=True):
+        return super(CNN2, self).load_state_dict(convert_legacy_state(state_dict, self.WORD_DIM), strict)
+
 
     def init_model(self):
         self.embed = nn.Embedding(
@@ -45,8 +48,7 @@ class CNN2(nn.Module):
             self.embed.weight.data.copy_(torch.from_numpy(self.wv_matrix))
 
         for i in range(len(self.FILTERS)):
-            conv = nn.Conv1d(
-                self.IN_CHANNEL, self.FILTER_NUM[i], self.WORD_DIM * self.FILTERS[i], stride=self.WORD_DIM)
+            conv = nn.Conv1d(self.WORD_DIM, self.FILTER_NUM[i], self.FILTERS[i])
             setattr(self, 'conv_{}'.format(i), conv)
 
         self.softmax = nn.Softmax()
@@ -59,14 +61,12 @@ class CNN2(nn.Module):
     def forward(self, inp):
         # inp = (25 x 59) - (mini_batch_size x sentence_length)
         # print(inp)
-        x = self.embed(inp).view(-1, 1, self.WORD_DIM * self.MAX_SENT_LEN)
-        # x = self.embed(inp).view(1, self.WORD_DIM * self.MAX_SENT_LEN)
+        x = self.embed(inp.view(-1, inp.size(-1))).transpose(1, 2).contiguous()
         x = self.dropout_embed(x)
-        # x = (25 x 1 x 17700) - mini_batch_size x embedding_for_each_sentence
+        # x = (25 x 300 x 59) - mini_batch_size x word_dim x sentence_length
 
         conv_results = [
-            F.max_pool1d(F.relu(self.get_conv(i)(x)),
-                         self.MAX_SENT_LEN - self.FILTERS[i] + 1).view(-1, self.FILTER_NUM[i])
+            torch.max(F.relu(self.get_conv(i)(x)), 2)[0]
             for i in range(len(self.FILTERS))]
         # Take a max for each filter - each filter result is 25 x 100 x 57
 
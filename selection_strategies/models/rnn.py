@@ -3,7 +3,7 @@ import torch.nn as nn
 from torch.autograd import Variable
 import torch.nn.functional as F
 import numpy as np
-from gensim.models.keyedvectors import KeyedVectors
+import embedding_cache
 from config import params, data, w2v
 
 
@@ -85,20 +85,4 @@ class RNN(nn.Module):
     load word2vec pre trained vectors
     """
     def load_word2vec(self):
-        print("loading word2vec...")
-        word_vectors = KeyedVectors.load_word2vec_format(
-            "GoogleNews-vectors-negative300.bin", binary=True)
-
-        wv_matrix = []
-        for word in self.data["vocab"]:
-            if word in word_vectors.vocab:
-                wv_matrix.append(word_vectors.word_vec(word))
-            else:
-                wv_matrix.append(
-                    np.random.uniform(-0.01, 0.01, 300).astype("float32"))
-
-        # one for UNK and one for zero padding
-        wv_matrix.append(np.random.uniform(-0.01, 0.01, 300).astype("float32"))
-        wv_matrix.append(np.zeros(300).astype("float32"))
-        wv_matrix = np.array(wv_matrix)
-        return wv_matrix
+        return embedding_cache.load_embeddings(self.data["vocab"], "GoogleNews-vectors-negative300.bin")
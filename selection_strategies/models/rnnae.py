@@ -1,5 +1,6 @@
 
 import os
+import numpy as np
 import torch
 import torchvision
 import torch.optim as optim
@@ -9,6 +10,7 @@ from torch import nn
 from torch.autograd import Variable
 
 from config import params, data
+import utils
 
 class EncoderRNN(nn.Module):
     def __init__(self):
@@ -19,17 +21,40 @@ class EncoderRNN(nn.Module):
         self.gru = nn.GRU(self.hidden_size, self.hidden_size)
 
     def forward(self, input, batch_lengths):
-        # TODO this makes first sentence include hidden states for padding .
-        # find a fix for this 
-        batch_lengths[0] = params["MAX_SENT_LEN"]
         output = self.embedding(input)
 
         output = torch.nn.utils.rnn.pack_padded_sequence(output, batch_lengths)
         hidden = self.initHidden(input.size()[1])
         output, hidden = self.gru(output, hidden)
         output, output_lengths = nn.utils.rnn.pad_packed_sequence(output)
+        # The attention decoder expects MAX_SENT_LEN encoder outputs
+        padding = params["MAX_SENT_LEN"] - output.size(0)
+        if padding > 0:
+            zeros = output.data.new(padding, output.size(1), output.size(2)).zero_()
+            output = torch.cat([output, Variable(zeros)], 0)
         return output, hidden
 
+    def encode(self, ids, lengths):
+        """Final hidden state of every padded sentence in `ids`, as a
+        (len(ids), hidden_size) numpy array. The sentences are encoded
+        longest first in packed batches of INFERENCE_BATCH_SIZE, each
+        trimmed to its longest sentence.
+        """
+        batch_size = params["INFERENCE_BATCH_SIZE"]
+        # Stable, like sorting the sentences by length
+        order = np.argsort(-lengths, kind="mergesort")
+        states = np.zeros((len(ids), self.hidden_size), dtype=np.float32)
+
+        for i in range(0, len(order), batch_size):
+            batch = order[i:i + batch_size]
+            batch_lengths = lengths[batch].tolist()
+            feature = utils.batch_variable(ids[batch, :batch_lengths[0]], volatile=True).transpose(0, 1)
+
+            output = torch.nn.utils.rnn.pack_padded_sequence(self.embedding(feature), batch_lengths)
+            output, hidden = self.gru(output, self.initHidden(len(batch)))
+            states[batch] = hidden[-1].data.cpu().numpy()
+        return states
+
     def initHidden(self, batch_size):
         result = Variable(torch.zeros(1, batch_size, self.hidden_size))
         if params["CUDA"]:
@@ -103,23 +128,17 @@ def train(encoder, decoder):
     criterion = nn.NLLLoss()
 
     for epoch in range(params["EPOCH"]):
-        for i in range(0, len(data["train_x"]), params["BATCH_SIZE"]):
-            batch_range = min(params["BATCH_SIZE"], len(data["train_x"]) - i)
-
-            batch_x = [[data["word_to_idx"][w] for w in sent] for sent in data["train_x"][i:i + batch_range]]
-
-            batch_x_sorted = sorted(batch_x, key=lambda x: len(x), reverse=True)
-
-            batch_lengths = [len(sent) for sent in batch_x_sorted]
+        for i in range(0, len(data["train_ids"]), params["BATCH_SIZE"]):
+            batch_lengths = data["train_lengths"][i:i + params["BATCH_SIZE"]]
+            # Stable, like sorting the sentences by length
+            order = np.argsort(-batch_lengths, kind="mergesort")
+            batch_lengths = batch_lengths[order].tolist()
             # print(batch_lengths)
 
-            batch_x_padded = [sent +[params["VOCAB_SIZE"] + 1] * (params["MAX_SENT_LEN"] - len(sent)) for sent in batch_x_sorted]
-            feature = Variable(torch.LongTensor(batch_x_padded))
-            target = Variable(torch.LongTensor(batch_x_padded))
+            feature = utils.batch_variable(data["train_ids"][i:i + params["BATCH_SIZE"]][order])
+            target = feature
 
             feature, target = feature.transpose(0, 1), target.transpose(0, 1)
-            if params["CUDA"]:
-                feature, target = feature.cuda(), target.cuda()
 
 
             encoder_optimizer.zero_grad()
@@ -127,7 +146,7 @@ def train(encoder, decoder):
 
             encoder_outputs, encoder_hidden = encoder(feature, batch_lengths)
 
-            decoder_input = Variable(torch.LongTensor([params["VOCAB_SIZE"]] * len(batch_x)))
+            decoder_input = Variable(torch.LongTensor([params["VOCAB_SIZE"]] * len(batch_lengths)))
             if params["CUDA"]:
                 decoder_input = decoder_input.cuda()
 
@@ -146,7 +165,7 @@ def train(encoder, decoder):
             encoder_optimizer.step()
             decoder_optimizer.step()
 
-            print("{} of {}".format(i, len(data["train_x"])), end="\r")
+            print("{} of {}".format(i, len(data["train_ids"])), end="\r")
 
-        print('epoch [{}/{}], loss:{:.4f}'.format(epoch, params["EPOCH"], loss.data[0] / len(batch_x)))
+        print('epoch [{}/{}], loss:{:.4f}'.format(epoch, params["EPOCH"], loss.data[0] / len(batch_lengths)))
     print("Training finished")
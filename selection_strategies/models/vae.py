@@ -6,6 +6,7 @@ from torch.autograd import Variable
 from torch.nn import functional as F
 
 from config import params, data
+import utils
 
 class VAE(nn.Module):
     def __init__(self):
@@ -76,20 +77,11 @@ def loss_function(recon_x, x, mu, logvar):
 def train(model):
     optimizer = optim.Adam(model.parameters(), lr=1e-3)
     for epoch in range(params["EPOCH"]):
-        for i in range(0, len(data["train_x"]), params["BATCH_SIZE"]):
-            batch_range = min(params["BATCH_SIZE"], len(data["train_x"]) - i)
-
-            batch_x = [[data["word_to_idx"][w] for w in sent] +
-                       [params["VOCAB_SIZE"] + 1] *
-                       (params["MAX_SENT_LEN"] - len(sent))
-                       for sent in data["train_x"][i:i + batch_range]]
-
+        for i in range(0, len(data["train_ids"]), params["BATCH_SIZE"]):
             model.train()
             train_loss = 0
 
-            feature = Variable(torch.FloatTensor(batch_x))
-            if params["CUDA"]:
-                feature = feature.cuda()
+            feature = utils.batch_variable(data["train_ids"][i:i + params["BATCH_SIZE"]]).float()
 
             optimizer.zero_grad()
             recon_batch, mu, logvar = model(feature)
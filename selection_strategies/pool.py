@@ -0,0 +1,35 @@
+import numpy as np
+
+
+class Pool(object):
+    """Unlabeled pool over the encoded train split. The encoded arrays are
+    never modified: selected sentences are only masked out, and a new
+    repetition clears the mask instead of copying the pool.
+    """
+
+    def __init__(self, ids, lengths, labels):
+        self.ids = ids
+        self.lengths = lengths
+        self.labels = labels
+        self.available = np.ones(len(ids), dtype=bool)
+        self.order = np.arange(len(ids))
+
+    def __len__(self):
+        return int(self.available.sum())
+
+    def reset(self, shuffle=True):
+        """Makes every sentence available again, in a new random order"""
+        self.available[:] = True
+        if shuffle:
+            self.order = np.random.permutation(len(self.ids))
+        else:
+            self.order = np.arange(len(self.ids))
+
+    def indices(self):
+        """Indices of the available sentences, in pool order"""
+        return self.order[self.available[self.order]]
+
+    def take(self, indices):
+        """Masks out `indices` and returns their token ids and labels"""
+        self.available[indices] = False
+        return self.ids[indices], self.labels[indices]
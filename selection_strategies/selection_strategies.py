@@ -7,7 +7,6 @@ import torch
 import torch.optim as optim
 import torch.nn as nn
 from torch.autograd import Variable
-from scipy import spatial
 
 import utils
 import train
@@ -16,200 +15,168 @@ from config import params, data, w2v, models
 
 
 def select_all(model, lg, i):
-    ret_feature = []
-    ret_target = []
-
-    for i in range(0, len(data["train_x"]), params["BATCH_SIZE"]):
-        batch_range = min(params["BATCH_SIZE"], len(data["train_x"]) - i)
-
-        batch_x = [[data["word_to_idx"][w] for w in sent] +
-                   [params["VOCAB_SIZE"] + 1] *
-                   (params["MAX_SENT_LEN"] - len(sent))
-                   for sent in data["train_x"][i:i + batch_range]]
-        batch_y = [data["classes"].index(c)
-                   for c in data["train_y"][i:i + batch_range]]
-
-        ret_feature.extend(batch_x)
-        ret_target.extend(batch_y)
-
-    return ret_feature, ret_target
+    pool = data["pool"]
+    indices = pool.indices()
+    return pool.ids[indices], pool.labels[indices]
+
+
+def egl_scores(model, feature):
+    """Expected gradient length of every sentence in `feature`: the sum over
+    classes c of p(c) times the largest gradient norm of the loss for label
+    c w.r.t. the embedding of one of the sentence's words.
+    Sentences are independent in eval mode, so one backward pass per class
+    gives the gradients w.r.t. the embedding output of the whole batch.
+    Positions holding the same word are summed, as in the gradient of its
+    embedding row.
+    """
+    embedded = []
+    handle = model.embed.register_forward_hook(
+        lambda module, inp, out: embedded.append((inp[0], out)))
+    output = model(feature)
+    handle.remove()
+    # Output is not a probability distribution - make it using softmax
+    output = nn.functional.softmax(output, dim=1)
+    log_probs = nn.functional.log_softmax(output, dim=1)
+
+    tokens, embeds = embedded[0]
+    tokens = tokens.data
+    batch_first = tokens.size() == feature.size() and tokens.equal(feature.data)
+    if not batch_first:
+        tokens = tokens.t()
+    same_word = (tokens.unsqueeze(2) == tokens.unsqueeze(1)).float()
+    not_padding = (tokens != model.embed.padding_idx).float()
+
+    scores = 0
+    for index in range(len(data["classes"])):
+        loss = -log_probs[:, index].sum()
+        grads = torch.autograd.grad(loss, embeds, retain_graph=True)[0].data
+        if not batch_first:
+            grads = grads.transpose(0, 1)
+        word_grads = torch.bmm(same_word, grads.contiguous())
+        best_grad = (word_grads.norm(2, 2) * not_padding).max(1)[0]
+        scores += output.data[:, index] * best_grad
+    return scores
 
 
 def select_egl(model, lg, iteration):
     model.eval()
-    parameters = filter(lambda p: p.requires_grad, model.parameters())
-    optimizer = optim.Adadelta(parameters, params["LEARNING_RATE"])
-    criterion = nn.CrossEntropyLoss()
-
+    pool = data["pool"]
+    indices = pool.indices()
     completed = 0
     sample_scores = []
-    step = 0
-
-    for i in range(0, len(data["train_x"]), params["BATCH_SIZE"]):
-        batch_range = min(params["BATCH_SIZE"], len(data["train_x"]) - i)
-
-        batch_x = [[data["word_to_idx"][w] for w in sent] +
-                   [params["VOCAB_SIZE"] + 1] *
-                   (params["MAX_SENT_LEN"] - len(sent))
-                   for sent in data["train_x"][i:i + batch_range]]
-        batch_y = [data["classes"].index(c)
-                   for c in data["train_y"][i:i + batch_range]]
-
-        feature = Variable(torch.LongTensor(batch_x))
-        target = Variable(torch.LongTensor(batch_y))
-        if params["CUDA"]:
-            feature, target = feature.cuda(), target.cuda()
-
-        for s_index in range(batch_range):
-            score = 0
-            output = model(feature[s_index])
-            # Output is not a probability distribution - make it using softmax
-            output = nn.functional.softmax(output)
-
-            for index in range(len(data["classes"])):
-                optimizer.zero_grad()
-                f_target = torch.autograd.Variable(torch.LongTensor([index]))
-                if params["CUDA"]:
-                    f_target = f_target.cuda()
-
-                loss = criterion(output, f_target)
-                loss.backward(retain_graph=True)
-
-                best_grad = -999
-                for word in feature[s_index]:
-                    grad = model.embed.weight.grad[word.data[0]]
-                    grad_length = torch.norm(grad).data[0]
-                    best_grad = max(best_grad, grad_length)
 
-                score += output[0][index].data[0] * best_grad
-            sample_scores.append(score)
+    for i in range(0, len(indices), params["BATCH_SIZE"]):
+        feature = utils.batch_variable(pool.ids[indices[i:i + params["BATCH_SIZE"]]])
+        sample_scores.extend(egl_scores(model, feature).cpu().numpy().tolist())
 
         completed += 1
 
         print("Selection process: {0:.0f}% completed ".format(
-            100 * (completed / (len(data["train_x"]) // params["BATCH_SIZE"] + 1))), end="\r")
+            100 * (completed / (len(indices) // params["BATCH_SIZE"] + 1))), end="\r")
 
-    sorted_scores_indices = np.flip(np.argsort(sample_scores), 0).tolist()
-    batch_indices = []
-    batch_feature = []
-    batch_target = []
-    total_deleted = 0
+    return take_best(indices, sample_scores, lg, iteration)
 
-    for i in range(0, len(sorted_scores_indices), params["BATCH_SIZE"]):
-        batch_range = min(params["BATCH_SIZE"], len(sorted_scores_indices) - i)
-        next_indices = sorted_scores_indices[i : i + batch_range]
 
-        next_features = [[data["word_to_idx"][w] for w in data["train_x"][index]] +
-                        [params["VOCAB_SIZE"] + 1 for i in range(params["MAX_SENT_LEN"] - len(data["train_x"][index]))] for index in next_indices]
+def entropy(probs):
+    return -torch.sum(probs * torch.log(probs), dim=1)
 
-        next_targets = [data["classes"].index(data["train_y"][index]) for index in next_indices]
 
+def margin(probs):
+    """Negated gap between the two most probable classes"""
+    top = torch.topk(probs, 2, dim=1)[0]
+    return top[:, 1] - top[:, 0]
 
-        batch_feature.extend(next_features)
-        batch_target.extend(next_targets)
-        batch_indices.extend(next_indices)
 
-        print("len before clean {}".format(len(batch_feature)))
-        n_deleted = clean(batch_feature, batch_target, batch_indices)
-        print("len after clean {}".format(len(batch_feature)))
-        total_deleted += n_deleted
+def least_confidence(probs):
+    return 1 - torch.max(probs, dim=1)[0]
 
-        if len(batch_feature) >= params["BATCH_SIZE"]:
-            break
-    # We only want to add batch_size elements each time
-    batch_feature = batch_feature[0 : params["BATCH_SIZE"]]
-    batch_target = batch_target[0 : params["BATCH_SIZE"]]
-    batch_indices = batch_indices[0 : params["BATCH_SIZE"]]
 
-    for index in sorted(batch_indices, reverse=True):
-        del data["train_x"][index]
-        del data["train_y"][index]
+def pool_scores(model, score_fn):
+    """Returns the available pool indices and score_fn of the predicted class
+    probabilities of each of them, from one volatile pass over the pool in
+    INFERENCE_BATCH_SIZE chunks
+    """
+    model.eval()
+    pool = data["pool"]
+    indices = pool.indices()
+    batch_size = params["INFERENCE_BATCH_SIZE"]
+    scores = torch.zeros(len(indices))
 
-    best_n_scores = [sample_scores[i] for i in batch_indices]
-    avg_all_score = sum(sample_scores) / len(sample_scores)
-    avg_best_score = sum(best_n_scores) / len(best_n_scores)
+    for i in range(0, len(indices), batch_size):
+        feature = utils.batch_variable(pool.ids[indices[i:i + batch_size]], volatile=True)
+        # Output is not a probability distribution - make it using softmax
+        probs = nn.functional.softmax(model(feature), dim=1).data
+        scores[i:i + len(feature)] = score_fn(probs).cpu()
 
-    if params["LOG"]:
-        lg.scalar_summary("avg-score", avg_all_score, iteration)
-        lg.scalar_summary("avg-best-score", avg_best_score, iteration)
-        lg.scalar_summary("n-deleted", total_deleted, iteration)
+        print("Selection process: {0:.0f}% completed ".format(
+            100 * min(1, (i + batch_size) / len(indices))), end="\r")
 
-    return batch_feature, batch_target
+    return indices, scores.numpy()
 
 
 def select_entropy(model, lg, iteration):
-    model.eval()
-    sample_scores = []
-    completed = 0
+    indices, sample_scores = pool_scores(model, entropy)
+    return take_best(indices, sample_scores, lg, iteration)
 
-    for i in range(0, len(data["train_x"]), params["BATCH_SIZE"]):
-        batch_range = min(params["BATCH_SIZE"], len(data["train_x"]) - i)
-        batch_x = [[data["word_to_idx"][w] for w in sent] +
-                   [params["VOCAB_SIZE"] + 1] *
-                   (params["MAX_SENT_LEN"] - len(sent))
-                   for sent in data["train_x"][i:i + batch_range]]
-        batch_y = [data["classes"].index(c)
-                   for c in data["train_y"][i:i + batch_range]]
 
-        feature = Variable(torch.LongTensor(batch_x))
-        target = Variable(torch.LongTensor(batch_y))
+def select_margin(model, lg, iteration):
+    indices, sample_scores = pool_scores(model, margin)
+    return take_best(indices, sample_scores, lg, iteration)
 
-        if params["CUDA"]:
-            feature, target = feature.cuda(), target.cuda()
 
-        output = model(feature)
-        # Output is not a probability distribution - make it using softmax
-        output = nn.functional.softmax(output)
-        output = torch.mul(output, torch.log(output))
-        output = torch.sum(output, dim=1)
-        output = output * -1
+def select_least_confidence(model, lg, iteration):
+    indices, sample_scores = pool_scores(model, least_confidence)
+    return take_best(indices, sample_scores, lg, iteration)
 
-        for s_index, score in enumerate(output):
-            sample_scores.append(score.data[0])
 
-        completed += 1
-        print("Selection process: {0:.0f}% completed ".format(
-            100 * (completed / (len(data["train_x"]) // params["BATCH_SIZE"] + 1))), end="\r")
-
-    sorted_scores_indices = np.flip(np.argsort(sample_scores), 0).tolist()
-    batch_indices = []
-    batch_feature = []
-    batch_target = []
-    total_deleted = 0
+def ranked_top(scores, k):
+    """Positions of the k highest `scores`, highest first"""
+    if k < len(scores):
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="mergesort")]
 
-    for i in range(0, len(sorted_scores_indices), params["BATCH_SIZE"]):
-        batch_range = min(params["BATCH_SIZE"], len(sorted_scores_indices) - i)
-        next_indices = sorted_scores_indices[i : i + batch_range]
 
-        next_features = [[data["word_to_idx"][w] for w in data["train_x"][index]] +
-                        [params["VOCAB_SIZE"] + 1 for i in range(params["MAX_SENT_LEN"] - len(data["train_x"][index]))] for index in next_indices]
+def take_best(indices, sample_scores, lg, iteration):
+    """Takes the BATCH_SIZE best scoring of the available pool `indices`,
+    skipping near-duplicates, and masks them out of the pool.
+    Only the best candidates are ranked; the ranking is widened when
+    cleaning leaves too few of them.
+    Returns their token ids and labels.
+    """
+    sample_scores = np.asarray(sample_scores, dtype=np.float64)
+    representations = {}
+    n_ranked = params["BATCH_SIZE"]
 
-        next_targets = [data["classes"].index(data["train_y"][index]) for index in next_indices]
+    while True:
+        sorted_scores_indices = indices[ranked_top(sample_scores, n_ranked)].tolist()
+        batch_indices = []
+        total_deleted = 0
 
+        for i in range(0, len(sorted_scores_indices), params["BATCH_SIZE"]):
+            batch_indices.extend(sorted_scores_indices[i : i + params["BATCH_SIZE"]])
 
-        batch_feature.extend(next_features)
-        batch_target.extend(next_targets)
-        batch_indices.extend(next_indices)
+            print("len before clean {}".format(len(batch_indices)))
+            n_deleted = clean(batch_indices, representations)
+            print("len after clean {}".format(len(batch_indices)))
+            total_deleted += n_deleted
 
-        print("len before clean {}".format(len(batch_feature)))
-        n_deleted = clean(batch_feature, batch_target, batch_indices)
-        print("len after clean {}".format(len(batch_feature)))
-        total_deleted += n_deleted
+            if len(batch_indices) >= params["BATCH_SIZE"]:
+                break
 
-        if len(batch_feature) >= params["BATCH_SIZE"]:
+        if len(batch_indices) >= params["BATCH_SIZE"] or n_ranked >= len(sample_scores):
             break
+        n_ranked *= 4
+
     # We only want to add batch_size elements each time
-    batch_feature = batch_feature[0 : params["BATCH_SIZE"]]
-    batch_target = batch_target[0 : params["BATCH_SIZE"]]
     batch_indices = batch_indices[0 : params["BATCH_SIZE"]]
+    batch_feature, batch_target = data["pool"].take(batch_indices)
 
-    for index in sorted(batch_indices, reverse=True):
-        del data["train_x"][index]
-        del data["train_y"][index]
-
-    best_n_scores = [sample_scores[i] for i in batch_indices]
-    avg_all_score = sum(sample_scores) / len(sample_scores)
-    avg_best_score = sum(best_n_scores) / len(best_n_scores)
+    scores = np.zeros(len(data["pool"].ids))
+    scores[indices] = sample_scores
+    avg_all_score = sample_scores.mean()
+    avg_best_score = scores[batch_indices].mean()
 
     if params["LOG"]:
         lg.scalar_summary("avg-score", avg_all_score, iteration)
@@ -218,116 +185,73 @@ def select_entropy(model, lg, iteration):
 
     return batch_feature, batch_target
 
-def clean(features, targets, indices):
-    to_delete = []
-    cachedFeatures = {}
-    for j in range(len(features)):
-        for k in range(j + 1, len(features)):
-            first = features[j]
-            second = features[k]
-
-            distance = getDistance(first, second, j, cachedFeatures);
-            # print(distance)
-
-            if distance < params["SIMILARITY_THRESHOLD"]:
-                to_delete.append(k)
-                # print("Distance: {}".format(distance))
-                # print(*[data["vocab"][i] for i in filter(lambda a: a < len(data["vocab"]), first)])
-                # print(*[data["vocab"][i] for i in filter(lambda a: a < len(data["vocab"]), second)])
-                # print("\n\n")
-
-    to_delete = list(set(to_delete))
 
-    print("Deleting {} entries. Feature len is {}".format(len(to_delete), len(features)))
+def clean(indices, representations=None):
+    """Deletes every pool index in `indices` within `SIMILARITY_THRESHOLD`
+    cosine distance of an earlier one. `representations` maps pool indices
+    to their representation for the current round, so every candidate is
+    encoded once even though the growing candidate list is cleaned
+    repeatedly.
+    """
+    to_delete = []
+    if params["SIMILARITY_THRESHOLD"] > 0 and len(indices) > 1:
+        if representations is None:
+            representations = {}
+        missing = [index for index in indices if index not in representations]
+        if missing:
+            for index, representation in zip(missing, get_representations(missing)):
+                representations[index] = representation
+
+        vectors = np.stack([representations[index] for index in indices]).astype(np.float64)
+        norms = np.linalg.norm(vectors, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distances = 1.0 - vectors.dot(vectors.T) / np.outer(norms, norms)
+        # k is deleted if any j < k is too close, as in the pairwise loop
+        close = np.triu(distances < params["SIMILARITY_THRESHOLD"], 1)
+        to_delete = np.where(close.any(axis=0))[0].tolist()
+
+    print("Deleting {} entries. Feature len is {}".format(len(to_delete), len(indices)))
     for delete in sorted(to_delete, reverse=True):
-        del features[delete]
-        del targets[delete]
         del indices[delete]
 
     return len(to_delete)
 
-def getDistance(first, second, j, savedFirsts):
-    distance = 0.0
-
-    if params["SIMILARITY_REPRESENTATION"] == "CNN":
-        feature_extractor = models["FEATURE_EXTRACTOR"]
-        first_cnn = Variable(torch.LongTensor(first))
-        second_cnn = Variable(torch.LongTensor(second))
-
-        if params["CUDA"]:
-            first_cnn, second_cnn = first_cnn.cuda(), second_cnn.cuda()
-
-        # if j in savedFirsts.keys():
-        #     first_cnn = savedFirsts[j]
-        # else:
-        #     first_cnn = feature_extractor(first_cnn).data.cpu().numpy()
-        #     savedFirsts[j] = first_cnn
-        first_cnn = feature_extractor(first_cnn).data.cpu().numpy()
-        second_cnn = feature_extractor(second_cnn).data.cpu().numpy()
-
-        distance = spatial.distance.cosine(first_cnn, second_cnn)
-    if params["SIMILARITY_REPRESENTATION"] == "CNN_SELF":
-        first_cnn = Variable(torch.LongTensor(first))
-        second_cnn = Variable(torch.LongTensor(second))
-        if params["CUDA"]:
-            first_cnn, second_cnn = first_cnn.cuda(), second_cnn.cuda()
-
-        model = models["CLASSIFIER"]
-        first_cnn = model.get_sentence_representation(first_cnn).data.cpu().numpy()
-        second_cnn = model.get_sentence_representation(second_cnn).data.cpu().numpy()
-
-        distance = spatial.distance.cosine(first_cnn, second_cnn)
 
-    if params["SIMILARITY_REPRESENTATION"] == "W2V":
-
-        first_w2v = utils.average_feature_vector(first, w2v["w2v"])
-        second_w2v = utils.average_feature_vector(second, w2v["w2v"])
-
-        distance = spatial.distance.cosine(first_w2v, second_w2v)
-
-    if params["SIMILARITY_REPRESENTATION"] == "AUTOENCODER":
-        encoder = models["ENCODER"]
-
-        if (params["VOCAB_SIZE"] + 1) in first:
-            first_length = first.index(params["VOCAB_SIZE"] + 1)
+def get_representations(indices):
+    """1-D numpy representation of the pool sentences at `indices` for the
+    similarity measure in `SIMILARITY_REPRESENTATION`. The CNN
+    representations are computed one batch at a time, the W2V and
+    AUTOENCODER ones are precomputed for the whole pool.
+    """
+    features = data["pool"].ids[indices]
+    representation = params["SIMILARITY_REPRESENTATION"]
+    if representation in ("CNN", "CNN_SELF"):
+        if representation == "CNN":
+            encode = models["FEATURE_EXTRACTOR"]
         else:
-            first_length = params["MAX_SENT_LEN"]
+            encode = models["CLASSIFIER"].get_sentence_representation
+        vectors = []
+        for i in range(0, len(features), params["BATCH_SIZE"]):
+            batch = utils.batch_variable(features[i:i + params["BATCH_SIZE"]])
+            vectors.extend(encode(batch).data.cpu().numpy().reshape(len(batch), -1))
+        return vectors
 
-        if (params["VOCAB_SIZE"] + 1) in second:
-            second_length = second.index(params["VOCAB_SIZE"] + 1)
-        else:
-            second_length = params["MAX_SENT_LEN"]
+    if representation == "W2V":
+        return w2v["pool_sentences"][indices]
 
-        first_tensor = Variable(torch.LongTensor(first)).unsqueeze(1)
-        second_tensor = Variable(torch.LongTensor(second)).unsqueeze(1)
+    if representation == "AUTOENCODER":
+        return data["pool_encoded"][indices]
 
-        first_tensor, second_tensor = first_tensor.cuda(), second_tensor.cuda()
-        first_out, first_hidden = encoder(first_tensor, [first_length])
-        second_out, second_hidden = encoder(second_tensor, [second_length])
-        first_hidden, second_hidden = first_hidden.squeeze().data.cpu().numpy(), second_hidden.squeeze().data.cpu().numpy()
+    raise ValueError("Unknown similarity representation {}".format(representation))
 
-        distance = spatial.distance.cosine(first_hidden, second_hidden)
-    return distance
 
 def select_random(model, lg, iteration):
-    all_sentences = []
-    all_targets = []
-
-    for i in range(params["SELECTION_SIZE"]):
-        index = random.randint(0, len(data["train_x"]) - 1)
-        sentence = [data["word_to_idx"][w]
-                    for w in data["train_x"][index]]
-        padding = [params["VOCAB_SIZE"] +
-                   1 for i in range(params["MAX_SENT_LEN"] - len(sentence))]
-        sentence.extend(padding)
-
-        target = data["classes"].index(data["train_y"][index])
-        all_sentences.append(sentence)
-        all_targets.append(target)
-        del data["train_x"][index]
-        del data["train_y"][index]
-
-    return all_sentences, all_targets
+    # Same draws as deleting every pick from the pool before the next one
+    remaining = data["pool"].indices().tolist()
+    indices = [remaining.pop(random.randint(0, len(remaining) - 1))
+               for i in range(params["SELECTION_SIZE"])]
+
+    return data["pool"].take(indices)
 
 
 def batchify(features, params):
@@ -1,12 +1,15 @@
 import copy
 import logger
 import datetime
+import shutil
+import tempfile
 import utils
 
 from reprint import output
 from torch.autograd import Variable
 from sklearn.utils import shuffle
 
+import numpy as np
 import torch
 import torch.optim as optim
 import torch.nn as nn
@@ -15,7 +18,9 @@ from config import params, data, models, global_logger
 from models.cnn import CNN
 from models.rnn import RNN
 from models import rnnae
-from selection_strategies import select_random, select_entropy, select_egl, select_all
+from pool import Pool
+from repetitions import run_repetitions, share_arrays
+from selection_strategies import select_random, select_entropy, select_egl, select_all, select_margin, select_least_confidence
 
 
 def to_np(x):
@@ -23,15 +28,53 @@ def to_np(x):
 
 
 def active_train():
-    init_learning_rate = params["LEARNING_RATE"]
-    init_selection_size = params["SELECTION_SIZE"]
-
-    init_data = {}
-    init_data["train_y"] = copy.deepcopy(data["train_y"])
-    init_data["train_x"] = copy.deepcopy(data["train_x"])
-
     average_accs = {}
     average_losses = {}
+    lg = global_logger["lg"] if params["LOG"] else None
+
+    def log_averages(j, rounds):
+        for i, (n_labeled, accuracy, loss) in enumerate(rounds):
+            average_accs.setdefault(i, []).append(accuracy)
+            average_losses.setdefault(i, []).append(loss)
+
+            if params["LOG"]:
+                lg.scalar_summary(
+                    "test-acc-avg", sum(average_accs[i]) / len(average_accs[i]), n_labeled)
+                lg.scalar_summary(
+                    "test-loss-avg", sum(average_losses[i]) / len(average_losses[i]), n_labeled)
+
+    workers = params["WORKERS"]
+    if workers > 1 and params["CUDA"]:
+        print("Running the repetitions sequentially on cuda")
+        workers = 1
+
+    if workers > 1:
+        # The workers map the encoded pool from disk instead of copying it
+        shared_dir = tempfile.mkdtemp()
+        try:
+            pool = data["pool"]
+            shared = share_arrays((pool.ids, pool.lengths, pool.labels), shared_dir)
+            run_repetitions(active_train_repetition, params["N_AVERAGE"], lg, workers,
+                            initializer=use_shared_pool, initargs=shared, on_result=log_averages)
+        finally:
+            shutil.rmtree(shared_dir)
+    else:
+        run_repetitions(active_train_repetition, params["N_AVERAGE"], lg, on_result=log_averages)
+
+    best_model = {}
+    return best_model
+
+
+def use_shared_pool(ids, lengths, labels):
+    data["pool"] = Pool(ids, lengths, labels)
+
+
+def active_train_repetition(j, lg):
+    """One active learning run from an empty labeled set. Returns the
+    (labeled pool size, test accuracy, test loss) of every round.
+    """
+    init_learning_rate = params["LEARNING_RATE"]
+    init_selection_size = params["SELECTION_SIZE"]
 
     if params["MODEL"] == "cnn":
         model = CNN()
@@ -45,91 +88,72 @@ def active_train():
 
     models["CLASSIFIER"] = model
 
-    for j in range(params["N_AVERAGE"]):
-        params["LEARNING_RATE"] = init_learning_rate
-        params["SELECTION_SIZE"] = init_selection_size
+    data["pool"].reset()
 
-        data["train_x"]  = copy.deepcopy(init_data["train_x"])
-        data["train_y"]  = copy.deepcopy(init_data["train_y"])
+    if params["LOG"]:
+        start_accuracy = 100 / params["CLASS_SIZE"]
+        lg.scalar_summary("test-acc", start_accuracy, 0)
+        lg.scalar_summary("test-acc-avg", start_accuracy, 0)
 
-        lg = None
-        if params["LOG"]:
-            lg = global_logger["lg"]
+    print("-" * 20, "Round {}".format(j + 1), "-" * 20)
+    model.init_model()
+    train_features = np.zeros((0, params["MAX_SENT_LEN"]), dtype=np.int32)
+    train_targets = np.zeros(0, dtype=np.int64)
+    distribution = {}
+    rounds = []
 
-            start_accuracy = 100 / params["CLASS_SIZE"]
-            lg.scalar_summary("test-acc", start_accuracy, 0)
-            lg.scalar_summary("test-acc-avg", start_accuracy, 0)
+    for key in range(len(data["classes"])):
+        distribution[key] = []
 
-        print("-" * 20, "Round {}".format(j + 1), "-" * 20)
+    if 500 % params["SELECTION_SIZE"] == 0:
+        n_rounds = int(500 / params["SELECTION_SIZE"])
+        last_selection_size = params["SELECTION_SIZE"]
+    else:
+        n_rounds = int(500 / params["SELECTION_SIZE"]) + 1
+        last_selection_size = 500 % params["SELECTION_SIZE"]
+
+    for i in range(n_rounds):
+        if (n_rounds - 1 == i):
+            params["SELECTION_SIZE"] = last_selection_size
+
+        if params["SCORE_FN"] == "all":
+            t1, t2 = select_all(model, lg, i)
+        elif params["SCORE_FN"] == "entropy":
+            t1, t2 = select_entropy(model, lg, i)
+        elif params["SCORE_FN"] == "egl":
+            t1, t2 = select_egl(model, lg, i)
+        elif params["SCORE_FN"] == "random":
+            t1, t2 = select_random(model, lg, i)
+        elif params["SCORE_FN"] == "margin":
+            t1, t2 = select_margin(model, lg, i)
+        elif params["SCORE_FN"] == "least_confidence":
+            t1, t2 = select_least_confidence(model, lg, i)
+
+        train_features = np.concatenate((train_features, t1))
+        train_targets = np.concatenate((train_targets, t2))
+
+        print("\n")
         model.init_model()
-        train_features = []
-        train_targets = []
-        distribution = {}
-
-        for key in range(len(data["classes"])):
-            distribution[key] = []
-
-        data["train_x"], data["train_y"] = shuffle(data["train_x"], data["train_y"])
-
-        if 500 % params["SELECTION_SIZE"] == 0:
-            n_rounds = int(500 / params["SELECTION_SIZE"])
-            last_selection_size = params["SELECTION_SIZE"]
-        else:
-            n_rounds = int(500 / params["SELECTION_SIZE"]) + 1
-            last_selection_size = 500 % params["SELECTION_SIZE"]
-
-        for i in range(n_rounds):
-            if (n_rounds - 1 == i):
-                params["SELECTION_SIZE"] = last_selection_size
-
-            if params["SCORE_FN"] == "all":
-                t1, t2 = select_all(model, lg, i)
-            elif params["SCORE_FN"] == "entropy":
-                t1, t2 = select_entropy(model, lg, i)
-            elif params["SCORE_FN"] == "egl":
-                t1, t2 = select_egl(model, lg, i)
-            elif params["SCORE_FN"] == "random":
-                t1, t2 = select_random(model, lg, i)
-
-            train_features.extend(t1)
-            train_targets.extend(t2)
-
-            print("\n")
-            model.init_model()
-            model = train(model, train_features, train_targets)
-            accuracy, loss, corrects, size = evaluate(model, i, mode="test")
-            print("{:10s} loss: {:10.6f} acc: {:10.4f}%({}/{}) \n".format("test",
-                                                                          loss, accuracy, corrects, size))
-            if i not in average_accs:
-                average_accs[i] = [accuracy]
-            else:
-                average_accs[i].append(accuracy)
-
-            if i not in average_losses:
-                average_losses[i] = [loss]
-
-            else:
-                average_losses[i].append(loss)
+        model = train(model, train_features, train_targets)
+        accuracy, loss, corrects, size = evaluate(model, i, mode="test")
+        print("{:10s} loss: {:10.6f} acc: {:10.4f}%({}/{}) \n".format("test",
+                                                                      loss, accuracy, corrects, size))
+        rounds.append((len(train_features), accuracy, loss))
 
-            if params["LOG"]:
-                lg.scalar_summary("test-acc", accuracy, len(train_features))
-                lg.scalar_summary(
-                    "test-acc-avg", sum(average_accs[i]) / len(average_accs[i]), len(train_features))
+        if params["LOG"]:
+            lg.scalar_summary("test-acc", accuracy, len(train_features))
+            lg.scalar_summary("test-loss", loss, len(train_features))
 
-                lg.scalar_summary("test-loss", loss, len(train_features))
-                lg.scalar_summary(
-                    "test-loss-avg", sum(average_losses[i]) / len(average_losses[i]), len(train_features))
+            for each in range(len(data["classes"])):
+                val = np.sum(train_targets == each) / len(train_targets)
+                distribution[each].append(val)
 
-                for each in range(len(data["classes"])):
-                    val = train_targets.count(each) / len(train_targets)
-                    distribution[each].append(val)
+            # count number of positive and negativ added to labeledpool.
+            # nameOfFile = '{}/distribution{}.html'.format(lg.log_dir, j)
 
-                # count number of positive and negativ added to labeledpool.
-                # nameOfFile = '{}/distribution{}.html'.format(lg.log_dir, j)
-                
-
-    best_model = {}
-    return best_model
+    params["LEARNING_RATE"] = init_learning_rate
+    params["SELECTION_SIZE"] = init_selection_size
+    return rounds
 
 
 def train(model, train_features, train_targets):
@@ -158,15 +182,8 @@ def train(model, train_features, train_targets):
             corrects = 0
 
             for i in range(0, len(train_features), params["BATCH_SIZE"]):
-                batch_range = min(params["BATCH_SIZE"], len(train_features) - i)
-                batch_x = train_features[i:i + batch_range]
-                batch_y = train_targets[i:i + batch_range]
-
-                feature = Variable(torch.LongTensor(batch_x))
-                target = Variable(torch.LongTensor(batch_y))
-
-                if params["CUDA"]:
-                    feature, target = feature.cuda(), target.cuda()
+                feature = utils.batch_variable(train_features[i:i + params["BATCH_SIZE"]])
+                target = utils.batch_variable(train_targets[i:i + params["BATCH_SIZE"]])
 
                 optimizer.zero_grad()
                 pred = model(feature)
@@ -249,28 +266,18 @@ def evaluate(model, step, mode="test"):
         model.cuda()
 
     corrects, avg_loss = 0, 0
-    for i in range(0, len(data["{}_x".format(mode)]), params["BATCH_SIZE"]):
-        batch_range = min(params["BATCH_SIZE"], len(data["{}_x".format(mode)]) - i)
-
-        feature = [[data["word_to_idx"][w] for w in sent] +
-                   [params["VOCAB_SIZE"] + 1] *
-                   (params["MAX_SENT_LEN"] - len(sent))
-                   for sent in data["{}_x".format(mode)][i:i + batch_range]]
-        target = [data["classes"].index(c)
-                  for c in data["{}_y".format(mode)][i:i + batch_range]]
-
-        feature = Variable(torch.LongTensor(feature))
-        target = Variable(torch.LongTensor(target))
-        if params["CUDA"]:
-            feature = feature.cuda()
-            target = target.cuda()
+    ids = data["{}_ids".format(mode)]
+    labels = data["{}_labels".format(mode)]
+    for i in range(0, len(ids), params["BATCH_SIZE"]):
+        feature = utils.batch_variable(ids[i:i + params["BATCH_SIZE"]])
+        target = utils.batch_variable(labels[i:i + params["BATCH_SIZE"]])
 
         logit = model(feature)
         loss = torch.nn.functional.cross_entropy(logit, target, size_average=False)
         avg_loss += loss.data[0]
         corrects += (torch.max(logit, 1)[1].view(target.size()).data == target.data).sum()
 
-    size = len(data["{}_x".format(mode)])
+    size = len(ids)
     avg_loss = avg_loss / size
     accuracy = 100.0 * corrects / size
 
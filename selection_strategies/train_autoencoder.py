@@ -71,6 +71,8 @@ def main():
     for key in params_local:
         params[key] = params_local[key]
 
+    utils.encode_data()
+
     params["CUDA"] = (not params["NO_CUDA"]) and torch.cuda.is_available()
     del params["NO_CUDA"]
 
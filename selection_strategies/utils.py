@@ -7,10 +7,17 @@ import time
 import plotly.graph_objs as go
 import plotly
 from plotly.graph_objs import Scatter, Layout
-from gensim.models.keyedvectors import KeyedVectors
 
+import embedding_cache
 from config import data, params, w2v
 import numpy as np
+import torch
+from scipy import sparse
+from torch.autograd import Variable
+
+from pool import Pool
+
+SPLITS = ("train", "dev", "test")
 
 def read_TREC():
     def read(mode):
@@ -190,39 +197,61 @@ def logAreaGraph(distribution, classes, name):
 load word2vec pre trained vectors
 """
 def load_word2vec():
-    print("loading word2vec...")
-    t0 = time.time()
-
-    word_vectors = KeyedVectors.load_word2vec_format(
-        "{}/GoogleNews-vectors-negative300.bin".format(params['DATA_PATH']), binary=True)
-
-    t1 = time.time()
-
-    total = t1-t0
-
-    print("It took {} to load w2v".format(total))
-
-    wv_matrix = []
-    for word in data["vocab"]:
-        if word in word_vectors.vocab:
-            wv_matrix.append(word_vectors.word_vec(word))
-        else:
-            wv_matrix.append(
-                np.random.uniform(-0.01, 0.01, 300).astype("float32"))
-
-    # one for UNK and one for zero padding
-    wv_matrix.append(np.random.uniform(-0.01, 0.01, 300).astype("float32"))
-    wv_matrix.append(np.zeros(300).astype("float32"))
-    wv_matrix = np.array(wv_matrix)
+    wv_matrix = embedding_cache.load_embeddings(
+        data["vocab"], "{}/GoogleNews-vectors-negative300.bin".format(params['DATA_PATH']))
     w2v["w2v"] = wv_matrix
+    w2v["pool_sentences"] = sentence_embeddings(data["train_ids"], data["train_lengths"], wv_matrix)
+
+def bag_of_words(ids, lengths, n_words):
+    """Sparse (len(ids), n_words) matrix of the word frequencies of every
+    padded sentence in `ids`, each row divided by the sentence length
+    """
+    lengths = np.asarray(lengths)
+    rows, cols = np.nonzero(np.arange(ids.shape[1]) < lengths[:, None])
+    weights = 1.0 / lengths[rows]
+    return sparse.csr_matrix((weights, (rows, ids[rows, cols])), shape=(len(ids), n_words))
+
+
+def sentence_embeddings(ids, lengths, wv_matrix):
+    """Average word vector of every padded sentence in `ids`, as one sparse
+    bag-of-words times embedding matrix product
+    """
+    return np.asarray(bag_of_words(ids, lengths, len(wv_matrix)).dot(wv_matrix), dtype=np.float32)
+
+
+def encode_split(sentences, labels):
+    """Token ids of `sentences` padded to MAX_SENT_LEN (int32), their
+    lengths (int32) and the class index of every label (int64)
+    """
+    ids = np.full((len(sentences), params["MAX_SENT_LEN"]), params["VOCAB_SIZE"] + 1, dtype=np.int32)
+    lengths = np.zeros(len(sentences), dtype=np.int32)
+    for i, sent in enumerate(sentences):
+        ids[i, :len(sent)] = [data["word_to_idx"][w] for w in sent]
+        lengths[i] = len(sent)
+
+    class_index = {c: i for i, c in enumerate(data["classes"])}
+    labels = np.array([class_index[c] for c in labels], dtype=np.int64)
+    return ids, lengths, labels
+
+
+def encode_data():
+    """One-time encoding of every split into data["{split}_ids"],
+    data["{split}_lengths"] and data["{split}_labels"], which the
+    selection and training functions slice directly. data["pool"] is the
+    unlabeled pool over the train split.
+    """
+    for split in SPLITS:
+        ids, lengths, labels = encode_split(data["{}_x".format(split)], data["{}_y".format(split)])
+        data["{}_ids".format(split)] = ids
+        data["{}_lengths".format(split)] = lengths
+        data["{}_labels".format(split)] = labels
+    data["pool"] = Pool(data["train_ids"], data["train_lengths"], data["train_labels"])
+
+
+def batch_variable(batch, volatile=False):
+    """LongTensor Variable of a slice of an encoded split"""
+    batch = Variable(torch.from_numpy(np.ascontiguousarray(batch)).long(), volatile=volatile)
+    if params["CUDA"]:
+        batch = batch.cuda()
+    return batch
 
-def average_feature_vector(sentence, word_vectors):
-    num_features = 300
-    feature_vector = np.zeros((num_features, ), dtype="float32")
-
-    for word in sentence:
-        word_vector = word_vectors[word]
-        feature_vector = np.add(feature_vector, word_vector)
-
-    feature_vector = np.divide(feature_vector, len(sentence))
-    return feature_vector
@@ -0,0 +1,98 @@
+"""Forward + backward benchmark of the chunked `order_sim` against the
+dense B x B x D implementation it replaced, for training batch sizes.
+
+    python benchmark_order_sim.py --embed_size 1024
+"""
+from __future__ import print_function
+import argparse
+import time
+
+import torch
+from torch.autograd import Variable
+
+from model import order_sim
+
+
+def dense_order_sim(im, s):
+    """The previous implementation, kept here for comparison"""
+    YmX = (s.unsqueeze(1).expand(s.size(0), im.size(0), s.size(1))
+           - im.unsqueeze(0).expand(s.size(0), im.size(0), s.size(1)))
+    return -YmX.clamp(min=0).pow(2).sum(2).sqrt().t()
+
+
+def run(sim, batch_size, embed_size, repeats, cuda):
+    """Returns (seconds per step, peak bytes or None, score, grads)"""
+    torch.manual_seed(batch_size)
+    im = torch.rand(batch_size, embed_size)
+    s = torch.rand(batch_size, embed_size)
+    # peak memory stats are missing from older torch versions
+    track_peak = cuda and hasattr(torch.cuda, 'reset_max_memory_allocated')
+    if cuda:
+        im, s = im.cuda(), s.cuda()
+    if track_peak:
+        torch.cuda.reset_max_memory_allocated()
+    im = Variable(im, requires_grad=True)
+    s = Variable(s, requires_grad=True)
+
+    start = time.time()
+    for _ in range(repeats):
+        for x in (im, s):
+            if x.grad is not None:
+                x.grad.data.zero_()
+        score = sim(im, s)
+        score.sum().backward()
+    if cuda:
+        torch.cuda.synchronize()
+    elapsed = (time.time() - start) / repeats
+
+    peak = torch.cuda.max_memory_allocated() if track_peak else None
+    return elapsed, peak, score.data, (im.grad.data, s.grad.data)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', default='128,256,512,1024',
+                        help='Comma separated batch sizes.')
+    parser.add_argument('--embed_size', default=1024, type=int)
+    parser.add_argument('--repeats', default=3, type=int)
+    parser.add_argument('--no_cuda', action='store_true')
+    opt = parser.parse_args()
+    cuda = torch.cuda.is_available() and not opt.no_cuda
+
+    print('{:>6} {:>12} {:>12} {:>14} {:>14} {:>10}'.format(
+        'batch', 'dense s', 'chunked s', 'dense peak MB', 'chunk peak MB',
+        'max diff'))
+    for batch_size in [int(b) for b in opt.batch_sizes.split(',')]:
+        chunked = run(order_sim, batch_size, opt.embed_size, opt.repeats,
+                      cuda)
+        try:
+            dense = run(dense_order_sim, batch_size, opt.embed_size,
+                        opt.repeats, cuda)
+        except RuntimeError as e:
+            # the dense version is expected to run out of memory
+            print('{:>6} {:>12} {:>12.4f}  dense failed: {}'.format(
+                batch_size, '-', chunked[0], str(e).split('\n')[0]))
+            continue
+
+        diff = max(float((dense[2] - chunked[2]).abs().max()),
+                   float((dense[3][0] - chunked[3][0]).abs().max()),
+                   float((dense[3][1] - chunked[3][1]).abs().max()))
+        if dense[1] is not None:
+            peaks = ['{:.1f}'.format(dense[1] / 2. ** 20),
+                     '{:.1f}'.format(chunked[1] / 2. ** 20)]
+        elif not cuda:
+            # on cpu report the size of the largest temporary instead
+            peaks = ['{:.1f}'.format(
+                         4. * batch_size ** 2 * opt.embed_size / 2. ** 20),
+                     '{:.1f}'.format(
+                         4. * min(batch_size ** 2 * opt.embed_size,
+                                  max(batch_size * opt.embed_size,
+                                      2 ** 24)) / 2. ** 20)]
+        else:
+            peaks = ['-', '-']
+        print('{:>6} {:>12.4f} {:>12.4f} {:>14} {:>14} {:>10.2e}'.format(
+            batch_size, dense[0], chunked[0], peaks[0], peaks[1], diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Tokenization throughput of `Vocabulary.encode_batch` with the regex
+tokenizer against the nltk tokenization + per-token lookup loop used by the
+datasets, on a coco-size caption set. The synthetic captions only use plain
+words, pass a real caption file to measure how often the encodings agree.
+
+    python benchmark_vocab.py --captions $DATA_PATH/coco_precomp/train_caps.txt \
+        --vocab vocab/coco_precomp_vocab.pkl
+"""
+from __future__ import print_function
+import argparse
+import pickle
+import random
+import time
+
+import nltk
+
+from vocab import Vocabulary, from_txt
+
+
+WORDS = ('a man woman dog cat two people red blue white young is are '
+         'sitting standing riding running on in at near with the of and '
+         'street field table horse bike beach water').split()
+
+
+def synthetic_captions(n, seed=0):
+    """Caption-like strings, used when no caption file is given"""
+    rng = random.Random(seed)
+    captions = []
+    for _ in range(n):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(6, 16))]
+        if rng.random() < .3:
+            words[rng.randrange(len(words))] += ','
+        if rng.random() < .2:
+            words[rng.randrange(len(words))] += "'s"
+        captions.append(' '.join(words) + rng.choice(['', ' .', '.']))
+    return captions
+
+
+def nltk_tokenizer():
+    """nltk's word_tokenize, or its Treebank part if punkt is missing"""
+    try:
+        nltk.tokenize.word_tokenize('a test.')
+        return nltk.tokenize.word_tokenize
+    except LookupError:
+        print('punkt not installed, timing the Treebank tokenizer only')
+        return nltk.tokenize.TreebankWordTokenizer().tokenize
+
+
+def encode_loop(captions, vocab, word_tokenize):
+    """What the datasets do per caption"""
+    encoded = []
+    for caption in captions:
+        tokens = word_tokenize(caption.lower())
+        ids = [vocab('<start>')]
+        ids.extend([vocab(token) for token in tokens])
+        ids.append(vocab('<end>'))
+        encoded.append(ids)
+    return encoded
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--captions', default='',
+                        help='Caption file, one per line (default: '
+                        'synthetic captions).')
+    parser.add_argument('--vocab', default='',
+                        help='Pickled vocabulary (default: built from the '
+                        'synthetic words).')
+    parser.add_argument('--n', default=600000, type=int,
+                        help='Number of captions to tokenize.')
+    parser.add_argument('--batch_size', default=10000, type=int)
+    opt = parser.parse_args()
+
+    if opt.captions:
+        captions = [c.decode('utf-8') if isinstance(c, bytes) else c
+                    for c in from_txt(opt.captions)[:opt.n]]
+    else:
+        captions = synthetic_captions(opt.n)
+    if opt.vocab:
+        with open(opt.vocab, 'rb') as f:
+            vocab = pickle.load(f)
+    else:
+        vocab = Vocabulary()
+        for word in ['<pad>', '<start>', '<end>', '<unk>'] + WORDS:
+            vocab.add_word(word)
+
+    word_tokenize = nltk_tokenizer()
+    start = time.time()
+    expected = encode_loop(captions, vocab, word_tokenize)
+    loop_time = time.time() - start
+
+    start = time.time()
+    batches = [vocab.encode_batch(captions[i:i + opt.batch_size],
+                                  tokenizer='regex')
+               for i in range(0, len(captions), opt.batch_size)]
+    batch_time = time.time() - start
+
+    same = 0
+    for b, (padded, lengths) in enumerate(batches):
+        for i in range(len(lengths)):
+            ids = expected[b * opt.batch_size + i]
+            same += padded[i, :lengths[i]].tolist() == ids
+    print('{} captions'.format(len(captions)))
+    print('{:>14} {:>10.2f} s {:>12.0f} captions/s'.format(
+        'nltk + lookup', loop_time, len(captions) / loop_time))
+    print('{:>14} {:>10.2f} s {:>12.0f} captions/s'.format(
+        'encode_batch', batch_time, len(captions) / batch_time))
+    print('identical encodings: {:.3f}%'.format(
+        100. * same / max(1, len(captions))))
+
+
+if __name__ == '__main__':
+    main()
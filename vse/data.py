@@ -7,6 +7,12 @@ from PIL import Image
 # from pycocotools.coco import COCO
 import numpy as np
 import json as jsonmod
+import random
+import hashlib
+import shutil
+import tempfile
+
+from vocab import tokenizer_version
 
 
 def get_paths(path, name='coco', use_restval=False):
@@ -93,14 +99,15 @@ class FlickrDataset(data.Dataset):
     def __getitem__(self, index):
         """This function returns a tuple that is further passed to collate_fn
         """
+        image, target, img_id = self.get_ann(self.ids[index])
+        return image, target, index, img_id
+
+    def get_ann(self, ann_id):
         vocab = self.vocab
-        root = self.root
-        ann_id = self.ids[index]
         img_id = ann_id[0]
         caption = self.dataset[img_id]['sentences'][ann_id[1]]['raw']
-        path = self.dataset[img_id]['filename']
 
-        image = Image.open(os.path.join(root, path)).convert('RGB')
+        image = self.load_image(img_id)
         if self.transform is not None:
             image = self.transform(image)
 
@@ -112,19 +119,185 @@ class FlickrDataset(data.Dataset):
         caption.extend([vocab(token) for token in tokens])
         caption.append(vocab('<end>'))
         target = torch.Tensor(caption)
-        return image, target, index, img_id
+        return image, target, img_id
+
+    def load_image(self, img_id):
+        path = self.dataset[img_id]['filename']
+        return Image.open(os.path.join(self.root, path)).convert('RGB')
+
+    def delete_indices(self, indices):
+        indices = set(indices)
+        self.ids = [ann_id for i, ann_id in enumerate(self.ids)
+                    if i not in indices]
 
     def __len__(self):
         return len(self.ids)
 
 
+class ImageFileDataset(data.Dataset):
+    """Decoded and transformed images of a list of files"""
+
+    def __init__(self, root, paths, transform):
+        self.root = root
+        self.paths = paths
+        self.transform = transform
+
+    def __getitem__(self, index):
+        image = Image.open(os.path.join(self.root, self.paths[index]))
+        return self.transform(image.convert('RGB')), index
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def to_uint8_array(image):
+    """PIL image to a (H, W, 3) uint8 tensor"""
+    return torch.from_numpy(np.asarray(image, dtype=np.uint8).copy())
+
+
+def resized_shape(width, height, size):
+    """(height, width) of an image after `transforms.Resize(size)`, which
+    scales its short side to `size`
+    """
+    if width < height:
+        return int(size * height / width), size
+    return size, int(size * width / height)
+
+
+class ResizedImageDataset(ImageFileDataset):
+    """Images of a list of files resized to given (height, width) shapes,
+    as uint8 tensors
+    """
+
+    def __init__(self, root, paths, shapes):
+        super(ResizedImageDataset, self).__init__(root, paths, None)
+        self.shapes = shapes
+
+    def __getitem__(self, index):
+        height, width = self.shapes[index]
+        image = Image.open(os.path.join(self.root, self.paths[index]))
+        image = image.convert('RGB').resize((int(width), int(height)),
+                                            Image.BILINEAR)
+        return to_uint8_array(image), index
+
+
+def collate_list(data):
+    return data
+
+
+def image_cache_paths(cache_dir, split, size):
+    """Paths of the pixel and shape arrays of an image cache"""
+    prefix = os.path.join(cache_dir, '%s_images_short%d' % (split, size))
+    return prefix + '.npy', prefix + '_shapes.npy'
+
+
+def image_offsets(shapes):
+    """Start of every image of an image cache, followed by the total size"""
+    offsets = np.zeros(len(shapes) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(shapes[:, 0] * shapes[:, 1] * 3)
+    return offsets
+
+
+def build_image_cache(root, paths, cache_path, shape_path, size=256,
+                      workers=10):
+    """One-time decoding of `paths` into a flat uint8 array at `cache_path`.
+    Images are resized to a short side of `size`, like the first step of
+    the JPEG transforms, and stored whole one after the other. Their
+    (height, width) go to `shape_path`. Both arrays are written next to
+    their paths and renamed into place when done, the pixels last.
+    """
+    shapes = np.zeros((len(paths), 2), dtype=np.int64)
+    for i, path in enumerate(paths):
+        # only reads the image header
+        width, height = Image.open(os.path.join(root, path)).size
+        shapes[i] = resized_shape(width, height, size)
+    offsets = image_offsets(shapes)
+
+    loader = torch.utils.data.DataLoader(
+        ResizedImageDataset(root, paths, shapes), batch_size=64,
+        shuffle=False, num_workers=workers, collate_fn=collate_list)
+    tmp_path = '%s.%d.tmp.npy' % (cache_path[:-len('.npy')], os.getpid())
+    images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                       shape=(int(offsets[-1]),))
+    for i, batch in enumerate(loader):
+        for image, index in batch:
+            images[offsets[index]:offsets[index + 1]] = \
+                image.numpy().ravel()
+        if i % 10 == 0:
+            print('Caching images [{}/{}]'.format(i, len(loader)))
+    images.flush()
+    del images
+
+    tmp_shape_path = '%s.%d.tmp.npy' % (shape_path[:-len('.npy')],
+                                        os.getpid())
+    np.save(tmp_shape_path, shapes)
+    os.rename(tmp_shape_path, shape_path)
+    os.rename(tmp_path, cache_path)
+
+
+class FlickrImageCacheDataset(FlickrDataset):
+    """
+    `FlickrDataset` reading decoded images from a uint8 memory-mapped
+    cache of the split, built on first use. Images are cached whole,
+    resized to a short side of `size`, so the transform only crops and
+    flips small arrays and should end in `to_uint8_tensor`.
+    """
+
+    def __init__(self, root, json, split, vocab, transform=None,
+                 cache_dir='', size=256, workers=10):
+        super(FlickrImageCacheDataset, self).__init__(root, json, split,
+                                                      vocab, transform)
+        img_ids = [i for i, d in enumerate(self.dataset)
+                   if d['split'] == split]
+        self.rows = dict((img_id, row) for row, img_id in enumerate(img_ids))
+
+        cache_path, shape_path = image_cache_paths(cache_dir, split, size)
+        if not os.path.isfile(cache_path):
+            print("Building image cache {}".format(cache_path))
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            build_image_cache(root, [self.dataset[i]['filename']
+                                     for i in img_ids],
+                              cache_path, shape_path, size, workers)
+        self.images = np.load(cache_path, mmap_mode='r')
+        self.shapes = np.load(shape_path)
+        self.offsets = image_offsets(self.shapes)
+
+    def load_image(self, img_id):
+        row = self.rows[img_id]
+        height, width = self.shapes[row]
+        image = self.images[self.offsets[row]:self.offsets[row + 1]]
+        return Image.fromarray(np.asarray(image).reshape(height, width, 3))
+
+
+class FlickrActiveDataset(data.Dataset):
+    """
+    Active dataset that only records which annotations of a Flickr
+    dataset have been labeled, and loads them through it.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.ids = []
+
+    def __getitem__(self, index):
+        image, target, _ = self.source.get_ann(self.ids[index])
+        return image, target, index, index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add_from(self, dataset, indices):
+        self.ids.extend(dataset.ids[index] for index in indices)
+
+
 class PrecompDataset(data.Dataset):
     """
     Load precomputed captions and image features
     Possible options: f8k, f30k, coco, 10crop
     """
 
-    def __init__(self, data_path, data_split, vocab):
+    def __init__(self, data_path, data_split, vocab, tokenizer='nltk'):
         self.vocab = vocab
         loc = data_path + '/'
 
@@ -135,7 +308,7 @@ class PrecompDataset(data.Dataset):
                 self.captions.append(line.strip())
 
         # Image features
-        self.images = np.load(loc+'%s_ims.npy' % data_split)
+        self.images = self.load_images(loc, data_split)
         self.length = len(self.captions)
         # rkiros data has redundancy in images, we divide by 5, 10crop doesn't
         if self.images.shape[0] != self.length:
@@ -146,32 +319,75 @@ class PrecompDataset(data.Dataset):
         if data_split == 'dev':
             self.length = 5000
 
+        # Convert captions (string) to word ids once
+        self.tokens, self.offsets, self.lengths = encode_captions(
+            self.captions, vocab, tokenizer)
+
+    def load_images(self, loc, data_split):
+        return np.load(loc+'%s_ims.npy' % data_split)
+
     def delete_indices(self, indices):
         self.images = np.delete(self.images, indices, axis=0)
         self.captions = np.delete(self.captions, indices, axis=0)
+        self.offsets = np.delete(self.offsets, indices)
+        self.lengths = np.delete(self.lengths, indices)
         self.length = len(self.captions)
 
     def __getitem__(self, index):
         # handle the image redundancy
         img_id = int(index/self.im_div)
         image = torch.Tensor(self.images[img_id])
-        caption = self.captions[index]
-        vocab = self.vocab
-
-        # Convert caption (string) to word ids.
-        tokens = nltk.tokenize.word_tokenize(
-            str(caption).lower().decode('utf-8'))
-        caption = []
-        caption.append(vocab('<start>'))
-        caption.extend([vocab(token) for token in tokens])
-        caption.append(vocab('<end>'))
-        target = torch.Tensor(caption)
+        start = self.offsets[index]
+        caption = self.tokens[start:start + self.lengths[index]]
+        target = torch.from_numpy(caption.astype(np.float32))
         return image, target, index, img_id
 
     def __len__(self):
         return self.length
 
 
+class FlickrFeatureDataset(PrecompDataset):
+    """
+    Flickr full dataset served from the CNN features written once by
+    `extract_features.py`. The features are memory-mapped. Items of 10-crop
+    features use the center crop, `active_item` keeps all ten so the active
+    set can sample a random one every epoch. Deleting items only clears
+    them in an availability mask over the captions, the features are never
+    copied.
+    """
+
+    def __init__(self, data_path, data_split, vocab, crop='center',
+                 tokenizer='nltk'):
+        self.crop = crop
+        super(FlickrFeatureDataset, self).__init__(data_path, data_split,
+                                                   vocab, tokenizer)
+        self.available = np.ones(self.length, dtype=bool)
+        self.ann_ids = np.flatnonzero(self.available)
+
+    def load_images(self, loc, data_split):
+        return np.load(loc+feature_file(data_split, self.crop), mmap_mode='r')
+
+    def delete_indices(self, indices):
+        self.available[self.ann_ids[indices]] = False
+        self.ann_ids = np.flatnonzero(self.available)
+
+    def active_item(self, index):
+        ann_id = int(self.ann_ids[index])
+        image, target, _, img_id = super(FlickrFeatureDataset,
+                                         self).__getitem__(ann_id)
+        return image, target, index, img_id
+
+    def __getitem__(self, index):
+        image, target, index, img_id = self.active_item(index)
+        if image.dim() == 2:
+            # TenCrop puts the center crop after the four corners
+            image = image[4]
+        return image, target, index, img_id
+
+    def __len__(self):
+        return len(self.ann_ids)
+
+
 class ActiveDataset(data.Dataset):
     """
     Initially empty dataset to contain the train
@@ -186,6 +402,9 @@ class ActiveDataset(data.Dataset):
 
     def __getitem__(self, index):
         image = torch.Tensor(self.images[index])
+        if image.dim() == 2:
+            # features of several crops, use a random one
+            image = image[random.randrange(image.size(0))]
         caption = self.captions[index]
         target = torch.Tensor(caption)
         return image, target, index, index
@@ -204,6 +423,161 @@ class ActiveDataset(data.Dataset):
         self.captions.extend(captions)
         # self.length = len(self.captions)
 
+    def add_from(self, dataset, indices):
+        get_item = getattr(dataset, 'active_item', dataset.__getitem__)
+        for index in indices:
+            item = get_item(index)
+            self.add_single(item[0], item[1])
+
+
+def encode_captions(captions, vocab, tokenizer='nltk'):
+    """Encode every caption once into a flat int64 token array.
+    Returns the tokens together with the offset and length of each caption.
+    """
+    return vocab.encode_flat(captions, tokenizer=tokenizer)
+
+
+CAPTION_CACHE_FILES = ('tokens', 'offsets', 'lengths')
+
+
+def count_lines(path):
+    with open(path, 'rb') as f:
+        return sum(1 for _ in f)
+
+
+def caption_cache_key(caption_path, vocab, limit, tokenizer):
+    """Short key of the caption file contents, the vocabulary, the
+    number of encoded rows and the tokenizer version
+    """
+    h = hashlib.sha1()
+    with open(caption_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    h.update(repr(sorted(vocab.word2idx.items(),
+                         key=lambda x: x[1])).encode('utf-8'))
+    h.update(repr(limit).encode('utf-8'))
+    h.update(tokenizer_version(tokenizer).encode('utf-8'))
+    return h.hexdigest()[:16]
+
+
+def build_caption_cache(caption_path, vocab, limit, cache_dir, tokenizer):
+    """One-time encoding of the first `limit` captions of `caption_path`
+    into `cache_dir`. The directory is written next to its final location
+    and renamed into place, so parallel runs never see a half-written cache.
+    """
+    captions = []
+    with open(caption_path, 'rb') as f:
+        for line in f:
+            if limit is not None and len(captions) == limit:
+                break
+            captions.append(line.strip())
+    arrays = encode_captions(captions, vocab, tokenizer)
+
+    parent = os.path.dirname(cache_dir)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    tmp_dir = tempfile.mkdtemp(dir=parent)
+    for name, array in zip(CAPTION_CACHE_FILES, arrays):
+        np.save(os.path.join(tmp_dir, '%s.npy' % name), array)
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        # Another process finished the same cache first
+        shutil.rmtree(tmp_dir)
+
+
+class CaptionTokenStore(object):
+    """
+    Pre-encoded captions and memory-mapped image features of one split,
+    shared by the pool dataset and the active dataset. The captions are
+    encoded once into a cache keyed by the caption file, the vocabulary and
+    the tokenizer, later runs memory-map it.
+    """
+
+    def __init__(self, data_path, data_split, vocab, cache_dir=None,
+                 tokenizer='nltk'):
+        loc = data_path + '/'
+        caption_path = loc+'%s_caps.txt' % data_split
+        # the development set for coco is large and so validation would be
+        # slow, only its first 5000 captions are served
+        limit = 5000 if data_split == 'dev' else None
+
+        if cache_dir is None:
+            cache_dir = os.path.join(data_path, 'caption_cache')
+        cache_dir = os.path.join(cache_dir, '%s_%s' % (
+            data_split,
+            caption_cache_key(caption_path, vocab, limit, tokenizer)))
+        if not os.path.isdir(cache_dir):
+            print("Building caption cache {}".format(cache_dir))
+            build_caption_cache(caption_path, vocab, limit, cache_dir,
+                                tokenizer)
+        self.tokens, self.offsets, self.lengths = [
+            np.load(os.path.join(cache_dir, '%s.npy' % name), mmap_mode='r')
+            for name in CAPTION_CACHE_FILES]
+
+        self.images = np.load(loc+'%s_ims.npy' % data_split, mmap_mode='r')
+        # rkiros data has redundancy in images, we divide by 5, 10crop doesn't
+        n_captions = (len(self.lengths) if limit is None
+                      else count_lines(caption_path))
+        if self.images.shape[0] != n_captions:
+            self.im_div = 5
+        else:
+            self.im_div = 1
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def item(self, ann_id):
+        """Image row and token slice of caption `ann_id`, both views"""
+        img_id = int(ann_id / self.im_div)
+        start = self.offsets[ann_id]
+        caption = self.tokens[start:start + self.lengths[ann_id]]
+        return self.images[img_id], caption, img_id
+
+
+class TokenPrecompDataset(data.Dataset):
+    """
+    Precomputed dataset backed by a `CaptionTokenStore`. Deleting items
+    only clears them in an availability mask, the store is never copied.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.available = np.ones(len(store), dtype=bool)
+        self.ann_ids = np.flatnonzero(self.available)
+
+    def delete_indices(self, indices):
+        self.available[self.ann_ids[indices]] = False
+        self.ann_ids = np.flatnonzero(self.available)
+
+    def __getitem__(self, index):
+        image, caption, img_id = self.store.item(self.ann_ids[index])
+        return image, caption, index, img_id
+
+    def __len__(self):
+        return len(self.ann_ids)
+
+
+class TokenActiveDataset(data.Dataset):
+    """
+    Active dataset that only records which captions of the store
+    have been labeled.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.ann_ids = []
+
+    def __getitem__(self, index):
+        image, caption, _ = self.store.item(self.ann_ids[index])
+        return image, caption, index, index
+
+    def __len__(self):
+        return len(self.ann_ids)
+
+    def add_from(self, dataset, indices):
+        self.ann_ids.extend(dataset.ann_ids[indices].tolist())
+
 
 def collate_fn(data):
     """Build mini-batch tensors from a list of (image, caption) tuples.
@@ -215,7 +589,7 @@ def collate_fn(data):
     Returns:
         images: torch tensor of shape (batch_size, 3, 256, 256).
         targets: torch tensor of shape (batch_size, padded_length).
-        lengths: list; valid length for each padded caption.
+        lengths: LongTensor; valid length for each padded caption.
     """
     # Sort a data list by caption length
     data.sort(key=lambda x: len(x[1]), reverse=True)
@@ -231,9 +605,41 @@ def collate_fn(data):
         end = lengths[i]
         targets[i, :end] = cap[:end]
 
+    return images, targets, torch.LongTensor(lengths), ids
+
+
+MEAN = torch.FloatTensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+STD = torch.FloatTensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+
+
+def collate_uint8_fn(data):
+    """Same as `collate_fn` for uint8 images, which are converted to
+    normalized float tensors per batch instead of per image.
+    """
+    images, targets, lengths, ids = collate_fn(data)
+    images = images.float().div_(255).sub_(MEAN).div_(STD)
     return images, targets, lengths, ids
 
 
+def collate_token_fn(data):
+    """Same as `collate_fn` for items holding numpy image rows and token
+    slices. Both are copied straight into preallocated batch tensors.
+    """
+    data.sort(key=lambda x: len(x[1]), reverse=True)
+    images, captions, ids, img_ids = zip(*data)
+
+    lengths = [len(cap) for cap in captions]
+    batch_images = torch.FloatTensor(len(images), *images[0].shape)
+    targets = torch.zeros(len(captions), lengths[0]).long()
+    images_np = batch_images.numpy()
+    targets_np = targets.numpy()
+    for i, (image, cap) in enumerate(zip(images, captions)):
+        images_np[i] = image
+        targets_np[i, :lengths[i]] = cap
+
+    return batch_images, targets, torch.LongTensor(lengths), list(ids)
+
+
 def get_loader_single(data_name, split, root, json, vocab, transform,
                       batch_size=100, shuffle=True,
                       num_workers=2, ids=None, collate_fn=collate_fn):
@@ -264,7 +670,8 @@ def get_loader_single(data_name, split, root, json, vocab, transform,
 def get_precomp_loader(data_path, data_split, vocab, opt, batch_size=100,
                        shuffle=True, num_workers=2):
     """Returns torch.utils.data.DataLoader for custom coco dataset."""
-    dset = PrecompDataset(data_path, data_split, vocab)
+    dset = PrecompDataset(data_path, data_split, vocab,
+                          getattr(opt, 'tokenizer', 'nltk'))
 
     data_loader = torch.utils.data.DataLoader(dataset=dset,
                                               batch_size=batch_size,
@@ -284,6 +691,96 @@ def get_active_loader(vocab, batch_size=100, shuffle=True, num_workers=2):
     return data_loader
 
 
+def get_token_loader(dset, batch_size=100, shuffle=True, num_workers=2):
+    """Returns torch.utils.data.DataLoader for a token-backed dataset."""
+    data_loader = torch.utils.data.DataLoader(dataset=dset,
+                                              batch_size=batch_size,
+                                              shuffle=shuffle,
+                                              pin_memory=True,
+                                              num_workers=num_workers,
+                                              collate_fn=collate_token_fn)
+    return data_loader
+
+
+
+def feature_dir(opt, data_name):
+    """Dir of the features written by `extract_features.py`"""
+    if getattr(opt, 'feature_path', ''):
+        return opt.feature_path
+    return os.path.join(opt.data_path, data_name, 'features', opt.cnn_type)
+
+
+def feature_file(data_split, crop='center'):
+    if crop == '10crop':
+        return '%s_ims_10crop.npy' % data_split
+    return '%s_ims.npy' % data_split
+
+
+def has_features(opt, data_name, splits):
+    fpath = feature_dir(opt, data_name)
+    crop = getattr(opt, 'feature_crop', 'center')
+    return all(os.path.isfile(os.path.join(fpath, feature_file(split, crop)))
+               for split in splits)
+
+
+def get_feature_loader(data_path, data_split, vocab, opt, batch_size=100,
+                       shuffle=True, num_workers=2):
+    """Returns torch.utils.data.DataLoader over extracted CNN features."""
+    dset = FlickrFeatureDataset(data_path, data_split, vocab,
+                                getattr(opt, 'feature_crop', 'center'),
+                                getattr(opt, 'tokenizer', 'nltk'))
+
+    data_loader = torch.utils.data.DataLoader(dataset=dset,
+                                              batch_size=batch_size,
+                                              shuffle=shuffle,
+                                              pin_memory=True,
+                                              num_workers=num_workers,
+                                              collate_fn=collate_fn)
+    return data_loader
+
+
+def to_uint8_tensor(image):
+    """PIL image to a (3, H, W) uint8 tensor"""
+    return torch.from_numpy(
+        np.asarray(image, dtype=np.uint8).transpose(2, 0, 1).copy())
+
+
+def get_cache_transform(split_name, opt):
+    """`get_transform` for images served from the image cache, which are
+    already resized. Normalization happens in `collate_uint8_fn`.
+    """
+    if split_name == 'train':
+        t_list = [transforms.RandomResizedCrop(opt.crop_size),
+                  transforms.RandomHorizontalFlip()]
+    else:
+        t_list = [transforms.CenterCrop(224)]
+    return transforms.Compose(t_list + [transforms.Lambda(to_uint8_tensor)])
+
+
+def get_image_cache_loader(dset, batch_size=100, shuffle=True,
+                           num_workers=2):
+    """Returns torch.utils.data.DataLoader for image cache datasets."""
+    data_loader = torch.utils.data.DataLoader(dataset=dset,
+                                              batch_size=batch_size,
+                                              shuffle=shuffle,
+                                              pin_memory=True,
+                                              num_workers=num_workers,
+                                              collate_fn=collate_uint8_fn)
+    return data_loader
+
+
+def image_cache_dataset(data_name, split, vocab, opt, workers):
+    dpath = os.path.join(opt.data_path, data_name)
+    roots, _ = get_paths(dpath, data_name, opt.use_restval)
+    cache_dir = (getattr(opt, 'image_cache_path', '') or
+                 os.path.join(dpath, 'image_cache'))
+    return FlickrImageCacheDataset(roots[split]['img'], roots[split]['cap'],
+                                   split, vocab,
+                                   get_cache_transform(split, opt),
+                                   cache_dir,
+                                   getattr(opt, 'image_cache_size', 256),
+                                   workers)
+
 
 def get_transform(data_name, split_name, opt):
     normalizer = transforms.Normalize(mean=[0.485, 0.456, 0.406],
@@ -304,12 +801,45 @@ def get_transform(data_name, split_name, opt):
 
 def get_loaders(data_name, vocab, crop_size, batch_size, workers, opt):
     dpath = os.path.join(opt.data_path, data_name)
-    if opt.data_name.endswith('_precomp'):
+    if opt.data_name.endswith('_precomp') and opt.token_store:
+        tokenizer = getattr(opt, 'tokenizer', 'nltk')
+        train_store = CaptionTokenStore(dpath, 'train', vocab,
+                                        tokenizer=tokenizer)
+        dev_store = CaptionTokenStore(dpath, 'dev', vocab,
+                                      tokenizer=tokenizer)
+        train_loader = get_token_loader(
+            TokenPrecompDataset(train_store), batch_size, True,
+            workers)
+        val_loader = get_token_loader(
+            TokenPrecompDataset(dev_store), batch_size, False, workers)
+        active_loader = get_token_loader(
+            TokenActiveDataset(train_store), batch_size, True, workers)
+    elif opt.data_name.endswith('_precomp'):
         train_loader = get_precomp_loader(dpath, 'train', vocab, opt,
                                           batch_size, True, workers)
         val_loader = get_precomp_loader(dpath, 'dev', vocab, opt,
                                         batch_size, False, workers)
         active_loader = get_active_loader(vocab)
+    elif not opt.finetune and has_features(opt, data_name, ('train', 'dev')):
+        # the CNN is frozen, train on its features extracted once
+        fpath = feature_dir(opt, data_name)
+        train_loader = get_feature_loader(fpath, 'train', vocab, opt,
+                                          batch_size, True, workers)
+        val_loader = get_feature_loader(fpath, 'dev', vocab, opt,
+                                        batch_size, False, workers)
+        active_loader = get_active_loader(vocab)
+        opt.precomp_features = True
+        opt.img_dim = train_loader.dataset.images.shape[-1]
+    elif getattr(opt, 'image_cache', False):
+        train_dset = image_cache_dataset(data_name, 'train', vocab, opt,
+                                         workers)
+        train_loader = get_image_cache_loader(train_dset, batch_size, True,
+                                              workers)
+        val_loader = get_image_cache_loader(
+            image_cache_dataset(data_name, 'val', vocab, opt, workers),
+            batch_size, False, workers)
+        active_loader = get_image_cache_loader(
+            FlickrActiveDataset(train_dset), batch_size, True, workers)
     else:
         # Build Dataset Loader
         roots, ids = get_paths(dpath, data_name, opt.use_restval)
@@ -340,9 +870,25 @@ def get_loaders(data_name, vocab, crop_size, batch_size, workers, opt):
 def get_test_loader(split_name, data_name, vocab, crop_size, batch_size,
                     workers, opt):
     dpath = os.path.join(opt.data_path, data_name)
-    if opt.data_name.endswith('_precomp'):
+    if opt.data_name.endswith('_precomp') and getattr(opt, 'token_store',
+                                                      False):
+        store = CaptionTokenStore(dpath, split_name, vocab,
+                                  tokenizer=getattr(opt, 'tokenizer', 'nltk'))
+        test_loader = get_token_loader(TokenPrecompDataset(store),
+                                       batch_size, False, workers)
+    elif opt.data_name.endswith('_precomp'):
         test_loader = get_precomp_loader(dpath, split_name, vocab, opt,
                                          batch_size, False, workers)
+    elif getattr(opt, 'precomp_features', False):
+        # models trained on extracted features are evaluated on them too
+        test_loader = get_feature_loader(
+            feature_dir(opt, data_name),
+            'dev' if split_name == 'val' else split_name, vocab, opt,
+            batch_size, False, workers)
+    elif getattr(opt, 'image_cache', False):
+        test_loader = get_image_cache_loader(
+            image_cache_dataset(data_name, split_name, vocab, opt, workers),
+            batch_size, False, workers)
     else:
         # Build Dataset Loader
         roots, ids = get_paths(dpath, data_name, opt.use_restval)
@@ -0,0 +1,80 @@
+import itertools
+import os
+
+import numpy as np
+
+# Shared by every model instance, so a model built for a new round never
+# reuses the version of the previous one
+_versions = itertools.count()
+
+
+def next_version():
+    """Returns a new, globally unique model version"""
+    return next(_versions)
+
+
+class EmbeddingStore(object):
+    """
+    Keeps the embeddings of each dataset together with the key (model
+    version, dataset size) they were computed for, so every weights/split
+    pair is encoded at most once. Embeddings are float32 numpy arrays,
+    datasets with at least `spill_size` items are memory-mapped from
+    `spill_dir` instead of being kept in memory.
+    """
+
+    def __init__(self, spill_dir='', spill_size=0):
+        self.spill_dir = spill_dir
+        self.spill_size = spill_size
+        self.entries = {}
+        self.spills = itertools.count()
+
+    def get(self, dataset, key, encode):
+        """Returns the embeddings of `dataset` cached under `key`. On a miss
+        `encode(allocate)` is called, with `allocate(shape)` returning the
+        float32 array (in memory or memory-mapped) to write them into.
+        """
+        entry = self.entries.get(id(dataset))
+        if entry is not None and entry[0] == key:
+            return entry[1]
+
+        self.drop(dataset)
+        paths = []
+        embs = tuple(np.asarray(emb, dtype=np.float32)
+                     for emb in encode(lambda shape: self.allocate(shape,
+                                                                   paths)))
+        self.entries[id(dataset)] = (key, embs, paths)
+        return embs
+
+    def allocate(self, shape, paths):
+        if not self.spill_dir or shape[0] < self.spill_size:
+            return np.zeros(shape, dtype=np.float32)
+
+        if not os.path.isdir(self.spill_dir):
+            os.makedirs(self.spill_dir)
+        path = os.path.join(self.spill_dir, '%d_%d.npy' % (os.getpid(),
+                                                           next(self.spills)))
+        paths.append(path)
+        return np.lib.format.open_memmap(path, mode='w+', dtype=np.float32,
+                                         shape=shape)
+
+    def drop(self, dataset):
+        """Forgets `dataset`. Spilled files are unlinked, arrays still
+        holding their mapping stay valid until they are released.
+        """
+        self.remove(id(dataset))
+
+    def remove(self, entry_id):
+        entry = self.entries.pop(entry_id, None)
+        if entry is None:
+            return
+        for path in entry[2]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def clear(self):
+        for entry_id in list(self.entries):
+            self.remove(entry_id)
+
+
+# Used by `evaluation.encode_data`, configured from the command line
+store = EmbeddingStore()
@@ -1,4 +1,5 @@
 from __future__ import print_function
+import multiprocessing
 import os
 import pickle
 
@@ -9,6 +10,7 @@ import numpy as np
 from vocab import Vocabulary  # NOQA
 import torch
 from model import VSE, order_sim
+import embedding_store
 from collections import OrderedDict
 
 
@@ -71,38 +73,54 @@ class LogCollector(object):
 
 
 def encode_data(model, data_loader, log_step=10, logging=print):
-    """Encode all images and captions loadable by `data_loader`
+    """Encode all images and captions loadable by `data_loader`. The
+    float32 embeddings are reused until the weights or the dataset change.
     """
-    batch_time = AverageMeter()
-    val_logger = LogCollector()
+    key = (model.version, len(data_loader.dataset))
+    return embedding_store.store.get(
+        data_loader.dataset, key,
+        lambda allocate: encode_loader(model, data_loader, log_step, logging,
+                                       allocate=allocate))
+
 
-    # switch to evaluate mode
+def iter_encode(model, data_loader):
+    """Yields (ids, img_emb, cap_emb) float32 numpy batches of everything
+    loadable by `data_loader`, without keeping earlier batches around
+    """
     model.val_start()
+    for images, captions, lengths, ids in data_loader:
+        img_emb, cap_emb = model.forward_emb(images, captions, lengths,
+                                             volatile=True)
+        yield (ids, img_emb.data.cpu().numpy().astype(np.float32, copy=False),
+               cap_emb.data.cpu().numpy().astype(np.float32, copy=False))
+        del images, captions, img_emb, cap_emb
+
+
+def allocate_embeddings(shape):
+    return np.zeros(shape, dtype=np.float32)
+
+
+def encode_loader(model, data_loader, log_step=10, logging=print,
+                  allocate=allocate_embeddings):
+    """Encode all images and captions loadable by `data_loader`, writing
+    each batch straight into the float32 arrays returned by
+    `allocate(shape)`, e.g. memory-mapped files
+    """
+    batch_time = AverageMeter()
 
     end = time.time()
 
-    # numpy array to keep all the embeddings
     img_embs = None
     cap_embs = None
-    for i, (images, captions, lengths, ids) in enumerate(data_loader):
-        # make sure val logger is used
-        model.logger = val_logger
-
-        # compute the embeddings
-        img_emb, cap_emb = model.forward_emb(images, captions, lengths,
-                                             volatile=True)
-
-        # initialize the numpy arrays given the size of the embeddings
+    for i, (ids, img_emb, cap_emb) in enumerate(iter_encode(model,
+                                                            data_loader)):
+        # initialize the outputs given the size of the embeddings
         if img_embs is None:
-            img_embs = np.zeros((len(data_loader.dataset), img_emb.size(1)))
-            cap_embs = np.zeros((len(data_loader.dataset), cap_emb.size(1)))
-
-        # preserve the embeddings by copying from gpu and converting to numpy
-        img_embs[ids] = img_emb.data.cpu().numpy().copy()
-        cap_embs[ids] = cap_emb.data.cpu().numpy().copy()
+            img_embs = allocate((len(data_loader.dataset), img_emb.shape[1]))
+            cap_embs = allocate((len(data_loader.dataset), cap_emb.shape[1]))
 
-        # measure accuracy and record loss
-        model.forward_loss(img_emb, cap_emb)
+        img_embs[ids] = img_emb
+        cap_embs[ids] = cap_emb
 
         # measure elapsed time
         batch_time.update(time.time() - end)
@@ -110,21 +128,31 @@ def encode_data(model, data_loader, log_step=10, logging=print):
 
         if i % log_step == 0:
             logging('Test: [{0}/{1}]\t'
-                    '{e_log}\t'
                     'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                     .format(
-                        i, len(data_loader), batch_time=batch_time,
-                        e_log=str(model.logger)))
-        del images, captions
+                        i, len(data_loader), batch_time=batch_time))
 
     return img_embs, cap_embs
 
 
-def evalrank(model_path, data_path=None, split='dev', fold5=False):
+def iter_chunks(embs, chunk_size=128):
+    """Yields (start, FloatTensor) row chunks of a (possibly memory-mapped)
+    embedding matrix, on the gpu if available
+    """
+    for start in range(0, len(embs), chunk_size):
+        chunk = torch.from_numpy(
+            np.ascontiguousarray(embs[start:start + chunk_size],
+                                 dtype=np.float32))
+        if torch.cuda.is_available():
+            chunk = chunk.cuda()
+        yield start, chunk
+
+
+def evalrank(model_path, data_path=None, split='dev', fold5=False, n_jobs=1):
     """
     Evaluate a trained model on either dev or test. If `fold5=True`, 5 fold
-    cross-validation is done (only for MSCOCO). Otherwise, the full data is
-    used for evaluation.
+    cross-validation is done (only for MSCOCO), in `n_jobs` processes.
+    Otherwise, the full data is used for evaluation.
     """
     # load model and options
     checkpoint = torch.load(model_path)
@@ -168,17 +196,22 @@ def evalrank(model_path, data_path=None, split='dev', fold5=False):
         print("Text to image: %.1f %.1f %.1f %.1f %.1f" % ri)
     else:
         # 5fold cross-validation, only for MSCOCO
+        folds = [(img_embs[i * 5000:(i + 1) * 5000],
+                  cap_embs[i * 5000:(i + 1) * 5000], opt.measure)
+                 for i in range(5)]
+        # order_sim may run on the gpu, which forked workers can not share
+        if n_jobs > 1 and not (opt.measure == 'order' and
+                               torch.cuda.is_available()):
+            pool = multiprocessing.Pool(min(n_jobs, len(folds)))
+            fold_results = pool.map(evaluate_fold, folds)
+            pool.close()
+            pool.join()
+        else:
+            fold_results = [evaluate_fold(fold) for fold in folds]
+
         results = []
-        for i in range(5):
-            r, rt0 = i2t(img_embs[i * 5000:(i + 1) * 5000],
-                         cap_embs[i * 5000:(i + 1) *
-                                  5000], measure=opt.measure,
-                         return_ranks=True)
+        for i, (r, rt0, ri, rti0) in enumerate(fold_results):
             print("Image to text: %.1f, %.1f, %.1f, %.1f, %.1f" % r)
-            ri, rti0 = t2i(img_embs[i * 5000:(i + 1) * 5000],
-                           cap_embs[i * 5000:(i + 1) *
-                                    5000], measure=opt.measure,
-                           return_ranks=True)
             if i == 0:
                 rt, rti = rt0, rti0
             print("Text to image: %.1f, %.1f, %.1f, %.1f, %.1f" % ri)
@@ -199,9 +232,61 @@ def evalrank(model_path, data_path=None, split='dev', fold5=False):
         print("Text to image: %.1f %.1f %.1f %.1f %.1f" %
               mean_metrics[5:10])
 
+    # ranks and top-1 indices as int32 arrays
     torch.save({'rt': rt, 'rti': rti}, 'ranks.pth.tar')
 
 
+def evaluate_fold(fold):
+    """i2t and t2i metrics and ranks of one (images, captions, measure)
+    fold, module level so it can run in a process pool
+    """
+    images, captions, measure = fold
+    r, rt = i2t(images, captions, measure=measure, return_ranks=True)
+    ri, rti = t2i(images, captions, measure=measure, return_ranks=True)
+    return r, rt, ri, rti
+
+
+# Number of queries scored at once by `rank_queries`
+RANK_BLOCK = 1000
+
+
+def order_scores(images, captions):
+    """(images x captions) `order_sim` scores of numpy embeddings"""
+    a = torch.Tensor(np.ascontiguousarray(images))
+    b = torch.Tensor(np.ascontiguousarray(captions))
+    if torch.cuda.is_available():
+        a, b = a.cuda(), b.cuda()
+    return order_sim(a, b).cpu().numpy()
+
+
+def rank_queries(scores, n_queries, relevant):
+    """Vectorized ranking kernel. `scores(start, stop)` returns the scores
+    of queries start:stop against all items and `relevant` the indices of
+    the matching items of every query. The rank of a query is the number of
+    items scoring strictly higher than its best matching item.
+    Returns int32 ranks and top-1 item indices.
+    """
+    ranks = np.zeros(n_queries, dtype=np.int32)
+    top1 = np.zeros(n_queries, dtype=np.int32)
+    for start in range(0, n_queries, RANK_BLOCK):
+        stop = min(start + RANK_BLOCK, n_queries)
+        d = scores(start, stop)
+        rows = np.arange(stop - start)[:, None]
+        best = d[rows, relevant[start:stop]].max(axis=1)
+        ranks[start:stop] = (d > best[:, None]).sum(axis=1)
+        top1[start:stop] = d.argmax(axis=1)
+    return ranks, top1
+
+
+def rank_metrics(ranks):
+    r1 = 100.0 * len(numpy.where(ranks < 1)[0]) / len(ranks)
+    r5 = 100.0 * len(numpy.where(ranks < 5)[0]) / len(ranks)
+    r10 = 100.0 * len(numpy.where(ranks < 10)[0]) / len(ranks)
+    medr = numpy.floor(numpy.median(ranks)) + 1
+    meanr = ranks.mean() + 1
+    return (r1, r5, r10, medr, meanr)
+
+
 def i2t(images, captions, npts=None, measure='cosine', return_ranks=False):
     """
     Images->Text (Image Annotation)
@@ -209,53 +294,22 @@ def i2t(images, captions, npts=None, measure='cosine', return_ranks=False):
     Captions: (5N, K) matrix of captions
     """
     if npts is None:
-        npts = images.shape[0] / 5
-    index_list = []
-
-    ranks = numpy.zeros(npts)
-    top1 = numpy.zeros(npts)
-    for index in range(npts):
-
-        # Get query image
-        im = images[5 * index].reshape(1, images.shape[1])
+        npts = images.shape[0] // 5
+    ims = images[0:5 * npts:5]
 
-        # Compute scores
+    def scores(start, stop):
         if measure == 'order':
-            bs = 100
-            if index % bs == 0:
-                mx = min(images.shape[0], 5 * (index + bs))
-                im2 = images[5 * index:mx:5]
-                a = torch.Tensor(im2)
-                b = torch.Tensor(captions)
-                if torch.cuda.is_available():
-                    a, b = a.cuda(), b.cuda()
-                d2 = order_sim(a,b)
-                d2 = d2.cpu().numpy()
-            d = d2[index % bs]
-        else:
-            d = numpy.dot(im, captions.T).flatten()
-        inds = numpy.argsort(d)[::-1]
-        index_list.append(inds[0])
-
-        # Score
-        rank = 1e20
-        for i in range(5 * index, 5 * index + 5, 1):
-            tmp = numpy.where(inds == i)[0][0]
-            if tmp < rank:
-                rank = tmp
-        ranks[index] = rank
-        top1[index] = inds[0]
+            return order_scores(ims[start:stop], captions)
+        return numpy.dot(ims[start:stop], captions.T)
+
+    relevant = 5 * numpy.arange(npts)[:, None] + numpy.arange(5)
+    ranks, top1 = rank_queries(scores, npts, relevant)
 
     # Compute metrics
-    r1 = 100.0 * len(numpy.where(ranks < 1)[0]) / len(ranks)
-    r5 = 100.0 * len(numpy.where(ranks < 5)[0]) / len(ranks)
-    r10 = 100.0 * len(numpy.where(ranks < 10)[0]) / len(ranks)
-    medr = numpy.floor(numpy.median(ranks)) + 1
-    meanr = ranks.mean() + 1
     if return_ranks:
-        return (r1, r5, r10, medr, meanr), (ranks, top1)
+        return rank_metrics(ranks), (ranks, top1)
     else:
-        return (r1, r5, r10, medr, meanr)
+        return rank_metrics(ranks)
 
 
 def t2i(images, captions, npts=None, measure='cosine', return_ranks=False):
@@ -265,46 +319,19 @@ def t2i(images, captions, npts=None, measure='cosine', return_ranks=False):
     Captions: (5N, K) matrix of captions
     """
     if npts is None:
-        npts = images.shape[0] / 5
-    ims = numpy.array([images[i] for i in range(0, len(images), 5)])
+        npts = images.shape[0] // 5
+    ims = images[0:5 * npts:5]
 
-    ranks = numpy.zeros(5 * npts)
-    top1 = numpy.zeros(5 * npts)
-    for index in range(npts):
-
-        # Get query captions
-        queries = captions[5 * index:5 * index + 5]
-
-        # Compute scores
+    def scores(start, stop):
         if measure == 'order':
-            bs = 100
-            if 5 * index % bs == 0:
-                mx = min(captions.shape[0], 5 * index + bs)
-                q2 = captions[5 * index:mx]
-
-                a = torch.Tensor(ims)
-                b = torch.Tensor(q2)
-                if torch.cuda.is_available():
-                    a, b = a.cuda(), b.cuda()
-                d2 = order_sim(a, b)
-                d2 = d2.cpu().numpy()
-
-            d = d2[:, (5 * index) % bs:(5 * index) % bs + 5].T
-        else:
-            d = numpy.dot(queries, ims.T)
-        inds = numpy.zeros(d.shape)
-        for i in range(len(inds)):
-            inds[i] = numpy.argsort(d[i])[::-1]
-            ranks[5 * index + i] = numpy.where(inds[i] == index)[0][0]
-            top1[5 * index + i] = inds[i][0]
+            return order_scores(ims, captions[start:stop]).T
+        return numpy.dot(captions[start:stop], ims.T)
+
+    relevant = (numpy.arange(5 * npts) // 5)[:, None]
+    ranks, top1 = rank_queries(scores, 5 * npts, relevant)
 
     # Compute metrics
-    r1 = 100.0 * len(numpy.where(ranks < 1)[0]) / len(ranks)
-    r5 = 100.0 * len(numpy.where(ranks < 5)[0]) / len(ranks)
-    r10 = 100.0 * len(numpy.where(ranks < 10)[0]) / len(ranks)
-    medr = numpy.floor(numpy.median(ranks)) + 1
-    meanr = ranks.mean() + 1
     if return_ranks:
-        return (r1, r5, r10, medr, meanr), (ranks, top1)
+        return rank_metrics(ranks), (ranks, top1)
     else:
-        return (r1, r5, r10, medr, meanr)
+        return rank_metrics(ranks)
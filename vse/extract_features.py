@@ -0,0 +1,133 @@
+"""Runs the frozen CNN of `EncoderImageFull` once over the images of a
+Flickr dataset and stores the l2-normalized features in the precomp layout
+(`{split}_ims.npy` + `{split}_caps.txt`), so runs without `--finetune`
+can train on `FlickrFeatureDataset` instead of decoding every image.
+
+    python extract_features.py --data_path $DATA_PATH --data_name f30k \
+        --cnn_type vgg19 --crop 10crop
+"""
+from __future__ import print_function
+import argparse
+import json as jsonmod
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from torch.autograd import Variable
+
+from data import get_paths, feature_dir, feature_file, ImageFileDataset
+from model import EncoderImageFull, l2norm
+
+# precomp split names of the Karpathy json splits
+SPLITS = {'train': 'train', 'val': 'dev', 'test': 'test'}
+
+
+def get_transform(crop):
+    """Same preprocessing as the val/test transform of `data.py`, with a
+    stack of ten crops for `10crop`
+    """
+    normalizer = transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                                      std=[0.229, 0.224, 0.225])
+    to_tensor = transforms.Compose([transforms.ToTensor(), normalizer])
+    if crop == '10crop':
+        return transforms.Compose([
+            transforms.Resize(256), transforms.TenCrop(224),
+            transforms.Lambda(
+                lambda crops: torch.stack([to_tensor(c) for c in crops]))])
+    return transforms.Compose([transforms.Resize(256),
+                               transforms.CenterCrop(224), to_tensor])
+
+
+def extract_split(cnn, root, json, split, out_dir, crop='center',
+                  batch_size=64, workers=10):
+    """Writes the features and captions of one json split to `out_dir`.
+    Both are written to a temporary directory first and moved into place
+    once complete.
+    """
+    images = [d for d in jsonmod.load(open(json, 'r'))['images']
+              if d['split'] == split]
+    n_caps = [len(d['sentences']) for d in images]
+    # one feature row per image when every image has 5 captions, as in the
+    # rkiros data, otherwise one per caption
+    rows = np.arange(len(images))
+    if set(n_caps) != set([5]):
+        rows = np.repeat(rows, n_caps)
+
+    loader = torch.utils.data.DataLoader(
+        ImageFileDataset(root, [d['filename'] for d in images],
+                         get_transform(crop)),
+        batch_size=batch_size, shuffle=False, num_workers=workers,
+        pin_memory=True)
+
+    name = SPLITS[split]
+    tmp_dir = tempfile.mkdtemp(dir=out_dir)
+    feats = None
+    for i, (batch, index) in enumerate(loader):
+        size = batch.size()
+        batch = Variable(batch.view(-1, *size[-3:]), volatile=True)
+        if torch.cuda.is_available():
+            batch = batch.cuda()
+        out = l2norm(cnn(batch)).data.cpu().numpy()
+        if feats is None:
+            shape = (len(images),) + tuple(size[1:-3]) + (out.shape[-1],)
+            feats = np.lib.format.open_memmap(
+                os.path.join(tmp_dir, 'images.npy'), mode='w+',
+                dtype=np.float32, shape=shape)
+        feats[index.numpy()] = out.reshape((len(index),) + feats.shape[1:])
+        if i % 10 == 0:
+            print('{} [{}/{}]'.format(name, i, len(loader)))
+    feats.flush()
+
+    ims_path = os.path.join(tmp_dir, 'ims.npy')
+    if len(rows) == len(images):
+        shutil.move(os.path.join(tmp_dir, 'images.npy'), ims_path)
+    else:
+        np.save(ims_path, feats[rows])
+    with open(os.path.join(tmp_dir, 'caps.txt'), 'wb') as f:
+        for d in images:
+            for sentence in d['sentences']:
+                f.write(sentence['raw'].strip().encode('utf-8') + b'\n')
+
+    shutil.move(ims_path, os.path.join(out_dir, feature_file(name, crop)))
+    shutil.move(os.path.join(tmp_dir, 'caps.txt'),
+                os.path.join(out_dir, '%s_caps.txt' % name))
+    shutil.rmtree(tmp_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_path', default='/data/stud/jorgebjorn/data/',
+                        help='path to datasets')
+    parser.add_argument('--data_name', default='f30k',
+                        help='f8k|f30k')
+    parser.add_argument('--cnn_type', default='vgg19',
+                        help='The CNN used for image encoder')
+    parser.add_argument('--crop', default='center',
+                        help='center|10crop')
+    parser.add_argument('--feature_path', default='', type=str,
+                        help='Output dir (default: DATA_PATH/DATA_NAME/'
+                        'features/CNN_TYPE)')
+    parser.add_argument('--splits', default='train,val,test',
+                        help='Comma separated json splits.')
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--workers', default=10, type=int)
+    opt = parser.parse_args()
+
+    dpath = os.path.join(opt.data_path, opt.data_name)
+    roots, _ = get_paths(dpath, opt.data_name)
+    out_dir = feature_dir(opt, opt.data_name)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    cnn = EncoderImageFull(1, False, opt.cnn_type).cnn
+    cnn.eval()
+    for split in opt.splits.split(','):
+        extract_split(cnn, roots[split]['img'], roots[split]['cap'], split,
+                      out_dir, opt.crop, opt.batch_size, opt.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,12 +3,15 @@ import torch.nn as nn
 import torch.nn.init
 import torchvision.models as models
 from torch.autograd import Variable
-from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.autograd.function import once_differentiable
+from torch.nn.utils.rnn import pack_padded_sequence
 import torch.backends.cudnn as cudnn
 from torch.nn.utils.clip_grad import clip_grad_norm
 import numpy as np
 from collections import OrderedDict
 
+from embedding_store import next_version
+
 
 def l2norm(X):
     """L2-normalize columns of X
@@ -19,12 +22,14 @@ def l2norm(X):
 
 
 def EncoderImage(data_name, img_dim, embed_size, finetune=False,
-                 cnn_type='vgg19', use_abs=False, no_imgnorm=False):
+                 cnn_type='vgg19', use_abs=False, no_imgnorm=False,
+                 precomp=False):
     """A wrapper to image encoders. Chooses between an encoder that uses
     precomputed image features, `EncoderImagePrecomp`, or an encoder that
-    computes image features on the fly `EncoderImageFull`.
+    computes image features on the fly `EncoderImageFull`. `precomp` selects
+    the former for full datasets whose CNN features were extracted.
     """
-    if data_name.endswith('_precomp'):
+    if data_name.endswith('_precomp') or precomp:
         img_enc = EncoderImagePrecomp(
             img_dim, embed_size, use_abs, no_imgnorm)
     else:
@@ -205,22 +210,19 @@ class EncoderText(nn.Module):
         self.embed.weight.data.uniform_(-0.1, 0.1)
 
     def forward(self, x, lengths):
-        """Handles variable size captions
+        """Handles variable size captions. `lengths` (list or LongTensor)
+        has to be sorted in descending order, the caption embedding is the
+        final hidden state of the GRU.
         """
-        # Embed word ids to vectors
-        x = self.embed(x)
+        if isinstance(lengths, list):
+            lengths = torch.LongTensor(lengths)
+        # Embed word ids to vectors, without the padding past the longest
+        x = self.embed(x[:, :int(lengths[0])])
         packed = pack_padded_sequence(x, lengths, batch_first=True)
 
-        # Forward propagate RNN
-        out, _ = self.rnn(packed)
-
-        # Reshape *final* output to (batch_size, hidden_size)
-        padded = pad_packed_sequence(out, batch_first=True)
-        I = torch.LongTensor(lengths).view(-1, 1, 1)
-        I = Variable(I.expand(x.size(0), 1, self.embed_size)-1)
-        if torch.cuda.is_available():
-            I = I.cuda()
-        out = torch.gather(padded[0], 1, I).squeeze(1)
+        # Forward propagate RNN, h_n holds the last step of every caption
+        _, hidden = self.rnn(packed)
+        out = hidden[-1]
 
         # normalization in the joint embedding space
         out = l2norm(out)
@@ -238,13 +240,67 @@ def cosine_sim(im, s):
     return im.mm(s.t())
 
 
+# Max number of elements of the (rows x captions x dim) difference tensor
+# materialized at once by `order_sim`
+ORDER_SIM_CHUNK = 2 ** 24
+
+
+def order_sim_chunks(im, s):
+    """Yields (start, stop) row ranges of `im` that keep the difference
+    tensor within ORDER_SIM_CHUNK elements
+    """
+    rows = max(1, ORDER_SIM_CHUNK // max(1, s.size(0) * s.size(1)))
+    for start in range(0, im.size(0), rows):
+        yield start, min(start + rows, im.size(0))
+
+
+def order_sim_forward(im, s):
+    """Chunked $-||max(0, s-im)||$ without tracking gradients
+    """
+    score = im.new(im.size(0), s.size(0))
+    for start, stop in order_sim_chunks(im, s):
+        diff = s.unsqueeze(0) - im[start:stop].unsqueeze(1)
+        score[start:stop] = diff.clamp_(min=0).pow_(2).sum(2).sqrt_().neg_()
+    return score
+
+
+class OrderSim(torch.autograd.Function):
+    """Order similarity whose forward and backward passes both work in row
+    chunks, so the full B x B x D difference tensor is never kept in memory.
+    """
+
+    @staticmethod
+    def forward(ctx, im, s):
+        score = order_sim_forward(im, s)
+        ctx.save_for_backward(im, s, score)
+        return score
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_score):
+        # plain tensors in and out, wrapped in Variables by the decorator
+        im, s, score = ctx.saved_tensors
+        # d score / d max(0, s-im) = max(0, s-im) / score, and zero for
+        # pairs that are already ordered (score == 0)
+        coef = grad_score / score
+        coef.masked_fill_(score == 0, 0)
+        grad_im = im.new(im.size()).zero_()
+        grad_s = s.new(s.size()).zero_()
+        for start, stop in order_sim_chunks(im, s):
+            diff = s.unsqueeze(0) - im[start:stop].unsqueeze(1)
+            weighted = diff.clamp_(min=0).mul_(coef[start:stop].unsqueeze(2))
+            grad_im[start:stop] = -weighted.sum(1)
+            grad_s += weighted.sum(0)
+        return grad_im, grad_s
+
+
 def order_sim(im, s):
     """Order embeddings similarity measure $max(0, s-im)$
     """
-    YmX = (s.unsqueeze(1).expand(s.size(0), im.size(0), s.size(1))
-           - im.unsqueeze(0).expand(s.size(0), im.size(0), s.size(1)))
-    score = -YmX.clamp(min=0).pow(2).sum(2).sqrt().t()
-    return score
+    if (getattr(im, 'requires_grad', False) or
+            getattr(s, 'requires_grad', False)):
+        return OrderSim.apply(im, s)
+    return order_sim_forward(im, s)
 
 
 class ContrastiveLoss(nn.Module):
@@ -261,6 +317,18 @@ class ContrastiveLoss(nn.Module):
             self.sim = cosine_sim
 
         self.max_violation = max_violation
+        # diagonal masks keyed by batch size, built once per size
+        self.masks = {}
+
+    def diagonal_mask(self, size):
+        """Boolean identity mask of `size`, cached across calls"""
+        if size not in self.masks:
+            mask = torch.eye(size) > .5
+            mask = Variable(mask)
+            if torch.cuda.is_available():
+                mask = mask.cuda()
+            self.masks[size] = mask
+        return self.masks[size]
 
     def forward(self, im, s):
         # compute image-sentence score matrix
@@ -277,10 +345,7 @@ class ContrastiveLoss(nn.Module):
         cost_im = (self.margin + scores - d2).clamp(min=0)
 
         # clear diagonals
-        mask = torch.eye(scores.size(0)) > .5
-        I = Variable(mask)
-        if torch.cuda.is_available():
-            I = I.cuda()
+        I = self.diagonal_mask(scores.size(0))
         cost_s = cost_s.masked_fill_(I, 0)
         cost_im = cost_im.masked_fill_(I, 0)
 
@@ -305,7 +370,9 @@ class VSE(nn.Module):
         self.img_enc = EncoderImage(opt.data_name, opt.img_dim, opt.embed_size,
                                     opt.finetune, opt.cnn_type,
                                     use_abs=opt.use_abs,
-                                    no_imgnorm=opt.no_imgnorm)
+                                    no_imgnorm=opt.no_imgnorm,
+                                    precomp=getattr(opt, 'precomp_features',
+                                                    False))
         self.txt_enc = EncoderText(opt.vocab_size, opt.word_dim,
                                    opt.embed_size, opt.num_layers,
                                    use_abs=opt.use_abs)
@@ -327,6 +394,8 @@ class VSE(nn.Module):
         self.optimizer = torch.optim.Adam(params, lr=opt.learning_rate)
 
         self.Eiters = 0
+        # Bumped whenever the weights change, invalidates cached embeddings
+        self.version = next_version()
 
     def state_dict(self):
         state_dict = [self.img_enc.state_dict(), self.txt_enc.state_dict()]
@@ -335,6 +404,7 @@ class VSE(nn.Module):
     def load_state_dict(self, state_dict):
         self.img_enc.load_state_dict(state_dict[0])
         self.txt_enc.load_state_dict(state_dict[1])
+        self.version = next_version()
 
     def train_start(self):
         """switch to train mode
@@ -405,3 +475,4 @@ class VSE(nn.Module):
         if self.grad_clip > 0:
             clip_grad_norm(self.params, self.grad_clip)
         self.optimizer.step()
+        self.version = next_version()
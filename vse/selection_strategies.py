@@ -1,5 +1,5 @@
 from model import cosine_sim
-from evaluation import encode_data
+from evaluation import encode_data, iter_chunks
 import torch.nn as nn
 import random
 import torch
@@ -10,6 +10,47 @@ import copy
 import numpy as np
 import sys
 
+# Rows of primary and secondary embeddings compared at once by `running_topk`
+PRIMARY_CHUNK = 1024
+SECONDARY_CHUNK = 8192
+
+
+def running_topk(primary_embs, secondary_embs, k, largest=False):
+    """Yields (start, values, indices) with the k smallest (or largest)
+    similarities of every chunk of primary embeddings to all secondary
+    embeddings. Only a running top-k is kept while streaming over the
+    secondary chunks, the full distance rows are never built.
+    """
+    for start, primary_batch in iter_chunks(primary_embs, PRIMARY_CHUNK):
+        values, indices = None, None
+        for j, secondary_batch in iter_chunks(secondary_embs, SECONDARY_CHUNK):
+            sims = primary_batch.mm(secondary_batch.t())
+            block_values, block_indices = torch.topk(
+                sims, min(k, sims.size(1)), 1, largest=largest)
+            block_indices += j
+            if values is not None:
+                # merge with the best k seen so far
+                block_values = torch.cat((values, block_values), 1)
+                block_indices = torch.cat((indices, block_indices), 1)
+                block_values, order = torch.topk(
+                    block_values, min(k, block_values.size(1)), 1,
+                    largest=largest)
+                block_indices = torch.gather(block_indices, 1, order)
+            values, indices = block_values, block_indices
+        yield start, values, indices
+
+
+def best_n(scores, n, largest=False):
+    """Indices of the n smallest (or largest) scores, best first"""
+    keys = -scores if largest else scores
+    n = min(n, len(keys))
+    if n < len(keys):
+        candidates = np.argpartition(keys, n - 1)[:n]
+    else:
+        candidates = np.arange(len(keys))
+    return candidates[np.argsort(keys[candidates], kind='mergesort')].tolist()
+
+
 def select_random(r, model, train_loader):
     if r == 0:
         return random.sample(range(0, len(train_loader.dataset)), 1280)
@@ -24,40 +65,16 @@ def select_margin(r, model, train_loader, primary="image"):
         img_embs, cap_embs = encode_data(model, train_loader)
         primary_embs, secondary_embs = (img_embs, cap_embs) if primary == "image" else (cap_embs, img_embs)
 
-        scores = []
-
-        for i in range(0, len(primary_embs), 128):
-            batch_range = min(128, len(primary_embs) - i)
-            primary_batch = primary_embs[i: i + batch_range]
-            primary_batch = torch.FloatTensor(primary_batch)
-
-            primary_secondary_distances = None
-            if torch.cuda.is_available():
-                primary_batch = primary_batch.cuda()
+        scores = np.zeros(len(primary_embs), dtype=np.float32)
 
-            for j in range(0, len(secondary_embs), 128):
-                batch_range2 = min(128, len(secondary_embs) - j)
-                secondary_batch = secondary_embs[j: j + batch_range2]
-
-                secondary_batch = torch.FloatTensor(secondary_batch)
-                if torch.cuda.is_available():
-                    secondary_batch = secondary_batch.cuda()
-
-                cosine_dist = primary_batch.mm(secondary_batch.t())
-
-                if j == 0:
-                    primary_secondary_distances = cosine_dist
-                else:
-                    primary_secondary_distances = torch.cat((primary_secondary_distances, cosine_dist), 1)
-
-            distances_top2 = torch.abs(torch.topk(primary_secondary_distances, 2, 1, largest=False)[0])
+        for i, values, _ in running_topk(primary_embs, secondary_embs, 2):
+            distances_top2 = torch.abs(values)
             margin = torch.abs(distances_top2[:, 0] - distances_top2[:, 1])
 
-            scores.extend(margin.cpu().numpy())
+            scores[i:i + len(margin)] = margin.cpu().numpy()
             print 'Selection: {:2.4}%\r'.format((float(i) / float(len(primary_embs))) * 100),
 
-        best_n_indices = [n[0] for n in heapq.nsmallest(128, enumerate(scores), key=lambda x: x[1])]
-        return best_n_indices
+        return best_n(scores, 128)
 
 def select_captionSimilarity(r, model, train_loader, primary="image"):
     if r == 0:
@@ -78,7 +95,7 @@ def select_captionSimilarity(r, model, train_loader, primary="image"):
             scores.append(primary_batch_sum.data.cpu().numpy())
 
         #Best results
-        best_n_indices = [n[0] for n in heapq.nsmallest(128, enumerate(scores), key=lambda x: x[1])]
+        best_n_indices = best_n(np.array(scores).ravel(), 128)
         print(best_n_indices)
         #worst results
         # best_n_indices = [n[0] for n in heapq.nlargest(128, enumerate(scores), key=lambda x: x[1])]
@@ -102,48 +119,16 @@ def select_uncertainty(r, model, train_loader, primary="image"):
         img_embs, cap_embs = encode_data(model, train_loader)
         primary_embs, secondary_embs = (img_embs, cap_embs) if primary == "image" else (cap_embs, img_embs)
 
-        scores = []
-
-        for i in range(0, len(primary_embs), 128):
-            batch_range = min(128, len(primary_embs) - i)
-            primary_batch = primary_embs[i: i + batch_range]
-            primary_batch = torch.FloatTensor(primary_batch)
-
-            image_scores = torch.zeros(batch_range)
-
-            primary_secondary_distances = None
-            if torch.cuda.is_available():
-                primary_batch = primary_batch.cuda()
-                image_scores = image_scores.cuda()
-
-            for j in range(0, len(secondary_embs), 128):
-                batch_range2 = min(128, len(secondary_embs) - j)
-                secondary_batch = secondary_embs[j: j + batch_range2]
-
-                secondary_batch = torch.FloatTensor(secondary_batch)
-                if torch.cuda.is_available():
-                    secondary_batch = secondary_batch.cuda()
+        scores = np.zeros(len(primary_embs))
 
-                cosine_dist = primary_batch.mm(secondary_batch.t())
-
-                if j == 0:
-                    primary_secondary_distances = cosine_dist
-                else:
-                    primary_secondary_distances = torch.cat((primary_secondary_distances, cosine_dist), 1)
-
-            # print(primary_secondary_distances)
-            distances_top10_index = torch.abs(torch.topk(primary_secondary_distances, 10, 1, largest=False)[1])
-
-            for row in distances_top10_index.cpu().numpy():
-                std = np.array([])
-
-                for caption_index in row:
-                    std = np.concatenate((std, secondary_embs[caption_index]))
-                scores.append(np.std(std))
+        for i, _, indices in running_topk(primary_embs, secondary_embs, 10):
+            # spread of all values of the 10 selected secondary embeddings
+            indices = indices.cpu().numpy()
+            top10 = secondary_embs[indices.ravel()].reshape(len(indices), -1)
+            scores[i:i + len(indices)] = top10.std(axis=1, dtype=np.float64)
             print 'Selection: {:2.4}%\r'.format((float(i) / float(len(primary_embs))) * 100),
 
-        best_n_indices = [n[0] for n in heapq.nlargest(128, enumerate(scores), key=lambda x: x[1])]
-        return best_n_indices
+        return best_n(scores, 128, largest=True)
 
 
 def select_hybrid(r, model, train_loader):
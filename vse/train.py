@@ -3,12 +3,15 @@ import os
 import time
 import shutil
 import datetime
+import copy
 
 import torch
+from collections import OrderedDict
 
 import data
 from vocab import Vocabulary  # NOQA
 from model import VSE
+import embedding_store
 from evaluation import i2t, t2i, AverageMeter, LogCollector, encode_data
 from selection_strategies import select_margin, select_random, select_uncertainty, select_hybrid,select_all, select_captionSimilarity
 
@@ -87,11 +90,48 @@ def main():
                         'train mode (Not recommended).')
     parser.add_argument('--no_log', action='store_true',
                         default=False, help='Disable logging')
+    parser.add_argument('--tokenizer', default='nltk',
+                        help='Caption tokenizer of the precomputed datasets '
+                        '(nltk|regex). regex is faster but differs from nltk '
+                        'on abbreviations and quotes.')
+    parser.add_argument('--token_store', action='store_true',
+                        help='Serve precomputed data from pre-encoded token '
+                        'arrays and memory-mapped image features.')
+    parser.add_argument('--feature_path', default='', type=str,
+                        help='Dir of CNN features from extract_features.py, '
+                        'used instead of the images when not fine-tuning '
+                        '(default: DATA_PATH/DATA_NAME/features/CNN_TYPE)')
+    parser.add_argument('--feature_crop', default='center',
+                        help='Extracted features to use (center|10crop)')
+    parser.add_argument('--image_cache', action='store_true',
+                        help='Read full images from a uint8 memory-mapped '
+                        'cache that is built on first use.')
+    parser.add_argument('--image_cache_path', default='', type=str,
+                        help='Dir of the image cache (default: DATA_PATH/'
+                        'DATA_NAME/image_cache)')
+    parser.add_argument('--image_cache_size', default=256, type=int,
+                        help='Short side of the cached images.')
+    parser.add_argument('--warm_start', action='store_true',
+                        help='Start every round from the weights of the '
+                        'previous round instead of a new model.')
+    parser.add_argument('--patience', default=0, type=int,
+                        help='Stop a round after this many epochs without '
+                        'rsum improvement (0: always train num_epochs).')
+    parser.add_argument('--min_delta', default=0., type=float,
+                        help='Min rsum increase that counts as improvement.')
+    parser.add_argument('--embed_spill_dir', default='', type=str,
+                        help='Dir to memory-map cached embeddings of large '
+                        'datasets to (default: keep in memory)')
+    parser.add_argument('--embed_spill_size', default=100000, type=int,
+                        help='Min number of items before cached embeddings '
+                        'are spilled to disk.')
     opt = parser.parse_args()
     opt.logger_name += "_" + opt.selection + "_" + opt.primary
     print(opt)
     if torch.cuda.is_available():
         torch.cuda.set_device(opt.device)
+    embedding_store.store.spill_dir = opt.embed_spill_dir
+    embedding_store.store.spill_size = opt.embed_spill_size
 
     # Setup tensorboard logger
     if not opt.no_log:
@@ -149,9 +189,7 @@ def main():
     for r in range(n_rounds):
         best_indices = selection(r, model, train_loader)
 
-        for index in best_indices:
-            active_loader.dataset.add_single(train_loader.dataset[index][0],
-                                            train_loader.dataset[index][1])
+        active_loader.dataset.add_from(train_loader.dataset, best_indices)
 
         train_loader.dataset.delete_indices(best_indices)
 
@@ -159,19 +197,18 @@ def main():
         print("Training on {} items ".format(len(active_loader)))
 
         # Reset the model
-        model = VSE(opt)
-        if torch.cuda.is_available():
-            model.cuda()
+        if not opt.warm_start or r == 0:
+            model = VSE(opt)
+            if torch.cuda.is_available():
+                model.cuda()
 
-        best_rsum = 0
-        for epoch in range(opt.num_epochs):
-            adjust_learning_rate(opt, model.optimizer, epoch)
+        epochs = train_round(opt, active_loader, model, val_loader)
 
-            # train for one epoch
-            train(opt, active_loader, model, epoch, val_loader)
-
-            # evaluate on validation set
+        # evaluate on validation set
         rsum = validate(opt, val_loader, model, not opt.no_log, r)
+        logging.info("Round %d: %d epochs, rsum %.1f" % (r, epochs, rsum))
+        if not opt.no_log:
+            tb_logger.log_value('round_epochs', epochs, step=r)
 
             # remember best R@ sum and save checkpoint
             # is_best = rsum > best_rsum
@@ -186,6 +223,47 @@ def main():
         # model.logger.tb_log(tb_logger, step=r)
 
 
+def train_round(opt, active_loader, model, val_loader):
+    """Trains `model` on the active set for up to `opt.num_epochs`. With
+    `opt.patience` set, rsum is validated after every epoch and the round
+    stops once it has not improved by `opt.min_delta` for `opt.patience`
+    epochs; the best weights and optimizer state are then restored. Returns the epochs trained.
+    """
+    best_rsum = None
+    best_state = None
+    best_optimizer_state = None
+    bad_epochs = 0
+    epochs = 0
+    for epoch in range(opt.num_epochs):
+        adjust_learning_rate(opt, model.optimizer, epoch)
+
+        # train for one epoch
+        train(opt, active_loader, model, epoch, val_loader)
+        epochs = epoch + 1
+
+        if opt.patience <= 0:
+            continue
+
+        rsum = validate(opt, val_loader, model)
+        if best_rsum is None or rsum > best_rsum + opt.min_delta:
+            best_rsum = rsum
+            best_state = [OrderedDict((k, v.clone()) for k, v in
+                                      state.items())
+                          for state in model.state_dict()]
+            best_optimizer_state = copy.deepcopy(
+                model.optimizer.state_dict())
+            bad_epochs = 0
+        else:
+            bad_epochs += 1
+            if bad_epochs >= opt.patience:
+                break
+
+    if best_state is not None and bad_epochs > 0:
+        model.load_state_dict(best_state)
+        model.optimizer.load_state_dict(best_optimizer_state)
+    return epochs
+
+
 def train(opt, train_loader, model, epoch, val_loader):
     # average meters to record the training statistics
     batch_time = AverageMeter()